@@ -0,0 +1,236 @@
+import time
+import uuid
+import logging
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from langchain.callbacks.base import BaseCallbackHandler
+
+logger = logging.getLogger(__name__)
+
+class RunCancelled(Exception):
+    """Raised inside an agent run that was cancelled"""
+
+class RunTimedOut(RunCancelled):
+    """Raised inside an agent run that went past its deadline"""
+
+class QueueFull(Exception):
+    """The user already has the maximum number of questions waiting"""
+
+class CancellationHandler(BaseCallbackHandler):
+    """Stops an agent run at its next LLM token, LLM call or tool call.
+
+    raise_error makes LangChain propagate the exception out of agent.run
+    instead of logging it.
+    """
+
+    raise_error = True
+
+    def __init__(self, job):
+        self.job = job
+
+    def check(self):
+        if self.job.cancel_requested.is_set():
+            raise RunCancelled("Cancelled by the user")
+        if self.job.deadline is not None and time.monotonic() > self.job.deadline:
+            raise RunTimedOut(f"Stopped after {self.job.timeout:g}s")
+
+    def on_chain_start(self, *args, **kwargs):
+        self.check()
+
+    def on_llm_start(self, *args, **kwargs):
+        self.check()
+
+    def on_chat_model_start(self, *args, **kwargs):
+        self.check()
+
+    def on_llm_new_token(self, *args, **kwargs):
+        self.check()
+
+    def on_agent_action(self, *args, **kwargs):
+        self.check()
+
+    def on_tool_start(self, *args, **kwargs):
+        self.check()
+
+# Events forwarded by ProgressRelay; the first two open a new step
+STEP_EVENTS = ("on_llm_start", "on_chat_model_start")
+RELAYED_EVENTS = STEP_EVENTS + (
+    "on_llm_new_token", "on_llm_end", "on_llm_error",
+    "on_tool_start", "on_tool_end", "on_tool_error",
+    "on_agent_action", "on_agent_finish", "on_text",
+)
+
+class ProgressRelay(BaseCallbackHandler):
+    """Forwards agent progress to a UI handler that can be swapped while the run continues.
+
+    A Streamlit rerun replaces the page the original handler writes to, so
+    the UI detaches the old handler and attaches a new one. A new handler
+    only receives events from the start of the next step, since it has not
+    seen the earlier part of the current one.
+    """
+
+    def __init__(self, handler=None):
+        self.handler = None
+        self._waiting_for_step = False
+        self.attach(handler)
+
+    def attach(self, handler):
+        self.handler = handler
+        self._waiting_for_step = True
+
+    def detach(self):
+        self.handler = None
+
+def _relay(name):
+    def forward(self, *args, **kwargs):
+        handler = self.handler
+        if handler is None:
+            return
+        if self._waiting_for_step:
+            if name not in STEP_EVENTS:
+                return
+            self._waiting_for_step = False
+        getattr(handler, name)(*args, **kwargs)
+    forward.__name__ = name
+    return forward
+
+for _event in RELAYED_EVENTS:
+    setattr(ProgressRelay, _event, _relay(_event))
+
+class AgentJob:
+    """One submitted agent run and its outcome.
+
+    status is queued, running, done, failed, cancelled or timeout. context
+    holds whatever the caller needs to finish the turn once the job ends.
+    """
+
+    def __init__(self, user, func, timeout):
+        self.job_id = uuid.uuid4().hex[:12]
+        self.user = user
+        self.func = func
+        self.timeout = timeout
+        self.status = "queued"
+        self.result = None
+        self.error = None
+        self.submitted = time.monotonic()
+        self.started = None
+        self.finished = None
+        self.deadline = None
+        self.context = {}
+        self.cancel_requested = threading.Event()
+        self._finished = threading.Event()
+
+    @property
+    def done(self):
+        return self._finished.is_set()
+
+    @property
+    def elapsed(self):
+        if self.started is None:
+            return 0.0
+        return (self.finished or time.monotonic()) - self.started
+
+    def wait(self, timeout=None):
+        """Block until the job ends or timeout seconds pass; True if it ended"""
+        return self._finished.wait(timeout)
+
+class AgentRunner:
+    """Bounded worker pool for agent runs with per-user queueing.
+
+    Each user has at most one run in the pool at a time; further questions
+    wait in that user's queue, so one busy session cannot take every worker.
+    func is called with a CancellationHandler that must be passed in the
+    callbacks of agent.run for cancel() and the timeout to take effect.
+    """
+
+    def __init__(self, max_workers=4, max_queued_per_user=3, timeout=120):
+        self.max_workers = max_workers
+        self.max_queued_per_user = max_queued_per_user
+        self.timeout = timeout
+        self.counts = {"done": 0, "failed": 0, "cancelled": 0, "timeout": 0}
+        self._executor = ThreadPoolExecutor(max_workers, thread_name_prefix="agent-worker")
+        self._active = {}
+        self._queues = {}
+        self._lock = threading.Lock()
+
+    def submit(self, user, func, timeout=None):
+        with self._lock:
+            waiting = self._queues.setdefault(user, deque())
+            if len(waiting) + (user in self._active) >= self.max_queued_per_user:
+                raise QueueFull(f"You already have {self.max_queued_per_user} questions in progress")
+            job = AgentJob(user, func, timeout or self.timeout)
+            if user in self._active:
+                waiting.append(job)
+            else:
+                self._dispatch(job)
+        return job
+
+    def _dispatch(self, job):
+        # Called with the lock held
+        self._active[job.user] = job
+        self._executor.submit(self._run, job)
+
+    def _run(self, job):
+        if not job.cancel_requested.is_set():
+            job.started = time.monotonic()
+            job.deadline = job.started + job.timeout
+            job.status = "running"
+            try:
+                job.result = job.func(CancellationHandler(job))
+                job.status = "done"
+            except RunTimedOut as e:
+                job.status, job.error = "timeout", e
+            except RunCancelled as e:
+                job.status, job.error = "cancelled", e
+            except Exception as e:
+                logger.exception("Agent run %s failed", job.job_id)
+                job.status, job.error = "failed", e
+        else:
+            job.status = "cancelled"
+        self._finish(job)
+        with self._lock:
+            self._active.pop(job.user, None)
+            waiting = self._queues.get(job.user)
+            if waiting:
+                self._dispatch(waiting.popleft())
+            elif waiting is not None:
+                del self._queues[job.user]
+
+    def _finish(self, job):
+        job.finished = time.monotonic()
+        with self._lock:
+            self.counts[job.status] += 1
+        job._finished.set()
+
+    def cancel(self, job):
+        """Stop a running job at its next step, or drop it from the queue"""
+        job.cancel_requested.set()
+        with self._lock:
+            waiting = self._queues.get(job.user)
+            if waiting is None or job not in waiting:
+                return
+            waiting.remove(job)
+        job.status = "cancelled"
+        self._finish(job)
+
+    def position(self, job):
+        """0 while the job is running or about to, otherwise its place in the user's queue"""
+        with self._lock:
+            waiting = self._queues.get(job.user, ())
+            return list(waiting).index(job) + 1 if job in waiting else 0
+
+    def stats(self):
+        with self._lock:
+            running = sum(1 for job in self._active.values() if job.status == "running")
+            return dict(
+                self.counts,
+                workers=self.max_workers,
+                running=running,
+                queued=len(self._active) - running + sum(len(q) for q in self._queues.values()),
+            )
+
+    def shutdown(self):
+        for job in list(self._active.values()):
+            job.cancel_requested.set()
+        self._executor.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,169 @@
+import os
+import re
+import time
+import sqlite3
+import hashlib
+import threading
+from contextlib import closing
+from sqlalchemy import inspect, make_url, text
+
+# Final answers that report that the agent failed rather than an answer
+FAILED_ANSWER = re.compile(r"^\s*(Agent stopped due to|Error\b|I don't know\b)", re.IGNORECASE)
+
+def normalize_question(question):
+    """Case-fold, collapse whitespace and drop trailing punctuation"""
+    question = re.sub(r"\s+", " ", question.strip().lower())
+    return question.rstrip(" ?.!")
+
+def database_identity(target):
+    """Name of a database for cache keys: the absolute path of a SQLite file,
+    or backend://host[:port]/database for a URL, without user and password"""
+    if "://" not in target:
+        return os.path.abspath(target)
+    url = make_url(target)
+    port = f":{url.port}" if url.port else ""
+    return f"{url.get_backend_name()}://{url.host or ''}{port}/{url.database or ''}"
+
+def is_cacheable_answer(answer):
+    """False for empty answers and ones that only say the agent failed"""
+    return bool(answer and answer.strip()) and not FAILED_ANSWER.match(answer)
+
+def schema_hash(engine):
+    """Short hash of the table and column definitions"""
+    inspector = inspect(engine)
+    parts = []
+    for table in sorted(inspector.get_table_names()):
+        columns = ",".join(f"{c['name']}:{c['type']}" for c in inspector.get_columns(table))
+        parts.append(f"{table}({columns})")
+    return hashlib.sha256(";".join(parts).encode()).hexdigest()[:16]
+
+def data_version(engine, db_path=None):
+    """Cheap stamp that changes whenever the underlying data changes.
+
+    For a local SQLite file this is the modification time and size of the
+    database and its WAL file. For MySQL it is taken from
+    information_schema, which tracks row counts and update times per table.
+    """
+    if db_path:
+        stamps = []
+        for path in (db_path, f"{db_path}-wal"):
+            if os.path.exists(path):
+                stat = os.stat(path)
+                stamps.append(f"{stat.st_mtime_ns}:{stat.st_size}")
+        return "/".join(stamps)
+    with engine.connect() as connection:
+        if engine.dialect.name == "mysql":
+            row = connection.execute(text(
+                "SELECT COALESCE(SUM(TABLE_ROWS), 0), COALESCE(SUM(AUTO_INCREMENT), 0), MAX(UPDATE_TIME) "
+                "FROM information_schema.tables WHERE table_schema = DATABASE()"
+            )).fetchone()
+            return ":".join(str(value) for value in row)
+        # Fall back to the highest rowid of every table, which is an O(1) lookup
+        stamps = [str(connection.execute(text("PRAGMA schema_version")).scalar())]
+        for table in sorted(inspect(engine).get_table_names()):
+            stamps.append(str(connection.execute(text(f'SELECT MAX(rowid) FROM "{table}"')).scalar()))
+        return ":".join(stamps)
+
+class AnswerCache:
+    """Persistent LRU/TTL cache of agent answers stored in a SQLite file.
+
+    Entries are keyed on the normalized question, the model, the database
+    (see database_identity), the schema hash and the data version, so any
+    change to the data produces new keys and stale answers are never
+    returned; they simply age out. Answers that report a failure, such as
+    the agent stopping at its iteration limit, are not stored.
+    """
+
+    def __init__(self, path="answer_cache.db", max_entries=1000, ttl_seconds=24 * 3600):
+        self.path = path
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        with closing(self._connect()) as connection, connection:
+            connection.execute("PRAGMA journal_mode = WAL")
+            connection.execute("""
+            CREATE TABLE IF NOT EXISTS answers (
+                cache_key TEXT PRIMARY KEY,
+                question TEXT,
+                model TEXT,
+                answer TEXT,
+                created_at REAL,
+                last_used REAL,
+                hits INTEGER DEFAULT 0
+            )
+            """)
+            connection.execute("CREATE INDEX IF NOT EXISTS idx_answers_last_used ON answers (last_used)")
+
+    def _connect(self):
+        return sqlite3.connect(self.path, timeout=5)
+
+    @staticmethod
+    def key(question, model, database, schema, version):
+        raw = "\x1f".join([normalize_question(question), model, database, schema, version])
+        return hashlib.sha256(raw.encode()).hexdigest()
+
+    def get(self, question, model, database, schema, version):
+        """Return the cached answer or None"""
+        cache_key = self.key(question, model, database, schema, version)
+        now = time.time()
+        with closing(self._connect()) as connection, connection:
+            row = connection.execute(
+                "SELECT answer, created_at FROM answers WHERE cache_key = ?", (cache_key,)
+            ).fetchone()
+            if row and now - row[1] > self.ttl_seconds:
+                connection.execute("DELETE FROM answers WHERE cache_key = ?", (cache_key,))
+                row = None
+            if row:
+                connection.execute(
+                    "UPDATE answers SET last_used = ?, hits = hits + 1 WHERE cache_key = ?", (now, cache_key)
+                )
+        with self._lock:
+            if row:
+                self.hits += 1
+            else:
+                self.misses += 1
+        return row[0] if row else None
+
+    def put(self, question, model, database, schema, version, answer):
+        """Store an answer and evict expired and least recently used entries.
+
+        Returns False without storing anything if the answer is not cacheable.
+        """
+        if not is_cacheable_answer(answer):
+            return False
+        cache_key = self.key(question, model, database, schema, version)
+        now = time.time()
+        with closing(self._connect()) as connection, connection:
+            connection.execute(
+                "INSERT OR REPLACE INTO answers (cache_key, question, model, answer, created_at, last_used, hits) "
+                "VALUES (?, ?, ?, ?, ?, ?, 0)",
+                (cache_key, normalize_question(question), model, answer, now, now)
+            )
+            connection.execute("DELETE FROM answers WHERE created_at < ?", (now - self.ttl_seconds,))
+            connection.execute("""
+            DELETE FROM answers WHERE cache_key IN (
+                SELECT cache_key FROM answers ORDER BY last_used DESC LIMIT -1 OFFSET ?
+            )
+            """, (self.max_entries,))
+        return True
+
+    def clear(self):
+        with closing(self._connect()) as connection, connection:
+            connection.execute("DELETE FROM answers")
+        with self._lock:
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        with closing(self._connect()) as connection:
+            entries = connection.execute("SELECT COUNT(*) FROM answers").fetchone()[0]
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "entries": entries,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+            }
@@ -0,0 +1,349 @@
+import os
+import re
+import csv
+import sys
+import json
+import time
+import random
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from langchain.callbacks.base import BaseCallbackHandler
+import fast_path
+from answer_cache import AnswerCache, data_version, database_identity, is_cacheable_answer, normalize_question, schema_hash
+from schema_catalog import SchemaCatalog, catalog_prompt_enabled, compose_agent_input
+from sql_tools import QueryRecorder, build_agent, internal_tables
+
+DEFAULT_MODEL = "Llama3-8b-8192"
+
+class TokenBucket:
+    """Thread-safe token bucket refilled at per_minute units a minute.
+
+    acquire blocks until the units are available. pause stops every taker
+    for a while, which is how a 429 from the backend slows all workers down
+    at once instead of each one finding out separately.
+    """
+
+    def __init__(self, per_minute, capacity=None):
+        self.rate = per_minute / 60.0
+        self.capacity = capacity or per_minute
+        self.available = self.capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self._lock = threading.Lock()
+
+    def acquire(self, amount=1):
+        """Take amount units, waiting as needed; returns the seconds waited"""
+        amount = min(amount, self.capacity)
+        waited = 0.0
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self.available = min(self.capacity, self.available + (now - self.updated) * self.rate)
+                self.updated = now
+                if now >= self.paused_until and self.available >= amount:
+                    self.available -= amount
+                    return waited
+                delay = max(self.paused_until - now, (amount - self.available) / self.rate)
+            time.sleep(delay)
+            waited += delay
+
+    def pause(self, seconds):
+        with self._lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+            self.available = 0
+
+def is_rate_limit_error(error):
+    """True for 429 / rate limit errors from the LLM backend"""
+    message = str(error).lower()
+    return type(error).__name__ == "RateLimitError" or "429" in message or "rate limit" in message
+
+class RateLimiter(BaseCallbackHandler):
+    """Keeps LLM calls of all concurrent agent runs under a request and token budget.
+
+    Calls are held back in on_llm_start, before the request is sent. Prompt
+    tokens are estimated at four characters per token. A rate-limit error
+    pauses every worker for cooldown seconds.
+    """
+
+    def __init__(self, requests_per_minute=None, tokens_per_minute=None, cooldown=10.0):
+        self.requests = TokenBucket(requests_per_minute) if requests_per_minute else None
+        self.tokens = TokenBucket(tokens_per_minute) if tokens_per_minute else None
+        self.cooldown = cooldown
+        self.waited = 0.0
+        self.calls = 0
+        self.rate_limited = 0
+        self._lock = threading.Lock()
+
+    def _acquire(self, chars):
+        waited = 0.0
+        if self.requests:
+            waited += self.requests.acquire()
+        if self.tokens:
+            waited += self.tokens.acquire(chars // 4)
+        with self._lock:
+            self.calls += 1
+            self.waited += waited
+
+    def on_llm_start(self, serialized, prompts, **kwargs):
+        self._acquire(sum(len(prompt) for prompt in prompts))
+
+    def on_chat_model_start(self, serialized, messages, **kwargs):
+        self._acquire(sum(len(str(message.content)) for batch in messages for message in batch))
+
+    def on_llm_error(self, error, **kwargs):
+        if is_rate_limit_error(error):
+            with self._lock:
+                self.rate_limited += 1
+            for bucket in (self.requests, self.tokens):
+                if bucket:
+                    bucket.pause(self.cooldown)
+
+def load_questions(path):
+    """[(id, question)] from a text file (one per line, # for comments), JSON Lines or CSV.
+
+    JSON Lines and CSV rows need a question field and may have an id field.
+    """
+    questions = []
+    with open(path, newline="", encoding="utf-8") as source:
+        if path.endswith((".jsonl", ".ndjson")):
+            rows = (json.loads(line) for line in source if line.strip())
+        elif path.endswith(".csv"):
+            rows = csv.DictReader(source)
+        else:
+            lines = (line.strip() for line in source)
+            rows = ({"question": line} for line in lines if line and not line.startswith("#"))
+        for number, row in enumerate(rows, 1):
+            if not row.get("question"):
+                raise SystemExit(f"{path}: entry {number} has no question")
+            questions.append((row.get("id") or str(number), row["question"].strip()))
+    return questions
+
+class BatchRunner:
+    """Answers a list of questions with the chat agent, several at a time.
+
+    Identical questions (after normalize_question) are answered once. Each
+    question goes through the same steps as in the chat: the answer cache,
+    then the fast path templates, then the agent. Agent runs that fail
+    with a rate-limit error are retried with exponential backoff.
+    """
+
+    def __init__(self, agent, engine, catalog=None, model=DEFAULT_MODEL, answer_cache=None, database="", data_stamp="",
+                 use_fast_path=True, parallelism=4, retries=3, backoff=5.0, rate_limiter=None, max_rows=1000):
+        self.agent = agent
+        self.engine = engine
+        self.catalog = catalog
+        self.model = model
+        self.answer_cache = answer_cache
+        self.database = database
+        self.schema = schema_hash(engine) if answer_cache is not None else None
+        self.data_stamp = data_stamp
+        self.use_fast_path = use_fast_path
+        self.parallelism = parallelism
+        self.retries = retries
+        self.backoff = backoff
+        self.rate_limiter = rate_limiter
+        self.max_rows = max_rows
+
+    def answer(self, question):
+        """Record for one question: answer, where it came from, SQL and result rows"""
+        record = {"question": question, "answer": None, "source": None, "sql": None, "columns": None,
+                  "rows": None, "total_rows": None, "attempts": 0, "error": None}
+        started = time.perf_counter()
+        try:
+            cached = self.answer_cache.get(question, self.model, self.database, self.schema, self.data_stamp) \
+                if self.answer_cache is not None else None
+            fast_answer = fast_path.answer_question(self.engine, question) \
+                if cached is None and self.use_fast_path else None
+            if cached is not None:
+                # Only the answer text is cached, so there is no result table
+                record.update(answer=cached, source="cache")
+            elif fast_answer is not None:
+                record.update(answer=fast_answer.text, source="fast_path", sql=fast_answer.sql,
+                              columns=list(fast_answer.columns), rows=[list(row) for row in fast_answer.rows],
+                              total_rows=len(fast_answer.rows))
+            else:
+                self._run_agent(question, record)
+            # Only answers of a finished agent run or a matched template are stored
+            if self.answer_cache is not None and record["source"] in ("agent", "fast_path") and not record["error"]:
+                self.answer_cache.put(question, self.model, self.database, self.schema, self.data_stamp, record["answer"])
+        except Exception as e:
+            record.update(source="error", error=str(e))
+        record["elapsed_ms"] = round((time.perf_counter() - started) * 1000, 1)
+        return record
+
+    def _run_agent(self, question, record):
+        callbacks = [self.rate_limiter] if self.rate_limiter else []
+        for attempt in range(self.retries + 1):
+            recorder = QueryRecorder()
+            record["attempts"] = attempt + 1
+            try:
+                answer = self.agent.run(compose_agent_input(question, self.catalog), callbacks=callbacks + [recorder])
+                break
+            except Exception as e:
+                if attempt == self.retries or not is_rate_limit_error(e):
+                    raise
+                # Exponential backoff with jitter, so retries do not arrive together
+                time.sleep(self.backoff * 2 ** attempt * random.uniform(0.5, 1.5))
+        record.update(answer=answer, source="agent")
+        if not is_cacheable_answer(answer):
+            # The agent hit its iteration or time limit, or gave up
+            record["error"] = answer or "The agent returned no answer"
+        result = recorder.last_result
+        if result is not None:
+            record.update(sql=result.sql, columns=list(result.columns),
+                          rows=[list(row) for row in result.rows[:self.max_rows]], total_rows=result.total_rows)
+
+    def run(self, questions, on_record=None):
+        """Records for [(id, question)] in input order; on_record is called as each one is ready"""
+        groups = {}
+        for index, (_, question) in enumerate(questions):
+            groups.setdefault(normalize_question(question), []).append(index)
+        records = [None] * len(questions)
+        with ThreadPoolExecutor(self.parallelism, thread_name_prefix="batch") as executor:
+            futures = {executor.submit(self.answer, questions[indices[0]][1]): indices for indices in groups.values()}
+            for future in as_completed(futures):
+                indices = futures[future]
+                for index in indices:
+                    question_id, question = questions[index]
+                    record = {"index": index, "id": question_id, **future.result(), "question": question}
+                    if index != indices[0]:
+                        record["duplicate_of"] = questions[indices[0]][0]
+                    records[index] = record
+                    if on_record:
+                        on_record(record)
+        return records
+
+def write_jsonl(records, path):
+    with open(path, "w", encoding="utf-8") as output:
+        for record in records:
+            output.write(json.dumps(record, default=str) + "\n")
+
+def write_parquet(records, directory):
+    """answers.parquet with one row per question, and results/<id>.parquet for each result table"""
+    try:
+        import pandas as pd
+        import pyarrow  # noqa: F401 - pandas needs it for Parquet
+    except ImportError:
+        raise SystemExit("Writing Parquet files needs pyarrow: pip install pyarrow")
+    os.makedirs(os.path.join(directory, "results"), exist_ok=True)
+    answers = []
+    for record in records:
+        answer = {key: value for key, value in record.items() if key not in ("columns", "rows")}
+        answer["result_file"] = None
+        if record.get("rows"):
+            # Duplicates point at the table of the question they repeat
+            name = re.sub(r"[^\w.-]", "_", str(record.get("duplicate_of") or record["id"]))
+            answer["result_file"] = f"results/{name}.parquet"
+            if not record.get("duplicate_of"):
+                table = pd.DataFrame.from_records(record["rows"], columns=record["columns"])
+                path = os.path.join(directory, answer["result_file"])
+                try:
+                    table.to_parquet(path, index=False)
+                except Exception:
+                    # Columns mixing types (SQLite allows it) are stored as text
+                    table.astype(str).to_parquet(path, index=False)
+        answers.append(answer)
+    pd.DataFrame(answers).astype({"total_rows": "Int64"}).to_parquet(os.path.join(directory, "answers.parquet"), index=False)
+
+def connect(database="medical.db", sites=None):
+    """(SQLDatabase, engine, federation or None, database identity, data stamp) for a SQLite path, URL or federated sites"""
+    from langchain.sql_database import SQLDatabase
+    from db_connection import pooled_engine, sqlite_engine
+    federation = None
+    if sites:
+        from federation import Federation, parse_sites, site_engines
+        sites = parse_sites("\n".join(sites))
+        federation = Federation(site_engines(sites))
+        engine = federation.first_engine
+        identity = "|".join(f"{site}={database_identity(target)}" for site, target in sites.items())
+        stamp = "|".join(data_version(federation.sites[site], target if "://" not in target else None)
+                         for site, target in sites.items())
+    elif "://" in database:
+        engine = pooled_engine(database)
+        identity = database_identity(database)
+        stamp = data_version(engine)
+    else:
+        if not os.path.exists(database):
+            raise SystemExit(f"Database {database} not found")
+        engine = sqlite_engine(database)
+        identity = database_identity(database)
+        stamp = data_version(engine, database)
+    return SQLDatabase(engine, ignore_tables=internal_tables(engine)), engine, federation, identity, stamp
+
+def main():
+    parser = argparse.ArgumentParser(description="Answer a file of questions with the MediChat agent, several at a time")
+    parser.add_argument("questions", help="questions file: one per line (.txt), or .jsonl/.csv rows with question and id")
+    parser.add_argument("--db", default="medical.db", help="SQLite database path or SQLAlchemy URL")
+    parser.add_argument("--site", action="append", help="name=path-or-url of a clinic database to federate (repeatable)")
+    parser.add_argument("--model", default=DEFAULT_MODEL, help="Groq model name")
+    parser.add_argument("--api-key", default=os.environ.get("GROQ_API_KEY"), help="Groq API key (default: GROQ_API_KEY)")
+    parser.add_argument("--parallelism", type=int, default=4, help="questions answered at the same time")
+    parser.add_argument("--requests-per-minute", type=float, default=30, help="LLM request budget (0 for none)")
+    parser.add_argument("--tokens-per-minute", type=float, default=0, help="LLM prompt token budget (0 for none)")
+    parser.add_argument("--retries", type=int, default=3, help="retries of a question after a rate-limit error")
+    parser.add_argument("--output", default="batch_answers.jsonl", help="JSON Lines file for the answers")
+    parser.add_argument("--parquet", help="also write answers.parquet and results/*.parquet to this directory")
+    parser.add_argument("--max-rows", type=int, default=1000, help="result rows kept per question")
+    parser.add_argument("--no-cache", action="store_true", help="do not use the answer cache (cached answers have no result table)")
+    parser.add_argument("--cache", default="answer_cache.db", help="answer cache shared with the chat UI")
+    args = parser.parse_args()
+    if not args.api_key:
+        raise SystemExit("A Groq API key is needed: set GROQ_API_KEY or pass --api-key")
+
+    questions = load_questions(args.questions)
+    db, engine, federation, identity, stamp = connect(args.db, args.site)
+    from langchain_groq import ChatGroq
+    from query_guard import QueryGuard
+    catalog = SchemaCatalog.build(engine, internal_tables(engine))
+    guard = QueryGuard(
+        engine, catalog,
+        max_examined_rows=int(os.environ.get("MEDICHAT_QUERY_MAX_ROWS", 10000000)),
+        timeout=float(os.environ.get("MEDICHAT_QUERY_TIMEOUT", 30)),
+    )
+    # The Groq client retries single calls itself; whole questions are retried on top of that
+    llm = ChatGroq(groq_api_key=args.api_key, model_name=args.model, max_retries=2)
+    # The guard always uses the catalog; questions only carry it with MEDICHAT_SCHEMA_CATALOG
+    prompt_catalog = catalog if catalog_prompt_enabled() else None
+    agent = build_agent(llm, db, verbose=False, catalog=prompt_catalog, guard=guard, federation=federation)
+    runner = BatchRunner(
+        agent, engine, prompt_catalog, model=args.model,
+        answer_cache=None if args.no_cache else AnswerCache(args.cache), database=identity, data_stamp=stamp,
+        use_fast_path=federation is None, parallelism=args.parallelism, retries=args.retries,
+        rate_limiter=RateLimiter(args.requests_per_minute or None, args.tokens_per_minute or None),
+        max_rows=args.max_rows,
+    )
+
+    unique = len({normalize_question(question) for _, question in questions})
+    print(f"{len(questions)} questions ({unique} unique), {args.parallelism} at a time")
+    done = []
+
+    def report(record):
+        done.append(record)
+        status = record["error"] or f"{record['total_rows'] if record['total_rows'] is not None else '-'} rows"
+        print(f"[{len(done)}/{len(questions)}] {record['source']:<9} {record['elapsed_ms'] / 1000:6.1f}s  "
+              f"{record['question'][:60]}  ({status})")
+
+    started = time.perf_counter()
+    records = runner.run(questions, on_record=report)
+    elapsed = time.perf_counter() - started
+    write_jsonl(records, args.output)
+    if args.parquet:
+        write_parquet(records, args.parquet)
+
+    sources = {}
+    for record in records:
+        if not record.get("duplicate_of"):
+            sources[record["source"]] = sources.get(record["source"], 0) + 1
+    busy = sum(record["elapsed_ms"] for record in records if not record.get("duplicate_of")) / 1000
+    limiter = runner.rate_limiter
+    print(f"Answered in {elapsed:.1f}s ({busy:.1f}s of question time): "
+          + ", ".join(f"{count} {source}" for source, count in sorted(sources.items())))
+    print(f"LLM calls: {limiter.calls}, {limiter.waited:.1f}s waiting for the rate limit, "
+          f"{limiter.rate_limited} rate-limit errors")
+    print(f"Answers written to {args.output}" + (f" and {args.parquet}" if args.parquet else ""))
+    if sources.get("error"):
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
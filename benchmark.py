@@ -0,0 +1,263 @@
+import os
+import sys
+import json
+import time
+import hashlib
+import argparse
+import tracemalloc
+from collections import Counter
+from langchain.callbacks.base import BaseCallbackHandler
+from langchain_core.language_models.chat_models import SimpleChatModel
+from medical_database import (
+    SCALE_PATIENTS, SCALE_RECORDS, SCALE_DOCTORS, generate_synthetic_database, upgrade_medical_database,
+)
+from db_connection import sqlite_engine
+from query_guard import QueryGuard
+from schema_catalog import SchemaCatalog, compose_agent_input
+from sql_tools import QueryRecorder, build_agent, internal_tables
+
+BENCHMARK_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "benchmarks")
+
+# Metrics compared against the baseline: timings and memory may grow by the
+# tolerance, prompt size by PROMPT_TOLERANCE, counts and result hashes must
+# match exactly
+TIMED_METRICS = ("latency_ms", "sql_ms")
+EXACT_METRICS = ("llm_calls", "tool_calls", "rows", "result_hash")
+PROMPT_TOLERANCE = 0.1
+
+class ScriptedChatModel(SimpleChatModel):
+    """Deterministic stand-in for ChatGroq that replays recorded ReAct traces.
+
+    The trace is picked by the question in the prompt and the step by the
+    number of observations the agent has collected so far. Prompts from
+    sql_db_query_checker get their query back unchanged.
+    """
+
+    traces: dict
+    model_name: str = "scripted"
+
+    @property
+    def _llm_type(self):
+        return "scripted-chat"
+
+    def _call(self, messages, stop=None, run_manager=None, **kwargs):
+        prompt = messages[-1].content
+        if "Double check the" in prompt:
+            return prompt.split("Double check the")[0].strip()
+        question, _, scratchpad = prompt.rpartition("Question:")[2].partition("\n")
+        steps = self.traces.get(question.strip())
+        if steps is None:
+            raise KeyError(f"No recorded trace for question: {question.strip()!r}")
+        step = scratchpad.count("Observation:")
+        return steps[min(step, len(steps) - 1)]
+
+class CallCounter(BaseCallbackHandler):
+    """Counts LLM calls, tool calls by tool name and prompt tokens.
+
+    Tokens are estimated at four characters each, which is close enough to
+    compare prompt sizes between runs.
+    """
+
+    def __init__(self):
+        self.llm_calls = 0
+        self.prompt_chars = 0
+        self.tool_calls = Counter()
+
+    @property
+    def prompt_tokens(self):
+        return self.prompt_chars // 4
+
+    def on_llm_start(self, serialized, prompts, **kwargs):
+        self.llm_calls += 1
+        self.prompt_chars += sum(len(prompt) for prompt in prompts)
+
+    def on_chat_model_start(self, serialized, messages, **kwargs):
+        self.llm_calls += 1
+        self.prompt_chars += sum(len(message.content) for batch in messages for message in batch)
+
+    def on_tool_start(self, serialized, input_str, **kwargs):
+        self.tool_calls[serialized.get("name", "tool")] += 1
+
+def load_traces(path=None):
+    with open(path or os.path.join(BENCHMARK_DIR, "traces.json")) as trace_file:
+        return json.load(trace_file)
+
+def scale_database(scale, data_dir=None, seed=42):
+    """Path of the synthetic database for a scale factor, generated on first use.
+
+    Databases cached by an earlier version are upgraded to the current schema.
+    """
+    data_dir = data_dir or os.path.join(BENCHMARK_DIR, "data")
+    os.makedirs(data_dir, exist_ok=True)
+    path = os.path.join(data_dir, f"medical_scale_{scale:g}_seed_{seed}.db")
+    if not os.path.exists(path):
+        print(f"Generating scale {scale:g} database at {path}")
+        generate_synthetic_database(
+            path=path,
+            patients=max(1, int(scale * SCALE_PATIENTS)),
+            records=int(scale * SCALE_RECORDS),
+            doctors=max(5, int(scale * SCALE_DOCTORS)),
+            seed=seed,
+        )
+    else:
+        upgrade_medical_database(path)
+    return path
+
+def _result_hash(result):
+    if result is None:
+        return None
+    return hashlib.sha256(repr((result.columns, result.rows)).encode()).hexdigest()[:16]
+
+def run_question(agent, question, catalog=None, trace_memory=False):
+    """Run one question through the agent and measure it.
+
+    tracemalloc slows Python down considerably, so peak memory is only
+    measured when trace_memory is set and timings from that run are not used.
+    """
+    recorder = QueryRecorder()
+    counter = CallCounter()
+    if trace_memory:
+        tracemalloc.start()
+    started = time.perf_counter()
+    try:
+        answer = agent.run(compose_agent_input(question, catalog), callbacks=[recorder, counter])
+    finally:
+        latency = time.perf_counter() - started
+        peak = tracemalloc.get_traced_memory()[1] if trace_memory else 0
+        if trace_memory:
+            tracemalloc.stop()
+    result = recorder.last_result
+    return {
+        "latency_ms": latency * 1000,
+        "sql_ms": sum(r.elapsed for r in recorder.results) * 1000,
+        "llm_calls": counter.llm_calls,
+        "prompt_tokens": counter.prompt_tokens,
+        "tool_calls": dict(sorted(counter.tool_calls.items())),
+        "rows": result.total_rows if result else 0,
+        "result_hash": _result_hash(result),
+        "peak_memory_kb": peak / 1024,
+        "answer": answer,
+    }
+
+def run_benchmark(scales, traces, repeat=5, seed=42, data_dir=None, use_catalog=False):
+    """Run every traced question at every scale; returns {scale: {question: metrics}}
+
+    Like the app, the query guard always uses a SchemaCatalog. Only with
+    use_catalog does the agent get it too (catalog-backed tools and the
+    relevant schema with each question), for comparing the same traces
+    with and without it.
+    """
+    from langchain.sql_database import SQLDatabase
+    llm = ScriptedChatModel(traces={trace["question"]: trace["steps"] for trace in traces})
+    report = {}
+    for scale in scales:
+        engine = sqlite_engine(scale_database(scale, data_dir, seed))
+        ignore_tables = internal_tables(engine)
+        db = SQLDatabase(engine, ignore_tables=ignore_tables)
+        guard_catalog = SchemaCatalog.build(engine, ignore_tables)
+        catalog = guard_catalog if use_catalog else None
+        guard = QueryGuard(engine, guard_catalog)
+        agent = build_agent(llm, db, verbose=False, catalog=catalog, guard=guard)
+        report[f"{scale:g}"] = results = {}
+        # Keep one-time costs such as lazy imports and cold page cache out of the numbers
+        if traces:
+            run_question(agent, traces[0]["question"], catalog)
+        for trace in traces:
+            # Timings are the best of the repeats, which is the least noisy estimate
+            memory_run = run_question(agent, trace["question"], catalog, trace_memory=True)
+            runs = [run_question(agent, trace["question"], catalog) for _ in range(repeat)]
+            metrics = dict(runs[-1])
+            for name in TIMED_METRICS:
+                metrics[name] = min(run[name] for run in runs)
+            metrics["peak_memory_kb"] = memory_run["peak_memory_kb"]
+            results[trace["question"]] = metrics
+        engine.dispose()
+    return report
+
+def compare(report, baseline, tolerance=0.5, min_delta_ms=15.0):
+    """Regressions of report against baseline as human-readable strings.
+
+    Timings only count as regressions past both the relative tolerance and
+    min_delta_ms, since short runs on a shared machine vary by tens of percent.
+    """
+    regressions = []
+    for scale, results in report.items():
+        for question, metrics in results.items():
+            expected = baseline.get(scale, {}).get(question)
+            if expected is None:
+                continue
+            label = f"[scale {scale}] {question}"
+            for name in TIMED_METRICS:
+                limit = max(expected[name] * (1 + tolerance), expected[name] + min_delta_ms)
+                if metrics[name] > limit:
+                    regressions.append(f"{label}: {name} {metrics[name]:.1f} > {expected[name]:.1f} baseline")
+            if metrics["peak_memory_kb"] > expected["peak_memory_kb"] * (1 + tolerance) + 64:
+                regressions.append(f"{label}: peak_memory_kb {metrics['peak_memory_kb']:.0f} > {expected['peak_memory_kb']:.0f} baseline")
+            # Baselines written before prompt sizes were measured have no prompt_tokens
+            if "prompt_tokens" in expected and metrics["prompt_tokens"] > expected["prompt_tokens"] * (1 + PROMPT_TOLERANCE):
+                regressions.append(f"{label}: prompt_tokens {metrics['prompt_tokens']} > {expected['prompt_tokens']} baseline")
+            for name in EXACT_METRICS:
+                if metrics[name] != expected[name]:
+                    regressions.append(f"{label}: {name} {metrics[name]} != {expected[name]} baseline")
+    return regressions
+
+def print_report(report, baseline=None):
+    print(f"{'scale':>6} {'latency ms':>11} {'vs base':>8} {'sql ms':>8} {'llm':>4} {'tokens':>7} {'tools':>5} {'rows':>8} {'peak KB':>8}  question")
+    for scale, results in report.items():
+        for question, metrics in results.items():
+            expected = (baseline or {}).get(scale, {}).get(question)
+            change = f"{(metrics['latency_ms'] / expected['latency_ms'] - 1) * 100:+.0f}%" if expected else "new"
+            print(
+                f"{scale:>6} {metrics['latency_ms']:>11.1f} {change:>8} {metrics['sql_ms']:>8.1f} {metrics['llm_calls']:>4} "
+                f"{metrics['prompt_tokens']:>7} {sum(metrics['tool_calls'].values()):>5} {metrics['rows']:>8,} {metrics['peak_memory_kb']:>8.0f}  {question}"
+            )
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the MediChat SQL agent offline with a scripted LLM")
+    parser.add_argument("--scales", default="0.1,1,5", help="comma-separated synthetic scale factors")
+    parser.add_argument("--repeat", type=int, default=5, help="runs per question; timings are the best run")
+    parser.add_argument("--seed", type=int, default=42, help="random seed for the synthetic databases")
+    parser.add_argument("--traces", help="trace file (default benchmarks/traces.json)")
+    parser.add_argument("--baseline", default=os.path.join(BENCHMARK_DIR, "baseline.json"), help="baseline file")
+    parser.add_argument("--update-baseline", action="store_true", help="store this run as the new baseline")
+    parser.add_argument("--tolerance", type=float, default=0.5, help="allowed relative slowdown")
+    parser.add_argument("--output", help="also write the full report as JSON to this file")
+    parser.add_argument("--catalog", action="store_true", help="give the agent the schema catalog (MEDICHAT_SCHEMA_CATALOG)")
+    args = parser.parse_args()
+
+    scales = [float(scale) for scale in args.scales.split(",")]
+    report = run_benchmark(scales, load_traces(args.traces), args.repeat, args.seed, use_catalog=args.catalog)
+    baseline = None
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as baseline_file:
+            baseline = json.load(baseline_file)
+    print_report(report, baseline)
+
+    if args.output:
+        with open(args.output, "w") as output_file:
+            json.dump(report, output_file, indent=2)
+    if args.update_baseline:
+        stored = {
+            scale: {
+                question: {k: round(v, 1) if isinstance(v, float) else v for k, v in metrics.items() if k != "answer"}
+                for question, metrics in results.items()
+            }
+            for scale, results in report.items()
+        }
+        with open(args.baseline, "w") as baseline_file:
+            json.dump(stored, baseline_file, indent=2, sort_keys=True)
+            baseline_file.write("\n")
+        print(f"Baseline written to {args.baseline}")
+        return
+    if baseline is None:
+        print("No baseline found; run with --update-baseline to create one")
+        return
+    regressions = compare(report, baseline, args.tolerance)
+    for regression in regressions:
+        print(f"REGRESSION {regression}")
+    if regressions:
+        sys.exit(1)
+    print("No regressions against the baseline")
+
+if __name__ == "__main__":
+    main()
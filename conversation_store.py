@@ -0,0 +1,202 @@
+import re
+import hmac
+import time
+import hashlib
+import secrets
+import sqlite3
+from contextlib import closing
+
+# Words that only make sense with an earlier turn ("what about them?",
+# "and the women?"). Plain "that" is left out, since "patients that ..." is
+# a standalone question
+CONTEXT_REFERENCE = re.compile(
+    r"^\s*(and|but|or|so|then|what about|how about)\b"
+    r"|\b(it|its|they|them|their|those|these|this one|he|she|him|her|his|same|also|too|instead|else|"
+    r"previous|above|earlier|again|another|ones)\b",
+    re.I
+)
+
+def depends_on_context(question):
+    """Whether a question refers back to earlier turns and cannot be answered on its own"""
+    return len(question.split()) < 3 or bool(CONTEXT_REFERENCE.search(question))
+
+def _first_sentence(text, limit):
+    """The first sentence of a message on one line, cut to limit characters"""
+    text = re.sub(r"\s+", " ", text or "").strip()
+    sentence = re.split(r"(?<=[.!?])\s", text, maxsplit=1)[0]
+    return sentence if len(sentence) <= limit else sentence[:limit - 3].rstrip() + "..."
+
+class ConversationStore:
+    """Chat history of every session, persisted in a SQLite file.
+
+    The page only reads the most recent messages of a session, so a rerun
+    costs the same however long the conversation is. Messages that fall
+    out of the last context_messages are folded into a rolling extractive
+    summary (each question with the first sentence of its answer), capped
+    at summary_max_chars by dropping the oldest lines. The summary and the
+    recent messages are what the agent sees of earlier turns.
+
+    Conversations idle for more than max_age_days, and the oldest beyond
+    max_sessions, are pruned at startup and every prune_every appends. A
+    browser can come back to its conversation with a resume token, the
+    session id signed with a secret (secret, else one generated and kept in
+    the store) that expires with the conversation.
+    """
+
+    def __init__(self, path="conversations.db", context_messages=6, summary_max_chars=1500, line_max_chars=160,
+                 max_age_days=30, max_sessions=10000, prune_every=200, secret=None):
+        self.path = path
+        self.context_messages = context_messages
+        self.summary_max_chars = summary_max_chars
+        self.line_max_chars = line_max_chars
+        self.max_age_days = max_age_days
+        self.max_sessions = max_sessions
+        self.prune_every = prune_every
+        self._appends = 0
+        with closing(self._connect()) as connection, connection:
+            connection.execute("PRAGMA journal_mode = WAL")
+            connection.execute("""
+            CREATE TABLE IF NOT EXISTS conversations (
+                session_id TEXT PRIMARY KEY,
+                created_at REAL,
+                updated_at REAL,
+                summary TEXT DEFAULT '',
+                summarized_through INTEGER DEFAULT 0
+            )
+            """)
+            connection.execute("""
+            CREATE TABLE IF NOT EXISTS messages (
+                message_id INTEGER PRIMARY KEY AUTOINCREMENT,
+                session_id TEXT,
+                role TEXT,
+                content TEXT,
+                created_at REAL
+            )
+            """)
+            connection.execute("CREATE INDEX IF NOT EXISTS idx_messages_session ON messages (session_id, message_id)")
+            connection.execute("CREATE INDEX IF NOT EXISTS idx_conversations_updated ON conversations (updated_at)")
+            connection.execute("CREATE TABLE IF NOT EXISTS store_settings (name TEXT PRIMARY KEY, value TEXT)")
+            if not secret:
+                # Kept in the store so tokens stay valid across restarts
+                connection.execute("INSERT OR IGNORE INTO store_settings VALUES ('resume_secret', ?)", (secrets.token_hex(32),))
+                secret = connection.execute("SELECT value FROM store_settings WHERE name = 'resume_secret'").fetchone()[0]
+        self._secret = secret.encode()
+        self.prune()
+
+    def _connect(self):
+        return sqlite3.connect(self.path, timeout=5)
+
+    def append(self, session_id, role, content):
+        """Store a message and fold the message that left the context window into the summary"""
+        now = time.time()
+        with closing(self._connect()) as connection, connection:
+            connection.execute(
+                "INSERT INTO conversations (session_id, created_at, updated_at) VALUES (?, ?, ?) "
+                "ON CONFLICT (session_id) DO UPDATE SET updated_at = excluded.updated_at",
+                (session_id, now, now)
+            )
+            message_id = connection.execute(
+                "INSERT INTO messages (session_id, role, content, created_at) VALUES (?, ?, ?, ?)",
+                (session_id, role, content, now)
+            ).lastrowid
+            self._roll_summary(connection, session_id)
+        self._appends += 1
+        if self.prune_every and self._appends % self.prune_every == 0:
+            self.prune()
+        return message_id
+
+    def prune(self):
+        """Delete conversations past max_age_days or beyond the newest max_sessions; returns how many"""
+        with closing(self._connect()) as connection, connection:
+            stale = [row[0] for row in connection.execute(
+                "SELECT session_id FROM conversations WHERE updated_at < ? "
+                "UNION SELECT session_id FROM (SELECT session_id FROM conversations ORDER BY updated_at DESC LIMIT -1 OFFSET ?)",
+                (time.time() - self.max_age_days * 86400, self.max_sessions)
+            )]
+            for session_id in stale:
+                connection.execute("DELETE FROM messages WHERE session_id = ?", (session_id,))
+                connection.execute("DELETE FROM conversations WHERE session_id = ?", (session_id,))
+        return len(stale)
+
+    def _signature(self, payload):
+        return hmac.new(self._secret, payload.encode(), hashlib.sha256).hexdigest()[:32]
+
+    def resume_token(self, session_id):
+        """A signed token that lets this browser return to the conversation until it would be pruned"""
+        payload = f"{session_id}.{int(time.time() + self.max_age_days * 86400)}"
+        return f"{payload}.{self._signature(payload)}"
+
+    def resume_session(self, token):
+        """The session id of a valid, unexpired resume token whose conversation still exists, else None"""
+        payload, _, signature = (token or "").rpartition(".")
+        session_id, _, expires = payload.rpartition(".")
+        if not session_id or not hmac.compare_digest(signature, self._signature(payload)):
+            return None
+        if not expires.isdigit() or int(expires) < time.time():
+            return None
+        with closing(self._connect()) as connection:
+            exists = connection.execute("SELECT 1 FROM conversations WHERE session_id = ?", (session_id,)).fetchone()
+        return session_id if exists else None
+
+    def _roll_summary(self, connection, session_id):
+        summary, through = connection.execute(
+            "SELECT summary, summarized_through FROM conversations WHERE session_id = ?", (session_id,)
+        ).fetchone()
+        # Messages older than the context window that are not summarized yet;
+        # at most a couple per append, so this stays constant-time
+        boundary = connection.execute(
+            "SELECT message_id FROM messages WHERE session_id = ? ORDER BY message_id DESC LIMIT 1 OFFSET ?",
+            (session_id, self.context_messages)
+        ).fetchone()
+        if boundary is None or boundary[0] <= through:
+            return
+        lines = summary.split("\n") if summary else []
+        for message_id, role, content in connection.execute(
+            "SELECT message_id, role, content FROM messages WHERE session_id = ? AND message_id > ? AND message_id <= ? "
+            "ORDER BY message_id", (session_id, through, boundary[0])
+        ).fetchall():
+            if role == "user":
+                lines.append(f"Q: {_first_sentence(content, self.line_max_chars)}")
+            elif lines and lines[-1].startswith("Q: "):
+                lines[-1] += f" A: {_first_sentence(content, self.line_max_chars)}"
+            through = message_id
+        while len(lines) > 1 and sum(len(line) + 1 for line in lines) > self.summary_max_chars:
+            lines.pop(0)
+        connection.execute(
+            "UPDATE conversations SET summary = ?, summarized_through = ? WHERE session_id = ?",
+            ("\n".join(lines), through, session_id)
+        )
+
+    def recent(self, session_id, limit):
+        """The last limit messages, oldest first, as dicts"""
+        with closing(self._connect()) as connection:
+            rows = connection.execute(
+                "SELECT message_id, role, content FROM messages WHERE session_id = ? ORDER BY message_id DESC LIMIT ?",
+                (session_id, limit)
+            ).fetchall()
+        return [{"id": message_id, "role": role, "content": content} for message_id, role, content in reversed(rows)]
+
+    def context(self, session_id):
+        """(rolling summary, recent messages) describing the conversation so far"""
+        with closing(self._connect()) as connection:
+            row = connection.execute("SELECT summary FROM conversations WHERE session_id = ?", (session_id,)).fetchone()
+        return (row[0] if row else ""), self.recent(session_id, self.context_messages)
+
+    def clear(self, session_id):
+        with closing(self._connect()) as connection, connection:
+            connection.execute("DELETE FROM messages WHERE session_id = ?", (session_id,))
+            connection.execute("DELETE FROM conversations WHERE session_id = ?", (session_id,))
+
+def format_conversation(summary, messages, message_max_chars=300):
+    """Earlier turns as a compact block for the agent input, or '' if there are none"""
+    lines = []
+    if summary:
+        lines += ["Earlier in this conversation:", summary]
+    if messages:
+        lines.append("Recent messages:")
+        for message in messages:
+            content = re.sub(r"\s+", " ", message["content"]).strip()
+            if len(content) > message_max_chars:
+                content = content[:message_max_chars - 3] + "..."
+            lines.append(f"{message['role']}: {content}")
+    return "\n".join(lines)
@@ -0,0 +1,156 @@
+import os
+import time
+import logging
+import threading
+from collections import defaultdict
+from sqlalchemy import inspect, text
+from medical_database import (
+    DASHBOARD_METRICS, DASHBOARD_STATS_TABLE, STAT_KEY_LENGTH, TABLE_KEYS,
+    metric_key_expression,
+)
+
+logger = logging.getLogger(__name__)
+
+def mysql_stats_enabled():
+    """Whether the app may keep dashboard_stats in MySQL databases (MEDICHAT_MYSQL_DASHBOARD_STATS).
+
+    Off by default: MySQL databases belong to their owners, and the app
+    only creates the table there when asked to.
+    """
+    return os.environ.get("MEDICHAT_MYSQL_DASHBOARD_STATS", "").lower() in ("1", "true", "yes")
+
+def read_dashboard_stats(engine):
+    """All materialized metrics as {metric: {stat_key: value}}, or None if not available.
+
+    This is a primary-key scan of a table with a few hundred rows, so the
+    dashboard costs the same however large the database is. On MySQL the
+    table is only used while DeltaRefresher keeps it current.
+    """
+    if engine.dialect.name == "mysql" and not mysql_stats_enabled():
+        return None
+    if "dashboard_stats" not in inspect(engine).get_table_names():
+        return None
+    stats = defaultdict(dict)
+    with engine.connect() as connection:
+        for metric, key, value in connection.execute(text(
+            "SELECT metric, stat_key, value FROM dashboard_stats WHERE value > 0"
+        )):
+            stats[metric][key] = value
+    # A table that exists but was never filled is not usable
+    return dict(stats) if "patients" in stats else None
+
+def combine_dashboard_stats(all_stats):
+    """Metrics of several databases added up, or None if any of them has none"""
+    combined = defaultdict(lambda: defaultdict(int))
+    for stats in all_stats:
+        if stats is None:
+            return None
+        for metric, values in stats.items():
+            for key, value in values.items():
+                combined[metric][key] += value
+    return {metric: dict(values) for metric, values in combined.items()} or None
+
+class DeltaRefresher:
+    """Keeps dashboard_stats current on MySQL, where the app installs no triggers.
+
+    Only started when mysql_stats_enabled(), since it creates and writes a
+    table in the database.
+
+    Every interval seconds only the rows added since the last run (by primary
+    key watermark) are aggregated and added to the counters. Updates and
+    deletes are not visible that way, so every full_refresh_every runs the
+    counters are rebuilt from scratch.
+    """
+
+    def __init__(self, engine, interval=60, full_refresh_every=60):
+        self.engine = engine
+        self.interval = interval
+        self.full_refresh_every = full_refresh_every
+        self.runs = 0
+        self.last_refresh = None
+        self._stop = threading.Event()
+        self._thread = None
+
+    def refresh(self, full=False):
+        """Bring the counters up to date; returns the number of new rows aggregated"""
+        with self.engine.begin() as connection:
+            connection.execute(text(DASHBOARD_STATS_TABLE))
+            if self.runs == 0:
+                self._widen_stat_key(connection)
+            watermarks = dict(connection.execute(text(
+                "SELECT stat_key, value FROM dashboard_stats WHERE metric = '_watermark'"
+            )).fetchall())
+            if full or not watermarks:
+                added = self._full_refresh(connection)
+            else:
+                added = self._delta_refresh(connection, watermarks)
+        self.runs += 1
+        self.last_refresh = time.time()
+        return added
+
+    def _widen_stat_key(self, connection):
+        # Tables created by earlier versions had a stat_key too short for some diagnoses
+        length = connection.execute(text(
+            "SELECT CHARACTER_MAXIMUM_LENGTH FROM information_schema.columns "
+            "WHERE table_schema = DATABASE() AND table_name = 'dashboard_stats' AND column_name = 'stat_key'"
+        )).scalar()
+        if length is not None and length < STAT_KEY_LENGTH:
+            connection.execute(text(f"ALTER TABLE dashboard_stats MODIFY stat_key VARCHAR({STAT_KEY_LENGTH}) NOT NULL"))
+
+    def _current_watermarks(self, connection):
+        tables = dict.fromkeys(table for table, _ in DASHBOARD_METRICS.values())
+        return {
+            table: connection.execute(text(f"SELECT COALESCE(MAX({TABLE_KEYS[table]}), 0) FROM {table}")).scalar()
+            for table in tables
+        }
+
+    def _full_refresh(self, connection):
+        # A full rebuild is a delta from an empty table
+        connection.execute(text("DELETE FROM dashboard_stats"))
+        return self._delta_refresh(connection, {})
+
+    def _delta_refresh(self, connection, watermarks):
+        current = self._current_watermarks(connection)
+        added = 0
+        for metric, (table, _) in DASHBOARD_METRICS.items():
+            low, high = watermarks.get(table, 0), current[table]
+            if high <= low:
+                continue
+            key = metric_key_expression(metric, table)
+            rows = connection.execute(text(
+                f"SELECT {key} AS stat_key, COUNT(*) AS value FROM {table} "
+                f"WHERE {TABLE_KEYS[table]} > :low AND {TABLE_KEYS[table]} <= :high GROUP BY {key}"
+            ), {"low": low, "high": high}).fetchall()
+            for stat_key, value in rows:
+                connection.execute(text(
+                    "INSERT INTO dashboard_stats (metric, stat_key, value) VALUES (:metric, :key, :value) "
+                    "ON DUPLICATE KEY UPDATE value = value + VALUES(value)"
+                ), {"metric": metric, "key": stat_key, "value": value})
+                added += value
+        self._store_watermarks(connection, current)
+        return added
+
+    def _store_watermarks(self, connection, watermarks):
+        connection.execute(text("DELETE FROM dashboard_stats WHERE metric = '_watermark'"))
+        for table, value in watermarks.items():
+            connection.execute(text(
+                "INSERT INTO dashboard_stats (metric, stat_key, value) VALUES ('_watermark', :table, :value)"
+            ), {"table": table, "value": value})
+
+    def _loop(self):
+        while not self._stop.is_set():
+            try:
+                self.refresh(full=self.runs % self.full_refresh_every == 0)
+            except Exception:
+                logger.exception("Dashboard stats refresh failed")
+            self._stop.wait(self.interval)
+
+    def start(self):
+        """Refresh now and then every interval seconds in a daemon thread"""
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._loop, name="dashboard-stats", daemon=True)
+            self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
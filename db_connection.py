@@ -0,0 +1,138 @@
+import os
+import sqlite3
+import logging
+import itertools
+import threading
+import weakref
+from pathlib import Path
+from sqlalchemy import URL, create_engine
+from sqlalchemy.pool import QueuePool
+
+logger = logging.getLogger(__name__)
+
+# Pool settings and the environment variables that override them
+POOL_SETTINGS = {
+    "pool_size": ("MEDICHAT_DB_POOL_SIZE", 5, int),
+    "max_overflow": ("MEDICHAT_DB_MAX_OVERFLOW", 10, int),
+    "pool_timeout": ("MEDICHAT_DB_POOL_TIMEOUT", 30, float),
+    "pool_recycle": ("MEDICHAT_DB_POOL_RECYCLE", 1800, int),
+    "pool_pre_ping": ("MEDICHAT_DB_PRE_PING", True, lambda value: value.lower() not in ("0", "false", "no")),
+}
+
+def pool_options(**overrides):
+    """Keyword arguments for create_engine from POOL_SETTINGS, the environment and overrides"""
+    options = {}
+    for name, (variable, default, parse) in POOL_SETTINGS.items():
+        value = os.environ.get(variable)
+        options[name] = parse(value) if value is not None else default
+    options.update(overrides)
+    return options
+
+# max_overflow of the engines made by pooled_engine; QueuePool does not expose it
+_max_overflow = weakref.WeakKeyDictionary()
+
+def pooled_engine(url, **options):
+    """create_engine with pool_options, remembering the overflow for pool_stats"""
+    options = pool_options(**options)
+    engine = create_engine(url, **options)
+    _max_overflow[engine] = options["max_overflow"]
+    return engine
+
+def enable_wal(path):
+    """Switch a SQLite database to WAL so readers do not block the writer or each other.
+
+    The journal mode is stored in the file, so medical_database calls this
+    once when it creates or upgrades a database, and the read-only engines
+    of sqlite_engine find it set. Returns the journal mode in effect.
+    """
+    connection = sqlite3.connect(path, timeout=5)
+    try:
+        return connection.execute("PRAGMA journal_mode = WAL").fetchone()[0]
+    except sqlite3.OperationalError as e:
+        logger.warning("Could not enable WAL for %s: %s", path, e)
+        return None
+    finally:
+        connection.close()
+
+def sqlite_engine(path, read_only=True, **overrides):
+    """Pooled engine for a SQLite file.
+
+    SQLAlchemy's default for files opens a connection per thread; a
+    QueuePool of connections created with check_same_thread=False lets the
+    agent workers, the dashboard and the fast path share a bounded set of
+    readers. Read-only connections use mode=ro so the agent cannot write.
+    """
+    path = Path(path).absolute()
+    uri = f"file:{path}?mode=ro" if read_only else f"file:{path}"
+    creator = lambda: sqlite3.connect(uri, uri=True, check_same_thread=False, timeout=5)
+    # Recycling and pinging only matter for server connections
+    options = dict(pool_recycle=-1, pool_pre_ping=False)
+    options.update(overrides)
+    return pooled_engine("sqlite:///", creator=creator, poolclass=QueuePool, **options)
+
+class RoundRobinCreator:
+    """Connection factory that spreads new connections over several hosts.
+
+    A host that refuses a connection is skipped until the next round, so a
+    replica that is down only costs one failed attempt per connection.
+    """
+
+    def __init__(self, hosts, connect):
+        self.hosts = list(hosts)
+        self.connect = connect
+        self._next = itertools.cycle(range(len(self.hosts)))
+        self._lock = threading.Lock()
+
+    def __call__(self):
+        error = None
+        for _ in self.hosts:
+            with self._lock:
+                host = self.hosts[next(self._next)]
+            try:
+                return self.connect(host)
+            except Exception as e:
+                logger.warning("Could not connect to %s: %s", host, e)
+                error = e
+        raise error
+
+def mysql_engines(host, user, password, database, replicas=(), **overrides):
+    """(primary engine, read engine) for MySQL.
+
+    With replicas the read engine opens its connections round-robin across
+    them; without, both are the same engine. Pre-ping and recycling replace
+    connections the server or a proxy has dropped.
+    """
+    url = URL.create("mysql+mysqlconnector", username=user, password=password, host=host, database=database)
+    primary = pooled_engine(url, **overrides)
+    if not replicas:
+        return primary, primary
+
+    def connect(replica):
+        # The dialect's own connect arguments, so replica connections get the
+        # same buffered cursors and client flags (FOUND_ROWS) as the primary's
+        replica_host, _, port = replica.partition(":")
+        args, kwargs = primary.dialect.create_connect_args(url.set(host=replica_host, port=int(port or 3306)))
+        return primary.dialect.connect(*args, **kwargs)
+
+    read = pooled_engine("mysql+mysqlconnector://", creator=RoundRobinCreator(replicas, connect), **overrides)
+    return primary, read
+
+def parse_hosts(value):
+    """Host list from a comma-separated string such as MEDICHAT_MYSQL_REPLICAS"""
+    return [host.strip() for host in (value or "").split(",") if host.strip()]
+
+def pool_stats(engine):
+    """Utilization of an engine's connection pool, or None for pools without a size"""
+    pool = engine.pool
+    if not isinstance(pool, QueuePool):
+        return None
+    checked_out = pool.checkedout()
+    capacity = pool.size() + _max_overflow.get(engine, pool_options()["max_overflow"])
+    return {
+        "size": pool.size(),
+        "checked_out": checked_out,
+        "idle": pool.checkedin(),
+        "overflow": max(pool.overflow(), 0),
+        "capacity": capacity,
+        "utilization": checked_out / capacity if capacity else 0.0,
+    }
@@ -0,0 +1,247 @@
+import re
+import time
+import threading
+from collections import namedtuple
+from sqlalchemy import text
+from answer_cache import normalize_question
+
+FastPathAnswer = namedtuple("FastPathAnswer", ["intent", "sql", "params", "columns", "rows", "text"])
+
+# Everyday names for the diagnoses used in medical_records, mapped to a
+# substring of the stored diagnosis text
+CONDITION_SYNONYMS = {
+    "high blood pressure": "hypertension",
+    "diabetes type 2": "type 2 diabetes",
+    "type ii diabetes": "type 2 diabetes",
+    "depression": "depress",
+    "anxiety": "anxiety",
+    "acid reflux": "reflux",
+    "gerd": "reflux",
+    "heartburn": "reflux",
+    "uti": "urinary tract infection",
+    "bladder infection": "urinary tract infection",
+    "arthritis": "arthritis",
+    "allergies": "allergic rhinitis",
+    "hay fever": "allergic rhinitis",
+    "cold": "upper respiratory infection",
+    "common cold": "upper respiratory infection",
+}
+
+# Words that signal extra filters the templates cannot express; such
+# questions fall through to the agent
+UNSUPPORTED_CONDITION_WORDS = re.compile(
+    r"\b(and|or|not|in|on|since|after|before|between|during|over|under|by|who|which|older|younger|"
+    r"than|male|female|men|women|age|aged|year|years|month|months|last|this|per)\b|\d{4}"
+)
+
+CONDITION = r"(?:an? )?(?P<condition>[a-z0-9' -]+)"
+
+INTENTS = [
+    (
+        "count_patients_by_diagnosis",
+        re.compile(r"^how many (?:patients|people)(?: have| has| had| with| are| were)?(?: been)?(?: diagnosed with)? " + CONDITION + r"$"),
+        """
+        SELECT COUNT(DISTINCT patient_id) AS patients
+        FROM medical_records
+        WHERE diagnosis LIKE :pattern
+        """,
+    ),
+    (
+        "top_doctors_by_patients",
+        re.compile(r"^(?:which|what) doctors? (?:has|have) (?:seen|treated) the most patients$"
+                   r"|^(?:who are |show |list |show me )?(?:the )?top (?P<limit>\d+) doctors(?: by (?:number of )?patients)?$"),
+        # Doctors tied with the limit-th highest count are all included
+        """
+        WITH counts AS (
+            SELECT d.doctor_id, d.first_name, d.last_name, d.specialization,
+                   COUNT(DISTINCT r.patient_id) AS patients
+            FROM medical_records r
+            JOIN doctors d ON r.doctor_id = d.doctor_id
+            GROUP BY d.doctor_id, d.first_name, d.last_name, d.specialization
+        )
+        SELECT * FROM counts
+        WHERE patients >= (SELECT MIN(patients) FROM (SELECT patients FROM counts ORDER BY patients DESC LIMIT :limit) AS top)
+        ORDER BY patients DESC, last_name, first_name
+        """,
+    ),
+    (
+        "medications_by_condition",
+        re.compile(r"^(?:list |show |show me |what are |which are |find )?(?:all )?(?:the )?(?:medications|medicines|drugs)"
+                   r"(?: that)?(?: are| were)? (?:prescribed|given|used) (?:for|to treat) " + CONDITION + r"$"),
+        """
+        SELECT m.name, m.category, COUNT(*) AS prescriptions
+        FROM prescriptions pr
+        JOIN medical_records r ON pr.record_id = r.record_id
+        JOIN medications m ON pr.medication_id = m.medication_id
+        WHERE r.diagnosis LIKE :pattern
+        GROUP BY m.medication_id, m.name, m.category
+        ORDER BY prescriptions DESC
+        """,
+    ),
+    (
+        "patients_by_condition",
+        re.compile(r"^(?:show|list|find|give|get)(?: me)? (?:all )?(?:the )?patients "
+                   r"(?:with|who have|who had|diagnosed with) " + CONDITION + r"$"),
+        """
+        SELECT DISTINCT p.patient_id, p.first_name, p.last_name, p.gender, p.date_of_birth, r.diagnosis
+        FROM patients p
+        JOIN medical_records r ON r.patient_id = p.patient_id
+        WHERE r.diagnosis LIKE :pattern
+        ORDER BY p.last_name, p.first_name
+        LIMIT :limit
+        """,
+    ),
+    (
+        "patient_lookup",
+        re.compile(r"^(?:show|find|look up|lookup|get)(?: me)? (?:the )?(?:patient|details for|records for|information for|info for)"
+                   r"(?: patient)? (?P<first_name>[a-z'-]+) (?P<last_name>[a-z'-]+)$"),
+        """
+        SELECT p.patient_id, p.first_name, p.last_name, p.date_of_birth, p.gender, p.blood_type,
+               r.visit_date, r.diagnosis, r.treatment_plan
+        FROM patients p
+        LEFT JOIN medical_records r ON r.patient_id = p.patient_id
+        WHERE LOWER(p.first_name) = :first_name AND LOWER(p.last_name) = :last_name
+        ORDER BY r.visit_date DESC
+        LIMIT :limit
+        """,
+    ),
+    (
+        "common_diagnoses",
+        re.compile(r"^(?:what are |show |list |show me )?(?:the )?(?:most common|top (?P<limit>\d+)|most frequent) diagnos[ie]s$"),
+        """
+        SELECT diagnosis, COUNT(*) AS records
+        FROM medical_records
+        GROUP BY diagnosis
+        ORDER BY records DESC
+        LIMIT :limit
+        """,
+    ),
+]
+
+DEFAULT_LIMITS = {
+    "top_doctors_by_patients": 1,
+    "patients_by_condition": 100,
+    "patient_lookup": 20,
+    "common_diagnoses": 10,
+}
+
+# Stored diagnosis values, re-read at most every DIAGNOSES_TTL seconds per engine
+DIAGNOSES_TTL = 300
+MAX_DIAGNOSES = 5000
+_diagnoses = {}
+_diagnoses_lock = threading.Lock()
+
+def known_diagnoses(engine):
+    """Lower-cased diagnosis values of medical_records.
+
+    Read from the dashboard counters when they exist, which is a lookup in
+    a small table, otherwise from the diagnosis index.
+    """
+    with _diagnoses_lock:
+        loaded = _diagnoses.get(engine)
+        if loaded and time.monotonic() - loaded[0] < DIAGNOSES_TTL:
+            return loaded[1]
+    from dashboard_stats import read_dashboard_stats
+    stats = read_dashboard_stats(engine)
+    if stats and stats.get("diagnosis"):
+        values = list(stats["diagnosis"])
+    else:
+        with engine.connect() as connection:
+            values = [row[0] for row in connection.execute(text(
+                f"SELECT DISTINCT diagnosis FROM medical_records WHERE diagnosis IS NOT NULL LIMIT {MAX_DIAGNOSES}"
+            ))]
+    values = [str(value).lower() for value in values]
+    with _diagnoses_lock:
+        _diagnoses[engine] = (time.monotonic(), values)
+    return values
+
+def _condition_pattern(condition, diagnoses=()):
+    """LIKE pattern for a condition, or None if it is not a known diagnosis.
+
+    The templates only answer for conditions that are a synonym in
+    CONDITION_SYNONYMS or words of a stored diagnosis; anything else
+    ("how many patients are there") goes to the agent.
+    """
+    condition = condition.strip()
+    if not condition or UNSUPPORTED_CONDITION_WORDS.search(condition) or len(condition.split()) > 4:
+        return None
+    term = CONDITION_SYNONYMS.get(condition)
+    if term is None:
+        words = re.compile(rf"\b{re.escape(condition)}\b")
+        if not any(words.search(diagnosis) for diagnosis in diagnoses):
+            return None
+        term = condition
+    return f"%{term}%"
+
+def match_intent(question, diagnoses=()):
+    """Return (intent, sql, params) for a supported question, otherwise None.
+
+    diagnoses are the lower-cased stored diagnosis values (see
+    known_diagnoses); without them only CONDITION_SYNONYMS are recognized.
+    """
+    question = normalize_question(question)
+    for intent, pattern, sql in INTENTS:
+        match = pattern.match(question)
+        if not match:
+            continue
+        groups = {k: v for k, v in match.groupdict().items() if v is not None}
+        params = {}
+        if "condition" in groups:
+            params["pattern"] = _condition_pattern(groups.pop("condition"), diagnoses)
+            if params["pattern"] is None:
+                return None
+        if ":limit" in sql:
+            params["limit"] = int(groups.pop("limit", DEFAULT_LIMITS[intent]))
+        # Names are compared lower-cased, so O'Brien and McDonald keep their spelling
+        params.update(groups)
+        return intent, sql, params
+    return None
+
+def _describe(intent, params, columns, rows):
+    """Plain-language answer for the rows returned by a template"""
+    condition = params.get("pattern", "").strip("%")
+    if intent == "count_patients_by_diagnosis":
+        return f"{rows[0][0]} patients have a diagnosis matching '{condition}'."
+    if not rows:
+        return "No matching records were found."
+    if intent == "top_doctors_by_patients":
+        lines = [f"Dr. {r[1]} {r[2]} ({r[3]}): {r[4]} patients" for r in rows]
+        if len(rows) == 1:
+            return f"Dr. {rows[0][1]} {rows[0][2]} ({rows[0][3]}) has seen the most patients: {rows[0][4]}."
+        if params["limit"] == 1:
+            return f"{len(rows)} doctors are tied for the most patients ({rows[0][4]} each):\n" + "\n".join(
+                f"- Dr. {r[1]} {r[2]} ({r[3]})" for r in rows)
+        tied = " (including ties)" if len(rows) > params["limit"] else ""
+        return f"Doctors who have seen the most patients{tied}:\n" + "\n".join(f"- {line}" for line in lines)
+    if intent == "medications_by_condition":
+        lines = [f"{r[0]} ({r[1]}): {r[2]} prescriptions" for r in rows]
+        return f"Medications prescribed for diagnoses matching '{condition}':\n" + "\n".join(f"- {line}" for line in lines)
+    if intent == "patients_by_condition":
+        lines = [f"{r[1]} {r[2]} (ID {r[0]}, {r[3]}, born {r[4]}): {r[5]}" for r in rows[:20]]
+        more = f"\n\n...and {len(rows) - 20} more (see the table)." if len(rows) > 20 else ""
+        found = f"the first {len(rows)}" if len(rows) == params["limit"] else str(len(rows))
+        return f"Showing {found} patients with diagnoses matching '{condition}':\n" + "\n".join(f"- {line}" for line in lines) + more
+    if intent == "patient_lookup":
+        first = rows[0]
+        lines = [f"{r[6]}: {r[7]} ({r[8]})" for r in rows if r[6]]
+        header = f"{first[1]} {first[2]} (ID {first[0]}), born {first[3]}, {first[4]}, blood type {first[5]}."
+        return header + ("\n\nVisits:\n" + "\n".join(f"- {line}" for line in lines) if lines else "\n\nNo visits on record.")
+    if intent == "common_diagnoses":
+        return "Most common diagnoses:\n" + "\n".join(f"- {r[0]}: {r[1]} records" for r in rows)
+    return str(rows)
+
+def answer_question(engine, question):
+    """Answer a common question with a parameterized template query.
+
+    Returns a FastPathAnswer, or None when the question does not match a
+    known intent and should go to the LLM agent.
+    """
+    matched = match_intent(question, known_diagnoses(engine))
+    if matched is None:
+        return None
+    intent, sql, params = matched
+    with engine.connect() as connection:
+        result = connection.execute(text(sql), params)
+        columns = list(result.keys())
+        rows = [tuple(row) for row in result]
+    return FastPathAnswer(intent, sql, params, columns, rows, _describe(intent, params, columns, rows))
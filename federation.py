@@ -0,0 +1,361 @@
+import re
+import time
+import datetime
+from decimal import Decimal
+from concurrent.futures import ThreadPoolExecutor
+from sql_tools import QueryResult, execute_query
+
+# Aggregates that can be combined from per-site partial results
+MERGEABLE_AGGREGATES = {"COUNT": "sum", "SUM": "sum", "TOTAL": "sum", "MIN": "min", "MAX": "max", "AVG": "avg"}
+AGGREGATE_CALL = re.compile(r"\b(COUNT|SUM|TOTAL|MIN|MAX|AVG|GROUP_CONCAT)\s*\(", re.IGNORECASE)
+
+ALIAS_KEYWORDS = {"END", "NULL", "TRUE", "FALSE", "DISTINCT", "ALL", "ASC", "DESC", "ESCAPE", "AND", "OR", "NOT"}
+
+CLAUSES = re.compile(r"\b(SELECT|FROM|WHERE|GROUP\s+BY|HAVING|ORDER\s+BY|LIMIT|UNION|INTERSECT|EXCEPT|WINDOW)\b", re.IGNORECASE)
+
+# Rows kept per site: every group for aggregates, a page for plain listings
+MAX_GROUPS = 100000
+MAX_ROWS = 1000
+
+class FederationError(Exception):
+    """A statement that cannot be answered by merging per-site results"""
+
+def _mask(sql):
+    """sql with string literals, quoted names and parenthesized text blanked out.
+
+    Positions are unchanged, so clauses and commas found in the mask can be
+    used to slice the original statement.
+    """
+    masked, depth, quote = [], 0, None
+    for char in sql:
+        if quote:
+            masked.append(" ")
+            if char == quote:
+                quote = None
+        elif char in "'\"`":
+            quote = char
+            masked.append(" ")
+        elif char == "(":
+            depth += 1
+            masked.append("(" if depth == 1 else " ")
+        elif char == ")":
+            depth -= 1
+            masked.append(")" if depth == 0 else " ")
+        else:
+            masked.append(char if depth == 0 else " ")
+    return "".join(masked)
+
+def _trim(text, masked):
+    """text and its mask with the text's surrounding whitespace removed from both"""
+    lead, end = len(text) - len(text.lstrip()), len(text.rstrip())
+    return text[lead:end], masked[lead:end]
+
+def _split_commas(text, masked):
+    """[(text, mask)] of the top-level comma-separated parts"""
+    parts, bounds = [], [-1] + [match.start() for match in re.finditer(",", masked)] + [len(text)]
+    for start, end in zip(bounds, bounds[1:]):
+        if text[start + 1:end].strip():
+            parts.append(_trim(text[start + 1:end], masked[start + 1:end]))
+    return parts
+
+def _normalize(expression):
+    return re.sub(r"\s+", "", expression).lower()
+
+def _sort_key(value):
+    # SQLite order: NULL, numbers, text, blobs. MySQL returns Decimal for
+    # numeric columns and date objects for dates, which sort as numbers and
+    # ISO text; anything else is compared by its text.
+    if value is None:
+        return (0, 0)
+    if isinstance(value, (int, float, Decimal)):
+        return (1, float(value))
+    if isinstance(value, (datetime.date, datetime.time)):
+        return (2, value.isoformat())
+    if isinstance(value, str):
+        return (2, value)
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        return (3, bytes(value))
+    return (2, str(value))
+
+class FederatedQuery:
+    """A SELECT split into the statement each site runs and how to merge the results.
+
+    Plain listings are unioned with a site column. Statements with
+    aggregates or GROUP BY are re-aggregated by group key: COUNT and SUM
+    add up, MIN and MAX combine, and AVG is run as SUM and COUNT on each
+    site. ORDER BY and LIMIT are applied again to the merged rows.
+    """
+
+    def __init__(self, sql):
+        self.sql = sql.strip().rstrip(";")
+        masked = _mask(self.sql)
+        clauses = [(re.sub(r"\s+", " ", m.group(1).upper()), m.start(), m.end()) for m in CLAUSES.finditer(masked)]
+        names = [name for name, _, _ in clauses]
+        if "SELECT" not in names:
+            raise FederationError("Only SELECT statements can be run across sites.")
+        for name in ("UNION", "INTERSECT", "EXCEPT", "WINDOW"):
+            if name in names:
+                raise FederationError(f"{name} is not supported across sites; run each part as its own query.")
+        if "HAVING" in names:
+            raise FederationError("HAVING is not supported across sites; select the aggregate and filter the merged groups instead.")
+        if any(names.count(name) > 1 for name in names):
+            raise FederationError("Only one top-level SELECT is supported across sites.")
+        if re.search(r"\bOVER\s*\(", self.sql, re.IGNORECASE):
+            raise FederationError("Window functions are not supported across sites.")
+
+        # Text of each top-level clause, and everything before SELECT (a WITH prefix)
+        self.parts = {}
+        for (name, _, end), (_, next_start, _) in zip(clauses, clauses[1:] + [(None, len(self.sql), None)]):
+            self.parts[name] = _trim(self.sql[end:next_start], masked[end:next_start])
+        self.prefix = self.sql[:clauses[names.index("SELECT")][1]]
+
+        select, select_masked = self.parts["SELECT"]
+        self.distinct = bool(re.match(r"DISTINCT\b", select_masked, re.IGNORECASE))
+        if self.distinct:
+            offset = len(re.match(r"DISTINCT\s*", select, re.IGNORECASE).group(0))
+            select, select_masked = select[offset:], select_masked[offset:]
+        self.items = [self._item(text, masked) for text, masked in _split_commas(select, select_masked)]
+        self.grouped = "GROUP BY" in self.parts or any(item["merge"] != "key" for item in self.items)
+        if self.grouped and any(item["star"] for item in self.items):
+            raise FederationError("SELECT * cannot be combined with aggregates across sites.")
+        self.limit, self.offset = self._limit()
+
+        # Columns each site returns after the selected ones: the COUNT of every
+        # AVG, group keys that are not selected and sort expressions that are not
+        self.averages = [index for index, item in enumerate(self.items) if item["merge"] == "avg"]
+        self.extra = [f"COUNT({self.items[index]['argument']})" for index in self.averages]
+        self.keys = [index for index, item in enumerate(self.items) if item["merge"] == "key"]
+        if "GROUP BY" in self.parts:
+            for text, _ in _split_commas(*self.parts["GROUP BY"]):
+                if self._match(text) is None:
+                    self.keys.append(len(self.items) + len(self.extra))
+                    self.extra.append(text)
+        self.order = []
+        if "ORDER BY" in self.parts:
+            for text, masked in _split_commas(*self.parts["ORDER BY"]):
+                match = re.search(r"\s+(ASC|DESC)$", masked, re.IGNORECASE)
+                descending = bool(match and match.group(1).upper() == "DESC")
+                expression = text[:match.start()].strip() if match else text
+                position = self._match(expression)
+                if position is None:
+                    if self.grouped:
+                        raise FederationError(
+                            f"ORDER BY {expression} must be one of the selected columns to sort groups across sites."
+                        )
+                    position = len(self.items) + len(self.extra)
+                    self.extra.append(expression)
+                self.order.append((position, descending))
+
+    def _item(self, text, masked):
+        alias = None
+        match = re.search(r"\s+(?:(AS)\s+)?([A-Za-z_]\w*|\"[^\"]+\"|`[^`]+`)$", text, re.IGNORECASE)
+        # A trailing name is an alias after AS, or after a complete expression unless it is a keyword (CASE ... END)
+        if match and (match.group(1) or match.group(2).upper() not in ALIAS_KEYWORDS) \
+                and text[:match.start()].strip() and (match.group(2)[0] in "\"`" or masked[match.start(2)] != " "):
+            alias = match.group(2).strip('"`')
+            text = text[:match.start()].strip()
+        item = {"expression": text, "alias": alias, "merge": "key", "star": text.endswith("*")}
+        call = re.match(r"^(\w+)\s*\((.*)\)$", text, re.DOTALL)
+        if call and call.group(1).upper() in MERGEABLE_AGGREGATES and not AGGREGATE_CALL.search(call.group(2)):
+            if re.match(r"\s*DISTINCT\b", call.group(2), re.IGNORECASE) and call.group(1).upper() not in ("MIN", "MAX"):
+                raise FederationError(
+                    f"{text} cannot be combined across sites, since the same value may occur at several sites. "
+                    f"Select the distinct values instead, or count without DISTINCT."
+                )
+            item.update(merge=MERGEABLE_AGGREGATES[call.group(1).upper()], argument=call.group(2).strip(), star=False)
+        elif AGGREGATE_CALL.search(text):
+            raise FederationError(
+                f"{text} cannot be combined across sites. Select plain aggregates such as SUM(x) or COUNT(*); "
+                f"ratios, rounding and other expressions around aggregates are not supported."
+            )
+        return item
+
+    def _limit(self):
+        if "LIMIT" not in self.parts:
+            return None, 0
+        match = re.match(r"(\d+)\s*(?:,\s*(\d+)|OFFSET\s+(\d+))?$", self.parts["LIMIT"][0], re.IGNORECASE)
+        if not match:
+            raise FederationError("LIMIT must be a number (optionally with OFFSET) across sites.")
+        if match.group(2):
+            return int(match.group(2)), int(match.group(1))
+        return int(match.group(1)), int(match.group(3) or 0)
+
+    def _match(self, expression):
+        """Position of the selected column an ORDER BY or GROUP BY term refers to, or None"""
+        if expression.isdigit():
+            return int(expression) - 1
+        wanted = _normalize(expression)
+        for index, item in enumerate(self.items):
+            if item["alias"] and item["alias"].lower() == wanted.strip('"`'):
+                return index
+        for index, item in enumerate(self.items):
+            column = _normalize(item["expression"])
+            if column == wanted or column.split(".")[-1] == wanted.split(".")[-1] and "(" not in wanted + column:
+                return index
+        return None
+
+    def site_sql(self):
+        """The statement every site runs"""
+        columns = []
+        for item in self.items:
+            # AVG becomes SUM in place, so positions (GROUP BY 1) still refer to the same columns
+            expression = f"SUM({item['argument']})" if item["merge"] == "avg" else item["expression"]
+            columns.append(expression + (f" AS {item['alias']}" if item["alias"] else ""))
+        select = ("DISTINCT " if self.distinct else "") + ", ".join(columns + self.extra)
+        sql = f"{self.prefix}SELECT {select}"
+        for name in ("FROM", "WHERE", "GROUP BY"):
+            if name in self.parts:
+                sql += f" {name} {self.parts[name][0]}"
+        if not self.grouped:
+            if "ORDER BY" in self.parts:
+                sql += f" ORDER BY {self.parts['ORDER BY'][0]}"
+            if self.limit is not None:
+                # The first limit + offset rows of the union are among each site's first limit + offset
+                sql += f" LIMIT {self.limit + self.offset}"
+        return sql
+
+    def merge(self, site_results):
+        """(columns, rows) combined from [(site, QueryResult)]"""
+        first = site_results[0][1]
+        width = len(first.columns) - len(self.extra)
+        columns = list(first.columns[:width])
+        for index in self.averages:
+            columns[index] = self.items[index]["alias"] or self.items[index]["expression"]
+        if self.grouped:
+            rows, offset = self._reaggregate(site_results), 0
+        else:
+            # Listings keep every row, tagged with the site it came from
+            rows, offset = [], 1
+            for site, result in site_results:
+                rows.extend((site,) + tuple(row) for row in result.rows)
+            if self.distinct:
+                unique = {}
+                for row in rows:
+                    unique.setdefault(row[1:1 + width], row)
+                rows = list(unique.values())
+            columns = ["site"] + columns
+        for position, descending in reversed(self.order):
+            rows.sort(key=lambda row: _sort_key(row[offset + position]), reverse=descending)
+        if self.offset or self.limit is not None:
+            rows = rows[self.offset:None if self.limit is None else self.offset + self.limit]
+        return columns, [tuple(row[:offset + width]) for row in rows]
+
+    def _reaggregate(self, site_results):
+        groups = {}
+        for _, result in site_results:
+            for row in result.rows:
+                key = tuple(row[index] for index in self.keys)
+                merged = groups.get(key)
+                if merged is None:
+                    groups[key] = list(row)
+                    continue
+                for index, item in enumerate(self.items):
+                    value, current = row[index], merged[index]
+                    if item["merge"] in ("sum", "avg"):
+                        merged[index] = value if current is None else current if value is None else current + value
+                    elif item["merge"] in ("min", "max") and value is not None:
+                        merged[index] = value if current is None else (min if item["merge"] == "min" else max)(current, value)
+                for n in range(len(self.averages)):
+                    merged[len(self.items) + n] += row[len(self.items) + n]
+        for merged in groups.values():
+            for n, index in enumerate(self.averages):
+                count = merged[len(self.items) + n]
+                merged[index] = merged[index] / count if count else None
+        return list(groups.values())
+
+class FederatedResult(QueryResult):
+    """Merged rows of a federated query; only the merged rows can be paged"""
+
+    def __init__(self, sql, columns, rows, elapsed, total_rows, complete, site_timings):
+        super().__init__(sql, columns, rows, elapsed, total_rows, complete)
+        self.site_timings = site_timings
+
+    @property
+    def truncated(self):
+        return not self.complete
+
+    def page(self, number, page_size=100):
+        import pandas as pd
+        return pd.DataFrame.from_records(self.rows[number * page_size:(number + 1) * page_size], columns=self.columns)
+
+class Federation:
+    """Runs each query on every registered site database in parallel and merges the results.
+
+    Sites must share the medical_database.py schema. Latency is that of
+    the slowest site, since all sites run at the same time.
+    """
+
+    def __init__(self, sites, max_workers=None):
+        self.sites = dict(sites)
+        self._executor = ThreadPoolExecutor(max_workers or len(self.sites), thread_name_prefix="federation")
+
+    @property
+    def first_engine(self):
+        return next(iter(self.sites.values()))
+
+    def map(self, func):
+        """{site: func(engine)} for every site, computed concurrently"""
+        futures = {site: self._executor.submit(func, engine) for site, engine in self.sites.items()}
+        return {site: future.result() for site, future in futures.items()}
+
+    def execute(self, sql, timeout=None):
+        query = FederatedQuery(sql)
+        site_sql = query.site_sql()
+        capture = MAX_GROUPS if query.grouped else min(MAX_ROWS, (query.limit or MAX_ROWS) + query.offset)
+        started = time.perf_counter()
+
+        def run(engine):
+            return execute_query(engine, site_sql, capture_rows=capture, timeout=timeout)
+
+        futures = {site: self._executor.submit(run, engine) for site, engine in self.sites.items()}
+        results, errors = [], {}
+        for site, future in futures.items():
+            try:
+                results.append((site, future.result()))
+            except Exception as e:
+                errors[site] = str(e)
+        if errors:
+            # A partial answer would silently undercount, so one failing site fails the query
+            if len(set(errors.values())) == 1:
+                failed = "every site" if len(errors) == len(self.sites) else ", ".join(errors)
+                raise FederationError(f"The query failed on {failed}: {next(iter(errors.values()))}")
+            raise FederationError("The query failed on " + "; ".join(f"{site}: {e}" for site, e in errors.items()))
+        columns, rows = query.merge(results)
+        elapsed = time.perf_counter() - started
+        complete = all(result.complete and result.total_rows <= len(result.rows) for _, result in results)
+        total = len(rows) if query.grouped or query.limit is not None else sum(r.total_rows for _, r in results)
+        timings = {site: result.elapsed for site, result in results}
+        return FederatedResult(sql, columns, rows, elapsed, max(total, len(rows)), complete, timings)
+
+    def describe(self, result):
+        """One line on where a merged result came from, for the LLM"""
+        slowest = max(result.site_timings, key=result.site_timings.get)
+        return (f"(Merged from {len(result.site_timings)} sites: {', '.join(result.site_timings)}; "
+                f"slowest was {slowest} at {result.site_timings[slowest] * 1000:.0f} ms.)")
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False)
+
+def parse_sites(spec):
+    """{site: database} from 'name=path-or-url' entries, one per line.
+
+    Only newlines separate entries, since SQLAlchemy URLs may contain commas.
+    """
+    sites = {}
+    for entry in (spec or "").splitlines():
+        entry = entry.strip()
+        if not entry:
+            continue
+        name, _, target = entry.partition("=") if "=" in entry.split("://")[0] else ("", "", entry)
+        target = target.strip()
+        name = name.strip() or re.sub(r"\.db$", "", target.rstrip("/").split("/")[-1])
+        sites[name] = target
+    return sites
+
+def site_engines(sites):
+    """Pooled engines for {site: SQLite path or SQLAlchemy URL}"""
+    from db_connection import pooled_engine, sqlite_engine
+    return {
+        site: pooled_engine(target) if "://" in target else sqlite_engine(target)
+        for site, target in sites.items()
+    }
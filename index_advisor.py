@@ -0,0 +1,219 @@
+import re
+import time
+import logging
+import threading
+from collections import Counter, deque
+from langchain.callbacks.base import BaseCallbackHandler
+from sqlalchemy import inspect, text
+
+logger = logging.getLogger(__name__)
+
+# Name of the SQLDatabaseToolkit tool that executes queries
+QUERY_TOOL_NAME = "sql_db_query"
+
+# Table references in FROM / JOIN clauses, with an optional alias
+TABLE_REF = re.compile(
+    r"\b(?:FROM|JOIN)\s+[`\"]?(\w+)[`\"]?(?:\s+(?:AS\s+)?(?!ON\b|WHERE\b|JOIN\b|INNER\b|LEFT\b|RIGHT\b|CROSS\b|GROUP\b|ORDER\b|LIMIT\b|USING\b)(\w+))?"
+    r"|,\s*[`\"]?(\w+)[`\"]?(?:\s+(?:AS\s+)?(?!ON\b|WHERE\b|JOIN\b|GROUP\b|ORDER\b|LIMIT\b)(\w+))?",
+    re.IGNORECASE,
+)
+
+# Column predicates: equality first, then ranges, which is also the order
+# the suggested composite index uses
+EQUALITY_PREDICATE = re.compile(r"(?:(\w+)\.)?(\w+)\s*(?:=|\bIN\s*\()", re.IGNORECASE)
+JOIN_PREDICATE = re.compile(r"(\w+)\.(\w+)\s*=\s*(\w+)\.(\w+)", re.IGNORECASE)
+RANGE_PREDICATE = re.compile(
+    r"(?:(\w+)\.)?(\w+)\s*(?:<=|>=|<(?!>)|>|\bBETWEEN\b|\bLIKE\s+'(?!%))", re.IGNORECASE
+)
+
+def _strip_literals(sql):
+    """Blank out string literals so their contents are not read as columns"""
+    return re.sub(r"'(?:[^']|'')*'", "''", sql)
+
+class IndexAdvisor(BaseCallbackHandler):
+    """Watches the SQL the agent runs and suggests indexes for repeated full scans.
+
+    Every statement passed to the sql_db_query tool is logged and explained
+    (EXPLAIN QUERY PLAN on SQLite, EXPLAIN on MySQL). Tables that are fully
+    scanned while being filtered or joined on a column become index
+    candidates once the same scan has been seen min_occurrences times.
+    """
+
+    def __init__(self, engine, min_occurrences=2, history=200):
+        self.engine = engine
+        self.min_occurrences = min_occurrences
+        self.statements = deque(maxlen=history)
+        self._candidates = Counter()
+        self._lock = threading.Lock()
+        self._columns = None
+        self._indexed = None
+
+    def on_tool_start(self, serialized, input_str, **kwargs):
+        if serialized.get("name") == QUERY_TOOL_NAME:
+            self.observe(input_str)
+
+    def observe(self, sql):
+        """Log a statement and record the index candidates from its plan"""
+        sql = sql.strip().strip("`").strip()
+        if not sql.upper().startswith(("SELECT", "WITH")):
+            return []
+        started = time.perf_counter()
+        try:
+            scans = self.full_scans(sql)
+        except Exception as e:
+            logger.info("Could not explain query: %s", e)
+            scans = []
+        candidates = self._candidates_for(sql, scans)
+        with self._lock:
+            self.statements.append({
+                "sql": sql,
+                "full_scans": scans,
+                "explain_ms": (time.perf_counter() - started) * 1000,
+            })
+            for candidate in candidates:
+                self._candidates[candidate] += 1
+        logger.info("SQL: %s | full scans: %s", sql, ", ".join(scans) or "none")
+        return candidates
+
+    def full_scans(self, sql):
+        """Tables the database plans to read in full for this statement"""
+        aliases = self._aliases(sql)
+        scans = []
+        with self.engine.connect() as connection:
+            if self.engine.dialect.name == "sqlite":
+                for row in connection.execute(text(f"EXPLAIN QUERY PLAN {sql}")):
+                    match = re.match(r"SCAN (?:TABLE )?(\w+)(.*)", row[-1])
+                    if match and "INDEX" not in match.group(2):
+                        scans.append(aliases.get(match.group(1).lower(), match.group(1)))
+            else:
+                for row in connection.execute(text(f"EXPLAIN {sql}")).mappings():
+                    if row.get("type") == "ALL" and row.get("table"):
+                        scans.append(aliases.get(row["table"].lower(), row["table"]))
+        return scans
+
+    def suggestions(self):
+        """Index suggestions ordered by how often the scan was seen"""
+        with self._lock:
+            candidates = self._candidates.most_common()
+        indexed = self._indexed_prefixes()
+        suggestions = []
+        for (table, columns), count in candidates:
+            if count < self.min_occurrences or columns in indexed.get(table, set()):
+                continue
+            name = f"idx_auto_{table}_{'_'.join(columns)}"
+            # MySQL has no IF NOT EXISTS for indexes; apply() checks for them there
+            guard = "IF NOT EXISTS " if self.engine.dialect.name == "sqlite" else ""
+            suggestions.append({
+                "table": table,
+                "columns": columns,
+                "name": name,
+                "full_scans": count,
+                "ddl": f"CREATE INDEX {guard}{name} ON {table} ({', '.join(columns)})",
+            })
+        return suggestions
+
+    def apply(self, engine=None, other_engines=()):
+        """Create the suggested indexes, returning the DDL that was executed.
+
+        The chatbot opens SQLite read-only, so a writable engine can be passed.
+        The other sites of a federation get the same indexes. Indexes that
+        already exist on a database, for example created by another session
+        or on an earlier run, are skipped.
+        """
+        engine = engine or self.engine
+        suggestions = self.suggestions()
+        created = []
+        for target in [engine, *other_engines]:
+            inspector = inspect(target)
+            with target.begin() as connection:
+                for suggestion in suggestions:
+                    existing = {index["name"] for index in inspector.get_indexes(suggestion["table"])}
+                    if suggestion["name"] in existing:
+                        continue
+                    connection.execute(text(suggestion["ddl"]))
+                    if suggestion["ddl"] not in created:
+                        created.append(suggestion["ddl"])
+        # Refresh the known indexes so applied suggestions disappear
+        self._indexed = None
+        return created
+
+    def _aliases(self, sql):
+        aliases = {}
+        for match in TABLE_REF.finditer(_strip_literals(sql)):
+            table = (match.group(1) or match.group(3)).lower()
+            alias = match.group(2) or match.group(4)
+            aliases[table] = table
+            if alias:
+                aliases[alias.lower()] = table
+        return aliases
+
+    def _table_columns(self):
+        if self._columns is None:
+            inspector = inspect(self.engine)
+            self._columns = {
+                table.lower(): {column["name"].lower() for column in inspector.get_columns(table)}
+                for table in inspector.get_table_names()
+            }
+        return self._columns
+
+    def _indexed_prefixes(self):
+        """Leading column tuples already covered by an index or primary key"""
+        if self._indexed is None:
+            inspector = inspect(self.engine)
+            indexed = {}
+            for table in inspector.get_table_names():
+                prefixes = indexed.setdefault(table.lower(), set())
+                keys = [index["column_names"] for index in inspector.get_indexes(table)]
+                keys.append(inspector.get_pk_constraint(table).get("constrained_columns") or [])
+                for columns in keys:
+                    columns = tuple(column.lower() for column in columns if column)
+                    for length in range(1, len(columns) + 1):
+                        prefixes.add(columns[:length])
+            self._indexed = indexed
+        return self._indexed
+
+    def _candidates_for(self, sql, scans):
+        """(table, columns) index candidates for the scanned tables"""
+        if not scans:
+            return []
+        sql = _strip_literals(sql)
+        aliases = self._aliases(sql)
+        table_columns = self._table_columns()
+
+        def resolve(qualifier, column):
+            column = column.lower()
+            if qualifier:
+                tables = [aliases.get(qualifier.lower())]
+            else:
+                tables = [t for t in set(aliases.values()) if column in table_columns.get(t, ())]
+            return [(t, column) for t in tables if t and column in table_columns.get(t, ())]
+
+        def predicate_columns(pattern, exclude=()):
+            found = {}
+            for match in pattern.finditer(sql):
+                for table, column in resolve(match.group(1), match.group(2)):
+                    columns = found.setdefault(table, [])
+                    if column not in columns and (table, column) not in exclude:
+                        columns.append(column)
+            return found
+
+        joins = set()
+        for match in JOIN_PREDICATE.finditer(sql):
+            joins.update(resolve(match.group(1), match.group(2)))
+            joins.update(resolve(match.group(3), match.group(4)))
+        equality = predicate_columns(EQUALITY_PREDICATE, exclude=joins)
+        ranges = predicate_columns(RANGE_PREDICATE)
+        indexed = self._indexed_prefixes()
+
+        candidates = []
+        for table in dict.fromkeys(scans):
+            # A column that already leads an index evidently did not avoid the scan
+            unindexed = lambda columns: [c for c in columns if (c,) not in indexed.get(table, set())]
+            columns = unindexed(equality.get(table, []))[:2]
+            columns += [c for c in unindexed(ranges.get(table, [])) if c not in columns][:1]
+            if not columns:
+                # Without a filter, index the join key so the table can be probed instead
+                columns = unindexed(sorted(c for t, c in joins if t == table))[:1]
+            if columns:
+                candidates.append((table, tuple(columns)))
+        return candidates
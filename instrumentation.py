@@ -0,0 +1,235 @@
+import os
+import json
+import math
+import time
+import uuid
+import logging
+import tempfile
+import threading
+from collections import defaultdict, deque
+from contextlib import contextmanager
+from langchain.callbacks.base import BaseCallbackHandler
+
+logger = logging.getLogger(__name__)
+
+def percentile(values, fraction):
+    """Nearest-rank percentile of a list of numbers"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = max(0, math.ceil(fraction * len(ordered)) - 1)
+    return ordered[index]
+
+def _estimate_tokens(text):
+    # Roughly four characters per token for English text and SQL
+    return max(1, len(text) // 4) if text else 0
+
+class TraceCollector:
+    """Process-wide sink for spans from every session.
+
+    Spans are buffered as they finish and appended to a JSONL trace file,
+    kept open, at the end of every turn together with the Prometheus
+    textfile of lifetime counters. A window of recent spans is kept for
+    percentiles.
+    """
+
+    def __init__(self, trace_dir="traces", window=2000):
+        os.makedirs(trace_dir, exist_ok=True)
+        self.trace_path = os.path.join(trace_dir, "medichat_traces.jsonl")
+        self.prometheus_path = os.path.join(trace_dir, "medichat.prom")
+        self.spans = deque(maxlen=window)
+        self._totals = defaultdict(lambda: [0, 0.0])
+        self._tokens = defaultdict(int)
+        self._pending = []
+        self._trace_file = None
+        self._lock = threading.Lock()
+        # File writes happen outside _lock so recording a span never waits for the disk
+        self._write_lock = threading.Lock()
+
+    def record(self, span):
+        with self._lock:
+            self.spans.append(span)
+            totals = self._totals[(span["kind"], span["name"], span.get("model", ""))]
+            totals[0] += 1
+            totals[1] += span["duration_ms"] / 1000
+            for kind in ("prompt_tokens", "completion_tokens"):
+                if span.get(kind):
+                    self._tokens[(span.get("model", ""), kind)] += span[kind]
+            self._pending.append(span)
+
+    def flush(self):
+        """Append the spans recorded since the last flush to the trace file"""
+        with self._lock:
+            pending, self._pending = self._pending, []
+        if not pending:
+            return
+        lines = "".join(json.dumps(span, default=str) + "\n" for span in pending)
+        with self._write_lock:
+            if self._trace_file is None:
+                self._trace_file = open(self.trace_path, "a")
+            self._trace_file.write(lines)
+            self._trace_file.flush()
+
+    def close(self):
+        self.flush()
+        with self._write_lock:
+            if self._trace_file is not None:
+                self._trace_file.close()
+                self._trace_file = None
+
+    def latency_summary(self):
+        """p50/p95 latency in ms per (kind, name, model) over the recent window"""
+        groups = defaultdict(list)
+        with self._lock:
+            for span in self.spans:
+                groups[(span["kind"], span["name"], span.get("model", ""))].append(span["duration_ms"])
+        return [
+            {
+                "kind": kind,
+                "name": name,
+                "model": model,
+                "count": len(durations),
+                "p50_ms": percentile(durations, 0.5),
+                "p95_ms": percentile(durations, 0.95),
+            }
+            for (kind, name, model), durations in sorted(groups.items())
+        ]
+
+    def write_prometheus(self):
+        """Write metrics in the node_exporter textfile collector format"""
+        lines = [
+            "# HELP medichat_span_latency_seconds Latency of MediChat turns, LLM calls, tool calls and rendering.",
+            "# TYPE medichat_span_latency_seconds summary",
+        ]
+        with self._lock:
+            totals = dict(self._totals)
+            tokens = dict(self._tokens)
+        summary = {(s["kind"], s["name"], s["model"]): s for s in self.latency_summary()}
+        for (kind, name, model), (count, seconds) in sorted(totals.items()):
+            labels = f'kind="{kind}",name="{name}",model="{model}"'
+            recent = summary.get((kind, name, model))
+            if recent:
+                for quantile, key in (("0.5", "p50_ms"), ("0.95", "p95_ms")):
+                    lines.append(f'medichat_span_latency_seconds{{{labels},quantile="{quantile}"}} {recent[key] / 1000:.6f}')
+            lines.append(f"medichat_span_latency_seconds_sum{{{labels}}} {seconds:.6f}")
+            lines.append(f"medichat_span_latency_seconds_count{{{labels}}} {count}")
+        lines += [
+            "# HELP medichat_llm_tokens_total Prompt and completion tokens sent to and received from the LLM.",
+            "# TYPE medichat_llm_tokens_total counter",
+        ]
+        for (model, kind), count in sorted(tokens.items()):
+            lines.append(f'medichat_llm_tokens_total{{model="{model}",type="{kind.replace("_tokens", "")}"}} {count}')
+        body = "\n".join(lines) + "\n"
+        with self._write_lock:
+            # A temp file of its own in the same directory, then an atomic
+            # replace, so the collector never reads a partial file
+            fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(self.prometheus_path) or ".", suffix=".tmp")
+            try:
+                with os.fdopen(fd, "w") as prometheus_file:
+                    prometheus_file.write(body)
+                # mkstemp creates the file private; node_exporter may run as another user
+                os.chmod(temp_path, 0o644)
+                os.replace(temp_path, self.prometheus_path)
+            except BaseException:
+                if os.path.exists(temp_path):
+                    os.remove(temp_path)
+                raise
+
+class TurnTracer(BaseCallbackHandler):
+    """Records the spans of one chat turn: LLM calls, tool calls, SQL and rendering"""
+
+    def __init__(self, collector, model, session_id=None):
+        self.collector = collector
+        self.model = model
+        self.session_id = session_id
+        self.turn_id = uuid.uuid4().hex[:12]
+        self.spans = []
+        self._started = time.perf_counter()
+        self._open = {}
+        self._query_result = None
+
+    def _finish(self, kind, name, started, **attributes):
+        span = {
+            "turn_id": self.turn_id,
+            "session_id": self.session_id,
+            "kind": kind,
+            "name": name,
+            "model": self.model,
+            "timestamp": time.time(),
+            "duration_ms": (time.perf_counter() - started) * 1000,
+        }
+        span.update(attributes)
+        self.spans.append(span)
+        self.collector.record(span)
+        return span
+
+    @contextmanager
+    def span(self, name, kind="app", **attributes):
+        """Time a block of application code, e.g. rendering"""
+        started = time.perf_counter()
+        try:
+            yield attributes
+        finally:
+            self._finish(kind, name, started, **attributes)
+
+    def on_llm_start(self, serialized, prompts, *, run_id, **kwargs):
+        self._open[run_id] = (time.perf_counter(), sum(_estimate_tokens(p) for p in prompts))
+
+    def on_chat_model_start(self, serialized, messages, *, run_id, **kwargs):
+        text = "".join(str(m.content) for batch in messages for m in batch)
+        self._open[run_id] = (time.perf_counter(), _estimate_tokens(text))
+
+    def on_llm_end(self, response, *, run_id, **kwargs):
+        started, estimated_prompt = self._open.pop(run_id, (self._started, 0))
+        usage = (response.llm_output or {}).get("token_usage") or {}
+        completion = "".join(g.text for batch in response.generations for g in batch)
+        self._finish(
+            "llm", "llm_call", started,
+            prompt_tokens=usage.get("prompt_tokens", estimated_prompt),
+            completion_tokens=usage.get("completion_tokens", _estimate_tokens(completion)),
+            tokens_estimated=not usage,
+        )
+
+    def on_llm_error(self, error, *, run_id, **kwargs):
+        started, _ = self._open.pop(run_id, (self._started, 0))
+        self._finish("llm", "llm_call", started, error=str(error))
+
+    def on_tool_start(self, serialized, input_str, *, run_id, **kwargs):
+        self._open[run_id] = (time.perf_counter(), serialized.get("name"), input_str)
+
+    def on_query_result(self, result):
+        # Called by RecordingQueryTool inside the tool run, before on_tool_end
+        self._query_result = result
+
+    def on_tool_end(self, output, *, run_id, **kwargs):
+        started, name, tool_input = self._open.pop(run_id, (self._started, "tool", ""))
+        attributes = {"input": tool_input}
+        if self._query_result is not None:
+            attributes.update(
+                sql_ms=self._query_result.elapsed * 1000,
+                rows=self._query_result.total_rows,
+            )
+            self._query_result = None
+        self._finish("tool", name, started, **attributes)
+
+    def on_tool_error(self, error, *, run_id, **kwargs):
+        started, name, tool_input = self._open.pop(run_id, (self._started, "tool", ""))
+        self._finish("tool", name, started, input=tool_input, error=str(error))
+
+    def finish(self, path, **attributes):
+        """Close the turn span (path is cache, fast_path or agent) and export metrics"""
+        self._finish("turn", path, self._started, **attributes)
+        # Exporting is best effort; a full disk must not fail the chat turn
+        try:
+            self.collector.flush()
+            self.collector.write_prometheus()
+        except OSError:
+            logger.exception("Could not export traces")
+
+    def breakdown(self):
+        """Milliseconds spent per span kind in this turn"""
+        totals = defaultdict(float)
+        for span in self.spans:
+            if span["kind"] != "turn":
+                totals[span["kind"] if span["kind"] != "app" else span["name"]] += span["duration_ms"]
+        return dict(totals)
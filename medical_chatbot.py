@@ -1,16 +1,24 @@
+import time
+_rerun_started = time.perf_counter()
+
 import streamlit as st
-from pathlib import Path
-from langchain.agents import create_sql_agent
-from langchain.sql_database import SQLDatabase
-from langchain.agents.agent_types import AgentType
-from langchain.callbacks import StreamlitCallbackHandler
-from langchain.agents.agent_toolkits import SQLDatabaseToolkit
-from sqlalchemy import create_engine
-import sqlite3
 import os
-from langchain_groq import ChatGroq
-import plotly.express as px
-import pandas as pd
+import hashlib
+from answer_cache import AnswerCache, data_version, database_identity, schema_hash
+import fast_path
+
+# LangChain, Groq, pandas and plotly are imported where they are used, so the
+# first page renders before they load and reruns never touch them
+
+# Wall-clock time of each phase of this script run, shown in the sidebar
+rerun_timings = {}
+_phase_started = _rerun_started
+
+def mark_phase(name):
+    global _phase_started
+    now = time.perf_counter()
+    rerun_timings[name] = (now - _phase_started) * 1000
+    _phase_started = now
 
 # Initialize medical database if needed
 def initialize_database_if_needed():
@@ -19,6 +27,14 @@ def initialize_database_if_needed():
         import medical_database
         medical_database.initialize_medical_database()
         st.sidebar.success("Database initialized!")
+    else:
+        upgrade_database()
+
+# Add indexes and other schema additions to existing databases once per server
+@st.cache_resource
+def upgrade_database():
+    import medical_database
+    medical_database.upgrade_medical_database()
 
 # Page configuration
 st.set_page_config(
@@ -40,20 +56,46 @@ This intelligent assistant can help you query and analyze medical records,
 patient information, prescriptions, and more using natural language.
 """)
 
+# Chat history lives in a SQLite file. The URL carries a signed, expiring
+# resume token rather than the bare session id, so a refresh returns to the
+# same conversation while ids cannot be guessed or forged
+@st.cache_resource
+def get_conversation_store():
+    from conversation_store import ConversationStore
+    return ConversationStore(os.environ.get("MEDICHAT_CONVERSATIONS_DB", "conversations.db"),
+                             max_age_days=float(os.environ.get("MEDICHAT_HISTORY_DAYS", "30")),
+                             secret=os.environ.get("MEDICHAT_SESSION_SECRET"))
+
+conversation_store = get_conversation_store()
+if "session_id" not in st.session_state:
+    import secrets
+    resumed = conversation_store.resume_session(st.query_params.get("resume"))
+    st.session_state["session_id"] = resumed or secrets.token_urlsafe(32)
+    st.query_params["resume"] = conversation_store.resume_token(st.session_state["session_id"])
+session_id = st.session_state["session_id"]
+
 # Database selection options
 LOCALDB = "USE_LOCALDB"
 MYSQL = "USE_MYSQL"
-radio_opt = ["Use Medical SQLite Database", "Connect to external Medical Database"]
+FEDERATED = "USE_FEDERATION"
+radio_opt = ["Use Medical SQLite Database", "Connect to external Medical Database", "Query several clinic databases"]
 selected_opt = st.sidebar.radio(label="Database Connection", options=radio_opt)
 
 # Database connection configuration
-if radio_opt.index(selected_opt) == 1:
+if radio_opt.index(selected_opt) == 2:
+    db_uri = FEDERATED
+    with st.sidebar.expander("Clinic Databases", expanded=True):
+        federation_sites = st.text_area("One per line: name=SQLite path or SQLAlchemy URL",
+                                        value=os.environ.get("MEDICHAT_FEDERATION", ""))
+elif radio_opt.index(selected_opt) == 1:
     db_uri = MYSQL
     with st.sidebar.expander("MySQL Connection Details"):
         mysql_host = st.text_input("MySQL Host")
         mysql_user = st.text_input("MySQL User")
         mysql_password = st.text_input("MySQL Password", type="password")
         mysql_db = st.text_input("Database Name")
+        mysql_replicas = st.text_input("Read Replicas (host[:port], comma-separated)",
+                                       value=os.environ.get("MEDICHAT_MYSQL_REPLICAS", ""))
 else:
     db_uri = LOCALDB
     initialize_database_if_needed()
@@ -77,7 +119,7 @@ example_questions = [
 ]
 for q in example_questions:
     if st.sidebar.button(q, key=q):
-        st.session_state.messages.append({"role": "user", "content": q})
+        conversation_store.append(session_id, "user", q)
         st.experimental_rerun()
 
 # Check for required inputs
@@ -87,53 +129,283 @@ if not api_key:
     st.info("Please enter your Groq API key to continue")
     st.stop()
 
-# Initialize LLM
-llm = ChatGroq(groq_api_key=api_key, model_name=selected_model, streaming=True)
+mark_phase("setup")
 
-# Database configuration function
+# Clinic databases with the same schema; every agent query runs on all of them
+# in parallel and the results are merged
 @st.cache_resource(ttl="2h")
-def configure_db(db_uri, mysql_host=None, mysql_user=None, mysql_password=None, mysql_db=None):
-    if db_uri == LOCALDB:
-        dbfilepath = Path("medical.db").absolute()
-        creator = lambda: sqlite3.connect(f"file:{dbfilepath}?mode=ro", uri=True)
-        return SQLDatabase(create_engine("sqlite:///", creator=creator))
+def get_federation(federation_sites):
+    from federation import Federation, parse_sites, site_engines
+    sites = parse_sites(federation_sites)
+    if not sites:
+        st.error("Please list at least one clinic database.")
+        st.stop()
+    return Federation(site_engines(sites))
+
+# Database configuration function: pooled engines from db_connection, with
+# agent and dashboard reads going to the replicas when there are any
+@st.cache_resource(ttl="2h")
+def configure_db(db_uri, mysql_host=None, mysql_user=None, mysql_password=None, mysql_db=None, mysql_replicas="",
+                 federation_sites=None):
+    from langchain.sql_database import SQLDatabase
+    from db_connection import mysql_engines, parse_hosts, sqlite_engine
+    from sql_tools import internal_tables
+    if db_uri == FEDERATED:
+        # The first site stands in for all of them for the schema
+        engine = primary_engine = get_federation(federation_sites).first_engine
+    elif db_uri == LOCALDB:
+        engine = primary_engine = sqlite_engine("medical.db")
     elif db_uri == MYSQL:
         if not (mysql_host and mysql_user and mysql_password and mysql_db):
             st.error("Please provide all MySQL connection details.")
             st.stop()
-        return SQLDatabase(create_engine(f"mysql+mysqlconnector://{mysql_user}:{mysql_password}@{mysql_host}/{mysql_db}"))
+        primary_engine, engine = mysql_engines(mysql_host, mysql_user, mysql_password, mysql_db,
+                                               replicas=parse_hosts(mysql_replicas))
+    return SQLDatabase(engine, ignore_tables=internal_tables(engine)), primary_engine
 
 # Create database connection
+federation = None
 if db_uri == MYSQL:
-    db = configure_db(db_uri, mysql_host, mysql_user, mysql_password, mysql_db)
+    db, primary_engine = configure_db(db_uri, mysql_host, mysql_user, mysql_password, mysql_db, mysql_replicas)
+elif db_uri == FEDERATED:
+    federation = get_federation(federation_sites)
+    db, primary_engine = configure_db(db_uri, federation_sites=federation_sites)
 else:
-    db = configure_db(db_uri)
-
-# Create SQL agent
-toolkit = SQLDatabaseToolkit(db=db, llm=llm)
-agent = create_sql_agent(
-    llm=llm,
-    toolkit=toolkit,
-    verbose=True,
-    agent_type=AgentType.ZERO_SHOT_REACT_DESCRIPTION
-)
+    db, primary_engine = configure_db(db_uri)
+
+# SQLDatabase keeps its SQLAlchemy engine private
+db_engine = db._engine
+if db_uri == MYSQL:
+    db_key = f"{db_uri}:{mysql_host}/{mysql_db}"
+    db_identity = database_identity(f"mysql://{mysql_host}/{mysql_db}")
+elif db_uri == FEDERATED:
+    from federation import parse_sites
+    db_key = f"{db_uri}:{federation_sites}"
+    db_identity = "|".join(f"{site}={database_identity(target)}" for site, target in parse_sites(federation_sites).items())
+else:
+    db_key = db_uri
+    db_identity = database_identity("medical.db")
+
+# Compact schema (types, keys, indexes, common values) built once per database.
+# The query guard reads its row counts; the agent only gets the part relevant
+# to each question with the question if MEDICHAT_SCHEMA_CATALOG is set
+@st.cache_resource(ttl="2h")
+def get_schema_catalog(_db, db_key):
+    from schema_catalog import SchemaCatalog
+    from sql_tools import internal_tables
+    return SchemaCatalog.build(_db._engine, internal_tables(_db._engine))
+
+from schema_catalog import catalog_prompt_enabled
+schema_catalog = get_schema_catalog(db, db_key)
+prompt_catalog = schema_catalog if catalog_prompt_enabled() else None
+
+# SQLite keeps dashboard_stats current with triggers. On MySQL, if
+# MEDICHAT_MYSQL_DASHBOARD_STATS allows it, a background refresher folds new
+# rows into it every minute; otherwise the dashboard queries the tables
+@st.cache_resource
+def get_dashboard_refresher(_primary_engine, db_key):
+    from dashboard_stats import DeltaRefresher
+    return DeltaRefresher(_primary_engine, interval=60).start()
+
+if db_uri == MYSQL or federation is not None:
+    from dashboard_stats import mysql_stats_enabled
+    if mysql_stats_enabled() and db_uri == MYSQL:
+        get_dashboard_refresher(primary_engine, f"{mysql_host}/{mysql_db}")
+    elif mysql_stats_enabled():
+        for site, site_engine in federation.sites.items():
+            if site_engine.dialect.name == "mysql":
+                get_dashboard_refresher(site_engine, f"{db_key}:{site}")
+
+# Index advisor shared by all sessions using the same database
+@st.cache_resource
+def get_index_advisor(_db, db_key):
+    from index_advisor import IndexAdvisor
+    return IndexAdvisor(_db._engine)
+
+index_advisor = get_index_advisor(db, db_key)
+
+# Persistent answer cache shared by all sessions
+@st.cache_resource
+def get_answer_cache():
+    return AnswerCache("answer_cache.db")
+
+@st.cache_resource(ttl="2h")
+def get_schema_hash(_db, db_key):
+    return schema_hash(_db._engine)
+
+answer_cache = get_answer_cache()
+db_schema_hash = get_schema_hash(db, db_key)
+
+# Spans from all sessions, exported to traces/ as JSONL and a Prometheus textfile
+@st.cache_resource
+def get_trace_collector():
+    from instrumentation import TraceCollector
+    return TraceCollector(os.environ.get("MEDICHAT_TRACE_DIR", "traces"))
+
+trace_collector = get_trace_collector()
+
+# Every agent query is explained first; queries that would read far too many
+# rows are sent back to the agent, the rest run under a timeout
+@st.cache_resource(ttl="2h")
+def get_query_guard(_db, db_key, catalog_version, _catalog):
+    from query_guard import QueryGuard
+    return QueryGuard(
+        _db._engine, _catalog,
+        max_examined_rows=int(os.environ.get("MEDICHAT_QUERY_MAX_ROWS", 10000000)),
+        timeout=float(os.environ.get("MEDICHAT_QUERY_TIMEOUT", 30)),
+    )
+
+query_guard = get_query_guard(db, db_key, schema_catalog.version, schema_catalog)
+
+# The LLM client, toolkit and agent are built once per model, database,
+# schema catalog and API key and shared by every rerun and session; only a
+# hash of the key is part of the cache key
+@st.cache_resource(ttl="2h")
+def get_agent(model_name, db_key, catalog_version, api_key_hash, _api_key, _db, _catalog, _guard, _federation):
+    from langchain_groq import ChatGroq
+    from sql_tools import build_agent
+    llm = ChatGroq(groq_api_key=_api_key, model_name=model_name, streaming=True)
+    return build_agent(llm, _db, catalog=_catalog, guard=_guard, federation=_federation)
+
+agent = get_agent(selected_model, db_key, prompt_catalog.version if prompt_catalog else None,
+                  hashlib.sha256(api_key.encode()).hexdigest(), api_key, db, prompt_catalog, query_guard, federation)
+
+# Agent runs execute in a shared worker pool so the page stays responsive and
+# a question can be cancelled; each session queues its own questions
+@st.cache_resource
+def get_agent_runner():
+    from agent_runner import AgentRunner
+    return AgentRunner(
+        max_workers=int(os.environ.get("MEDICHAT_AGENT_WORKERS", 4)),
+        max_queued_per_user=int(os.environ.get("MEDICHAT_AGENT_QUEUE", 3)),
+        timeout=float(os.environ.get("MEDICHAT_AGENT_TIMEOUT", 120)),
+    )
+
+agent_runner = get_agent_runner()
+mark_phase("agent")
 
 # Add options to view database schema
 if st.sidebar.checkbox("Show Database Schema"):
-    st.sidebar.code(db.get_table_info())
+    st.sidebar.code(schema_catalog.describe())
+
+# Index suggestions for repeated full-table scans in the agent's queries
+with st.sidebar.expander("Index Advisor"):
+    suggestions = index_advisor.suggestions()
+    st.caption(f"{len(index_advisor.statements)} recent agent queries analyzed")
+    if not suggestions:
+        st.write("No repeated full-table scans detected.")
+    for suggestion in suggestions:
+        st.code(suggestion["ddl"], language="sql")
+        st.caption(f"{suggestion['full_scans']} full scans of {suggestion['table']}")
+    if suggestions and st.button("Create suggested indexes"):
+        # SQLite databases are opened read-only for the agent, so they get a
+        # writable engine for this that is disposed afterwards
+        from db_connection import sqlite_engine
+        opened = []
+        try:
+            if db_uri == LOCALDB:
+                opened = [sqlite_engine("medical.db", read_only=False)]
+                writable_engines = opened
+            elif federation is not None:
+                from federation import parse_sites
+                writable_engines = []
+                for site, target in parse_sites(federation_sites).items():
+                    if "://" in target:
+                        writable_engines.append(federation.sites[site])
+                    else:
+                        opened.append(sqlite_engine(target, read_only=False))
+                        writable_engines.append(opened[-1])
+            else:
+                writable_engines = [primary_engine]
+            created = index_advisor.apply(writable_engines[0], writable_engines[1:])
+            st.success(f"Created {len(created)} index(es)" + (f" on {len(writable_engines)} sites" if federation else ""))
+        except Exception as e:
+            st.error(f"Could not create indexes: {e}")
+        finally:
+            for writable_engine in opened:
+                writable_engine.dispose()
 
-# Display database overview in dashboard
-if "messages" not in st.session_state:
+# Answer cache statistics
+with st.sidebar.expander("Answer Cache"):
+    cache_stats = answer_cache.stats()
+    col1, col2 = st.columns(2)
+    col1.metric("Hits", cache_stats["hits"])
+    col2.metric("Misses", cache_stats["misses"])
+    st.caption(f"{cache_stats['entries']} cached answers, {cache_stats['hit_rate']:.0%} hit rate")
+    if st.button("Clear answer cache"):
+        answer_cache.clear()
+        st.experimental_rerun()
+
+# Latency percentiles per model and the breakdown of the last turn
+with st.sidebar.expander("Performance"):
+    latency = [row for row in trace_collector.latency_summary() if row["kind"] in ("turn", "llm", "tool")]
+    if latency:
+        import pandas as pd
+        st.dataframe(pd.DataFrame(latency).round({"p50_ms": 1, "p95_ms": 1}), hide_index=True, use_container_width=True)
+    else:
+        st.write("No questions answered yet.")
+    runner_stats = agent_runner.stats()
+    st.caption(
+        f"Agent workers: {runner_stats['running']}/{runner_stats['workers']} busy, {runner_stats['queued']} queued; "
+        f"{runner_stats['cancelled']} cancelled, {runner_stats['timeout']} timed out"
+    )
+    from db_connection import pool_stats
+    if federation is not None:
+        engines = {f"{site} pool": site_engine for site, site_engine in federation.sites.items()}
+    elif primary_engine is db_engine:
+        engines = {"Connection pool": db_engine}
+    else:
+        engines = {"Replica pool": db_engine, "Primary pool": primary_engine}
+    for label, engine in engines.items():
+        pool = pool_stats(engine)
+        if pool:
+            st.caption(
+                f"{label}: {pool['checked_out']}/{pool['capacity']} connections in use "
+                f"(pool of {pool['size']}, {pool['idle']} idle, {pool['overflow']} overflow)"
+            )
+    guard_counts = query_guard.stats()
+    st.caption(
+        f"Agent queries: {guard_counts['admitted']} run ({guard_counts['rewritten']} limited), "
+        f"{guard_counts['rejected']} rejected as too expensive, {guard_counts['timed_out']} timed out"
+    )
+    if st.session_state.get("last_turn_breakdown"):
+        st.caption("Last turn (ms): " + ", ".join(f"{kind} {ms:.0f}" for kind, ms in st.session_state["last_turn_breakdown"].items()))
+
+# Display database overview in dashboard, once per browser session
+if "greeting" not in st.session_state:
     # Create initial dashboard
     st.subheader("Database Overview")
+    import pandas as pd
+    import plotly.express as px
     col1, col2, col3 = st.columns(3)
     
+    def read_sql(sql):
+        # Federated figures are merged from every site
+        if federation is None:
+            return pd.read_sql(sql, db_engine)
+        result = federation.execute(sql)
+        return pd.DataFrame.from_records(result.rows, columns=result.columns)
+
     try:
-        # Count statistics
-        patient_count = pd.read_sql("SELECT COUNT(*) as count FROM patients", db.engine).iloc[0]['count']
-        record_count = pd.read_sql("SELECT COUNT(*) as count FROM medical_records", db.engine).iloc[0]['count']
-        prescription_count = pd.read_sql("SELECT COUNT(*) as count FROM prescriptions", db.engine).iloc[0]['count']
-        
+        # Read the materialized counters; fall back to live queries if they are missing
+        from dashboard_stats import combine_dashboard_stats, read_dashboard_stats
+        if federation is not None:
+            stats = combine_dashboard_stats(federation.map(read_dashboard_stats).values())
+        else:
+            stats = read_dashboard_stats(db_engine)
+        if stats:
+            patient_count = stats["patients"].get("all", 0)
+            record_count = stats.get("medical_records", {}).get("all", 0)
+            prescription_count = stats.get("prescriptions", {}).get("all", 0)
+            gender_data = pd.DataFrame(stats.get("gender", {}).items(), columns=["gender", "count"])
+            blood_data = pd.DataFrame(sorted(stats.get("blood_type", {}).items()), columns=["blood_type", "count"])
+        else:
+            patient_count = read_sql("SELECT COUNT(*) as count FROM patients").iloc[0]['count']
+            record_count = read_sql("SELECT COUNT(*) as count FROM medical_records").iloc[0]['count']
+            prescription_count = read_sql("SELECT COUNT(*) as count FROM prescriptions").iloc[0]['count']
+            gender_data = read_sql("SELECT gender, COUNT(*) as count FROM patients GROUP BY gender")
+            blood_data = read_sql("SELECT blood_type, COUNT(*) as count FROM patients GROUP BY blood_type")
+
         col1.metric("Total Patients", patient_count)
         col2.metric("Medical Records", record_count)
         col3.metric("Prescriptions", prescription_count)
@@ -143,74 +415,271 @@ if "messages" not in st.session_state:
             col1, col2 = st.columns(2)
             
             # Gender distribution
-            gender_data = pd.read_sql("SELECT gender, COUNT(*) as count FROM patients GROUP BY gender", db.engine)
             fig1 = px.pie(gender_data, values='count', names='gender', title='Gender Distribution')
             col1.plotly_chart(fig1, use_container_width=True)
             
             # Blood type distribution
-            blood_data = pd.read_sql("SELECT blood_type, COUNT(*) as count FROM patients GROUP BY blood_type", db.engine)
             fig2 = px.bar(blood_data, x='blood_type', y='count', title='Blood Type Distribution')
             col2.plotly_chart(fig2, use_container_width=True)
+
+        # Clinical activity is only shown when it can be read from the counters
+        if stats and (stats.get("diagnosis") or stats.get("prescriptions_by_month")):
+            with st.expander("Clinical Activity"):
+                col1, col2 = st.columns(2)
+                diagnosis_data = pd.DataFrame(
+                    sorted(stats.get("diagnosis", {}).items(), key=lambda item: -item[1])[:10],
+                    columns=["diagnosis", "count"]
+                )
+                fig3 = px.bar(diagnosis_data, x='count', y='diagnosis', orientation='h', title='Top Diagnoses')
+                col1.plotly_chart(fig3, use_container_width=True)
+                monthly_data = pd.DataFrame(sorted(stats.get("prescriptions_by_month", {}).items()), columns=["month", "count"])
+                fig4 = px.line(monthly_data, x='month', y='count', title='Prescriptions per Month')
+                col2.plotly_chart(fig4, use_container_width=True)
         
-        # Initialize chat messages
-        st.session_state["messages"] = [{"role": "assistant", "content": "Hello! I'm your Medical Database Assistant. How can I help you analyze the medical records today?"}]
     except Exception as e:
         st.error(f"Error loading dashboard: {e}")
-        st.session_state["messages"] = [{"role": "assistant", "content": "Hello! I'm your Medical Database Assistant. How can I help you analyze the medical records today?"}]
+    st.session_state["greeting"] = "Hello! I'm your Medical Database Assistant. How can I help you analyze the medical records today?"
+
+mark_phase("dashboard")
+
+# Messages rendered per rerun, and added by each "Load older messages"
+HISTORY_WINDOW = 20
 
 # Clear chat button
 if st.sidebar.button("Clear Chat History"):
-    st.session_state["messages"] = [{"role": "assistant", "content": "Chat history cleared. How can I help you analyze the medical records today?"}]
+    conversation_store.clear(session_id)
+    st.session_state["greeting"] = "Chat history cleared. How can I help you analyze the medical records today?"
+    st.session_state["history_window"] = HISTORY_WINDOW
+    st.session_state["last_query_result"] = None
+    for job in st.session_state.get("pending_jobs", []):
+        agent_runner.cancel(job)
+    st.session_state["pending_jobs"] = []
     st.experimental_rerun()
 
-# Display chat history
-for msg in st.session_state.messages:
+# Display the latest messages; older ones are read from the store on request
+window = st.session_state.setdefault("history_window", HISTORY_WINDOW)
+history = conversation_store.recent(session_id, window + 1)
+if len(history) > window:
+    if st.button("Load older messages"):
+        st.session_state["history_window"] = window + HISTORY_WINDOW
+        st.experimental_rerun()
+    history = history[1:]
+else:
+    st.chat_message("assistant").write(st.session_state["greeting"])
+for msg in history:
     st.chat_message(msg["role"]).write(msg["content"])
 
 # User input
 user_query = st.chat_input(placeholder="Ask anything about the medical database (e.g., 'Show me all patients with hypertension')")
 
+# Chart small category/value results and keep the result for the browser below the chat
+def display_query_result(query_result):
+    st.session_state["last_query_result"] = query_result
+    st.session_state.pop("result_page", None)
+    if query_result.truncated:
+        st.caption(f"Query returned {query_result.total_rows:,}{'' if query_result.complete else '+'} rows; browse them below.")
+        return
+    try:
+        import plotly.express as px
+        result_df = query_result.dataframe
+        if result_df.shape[1] == 2 and result_df.shape[0] < 15:
+            # For 2-column results that look like category-value pairs
+            if result_df.dtypes.iloc[1] in ['int64', 'float64']:
+                cols = result_df.columns
+                fig = px.bar(result_df, x=cols[0], y=cols[1],
+                             title=f"Visualization of {cols[0]} vs {cols[1]}")
+                st.plotly_chart(fig, use_container_width=True)
+    except Exception:
+        # Silently fail visualization attempts - they're just enhancements
+        pass
+
+st.session_state.setdefault("pending_jobs", [])
+
+def submit_agent_turn(question, tracer, data_stamp, conversation=""):
+    """Queue an agent run; its progress and answer are rendered by show_pending_job"""
+    import threading
+    from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
+    from agent_runner import ProgressRelay
+    from schema_catalog import compose_agent_input
+    from sql_tools import QueryRecorder
+    query_recorder = QueryRecorder()
+    relay = ProgressRelay()
+    script_context = get_script_run_ctx()
+
+    def run_agent(canceller):
+        # The worker writes progress into this session's page
+        add_script_run_ctx(threading.current_thread(), script_context)
+        try:
+            return agent.run(compose_agent_input(question, prompt_catalog, conversation),
+                             callbacks=[relay, index_advisor, query_recorder, tracer, canceller])
+        finally:
+            add_script_run_ctx(threading.current_thread(), None)
+
+    job = agent_runner.submit(session_id, run_agent)
+    job.context.update(question=question, tracer=tracer, recorder=query_recorder, relay=relay,
+                       data_stamp=data_stamp, cacheable=not conversation, claim=threading.Lock())
+    st.session_state["pending_jobs"].append(job)
+
+def finish_agent_turn(job):
+    """Record the outcome of a finished agent run in the chat history, once.
+
+    A run interrupted by a rerun may race the next run to this point, so
+    recording is guarded by the job's lock. All state is updated before
+    anything is written to the page, since any write can be interrupted.
+    """
+    with job.context["claim"]:
+        if "response" in job.context:
+            return
+        query_result = None
+        if job.status == "done":
+            response = job.result
+            # Reuse the rows the agent already fetched instead of re-running its SQL
+            query_result = job.context["recorder"].last_result
+        elif job.status == "cancelled":
+            response = "Question cancelled."
+        elif job.status == "timeout":
+            response = f"Sorry, this question took longer than {job.timeout:g} seconds and was stopped. Try a narrower question."
+        else:
+            response = f"Sorry, I encountered an error: {str(job.error)}"
+        job.context.update(response=response, query_result=query_result)
+        conversation_store.append(session_id, "assistant", response)
+        if job in st.session_state["pending_jobs"]:
+            st.session_state["pending_jobs"].remove(job)
+    tracer = job.context["tracer"]
+    tracer.finish("agent" if job.status == "done" else job.status,
+                  wait_ms=((job.started or job.finished) - job.submitted) * 1000)
+    st.session_state["last_turn_breakdown"] = tracer.breakdown()
+    # Answers that build on earlier turns only make sense in this conversation
+    if job.status == "done" and job.context["cacheable"]:
+        answer_cache.put(job.context["question"], selected_model, db_identity, db_schema_hash, job.context["data_stamp"], response)
+
+def render_agent_turn(job):
+    tracer = job.context["tracer"]
+    query_result = job.context["query_result"]
+    with tracer.span("render"):
+        if query_result is not None and query_result.rows:
+            display_query_result(query_result)
+        st.write(job.context["response"])
+
+def show_pending_job(job):
+    """Stream a queued or running job's progress until it ends.
+
+    Clicking Cancel (or any other widget) starts a rerun, which interrupts
+    the wait; the next run picks the job up again here.
+    """
+    from langchain.callbacks import StreamlitCallbackHandler
+    with st.chat_message("assistant"):
+        if st.button("Cancel", key=f"cancel_{job.job_id}") and not job.done:
+            agent_runner.cancel(job)
+        status = st.empty()
+        job.context["relay"].attach(StreamlitCallbackHandler(st.container()))
+        try:
+            shown = None
+            while not job.wait(0.25):
+                position = agent_runner.position(job)
+                if job.cancel_requested.is_set():
+                    message = "Cancelling..."
+                elif job.status == "queued":
+                    message = f"Queued behind {position} earlier question(s)" if position else "Waiting for a free worker..."
+                else:
+                    message = f"Working... {job.elapsed:.0f}s"
+                if message != shown:
+                    # Each update also gives Streamlit a chance to stop this run for a rerun
+                    status.caption(message)
+                    shown = message
+        finally:
+            job.context["relay"].detach()
+        finish_agent_turn(job)
+        status.empty()
+        render_agent_turn(job)
+
 # Process user input
 if user_query:
-    st.session_state.messages.append({"role": "user", "content": user_query})
+    # Earlier turns for the agent: a rolling summary and the last few messages.
+    # Standalone questions are answered without them, so they can use the cache
+    from conversation_store import depends_on_context, format_conversation
+    conversation = ""
+    if depends_on_context(user_query):
+        conversation = format_conversation(*conversation_store.context(session_id))
+    conversation_store.append(session_id, "user", user_query)
     st.chat_message("user").write(user_query)
     
-    with st.chat_message("assistant"):
-        streamlit_callback = StreamlitCallbackHandler(st.container())
-        
+    from sql_tools import QueryResult
+    from instrumentation import TurnTracer
+    tracer = TurnTracer(trace_collector, selected_model, session_id)
+    answer_path = None
+    try:
+        # Repeat questions are answered from the cache without running the agent,
+        # unless they refer back to earlier turns
+        with tracer.span("cache_lookup"):
+            if federation is not None:
+                from federation import parse_sites
+                data_stamp = "|".join(
+                    data_version(federation.sites[site], target if "://" not in target else None)
+                    for site, target in parse_sites(federation_sites).items()
+                )
+            else:
+                data_stamp = data_version(db_engine, "medical.db" if db_uri == LOCALDB else None)
+            response = None if conversation else answer_cache.get(user_query, selected_model, db_identity, db_schema_hash, data_stamp)
+        fast_answer = None
+        # Template queries run on one database, so federated questions go to the agent
+        if response is None and federation is None:
+            with tracer.span("fast_path", kind="sql"):
+                fast_answer = fast_path.answer_question(db_engine, user_query)
+        if response is not None:
+            answer_path = "cache"
+            with st.chat_message("assistant"):
+                st.caption("⚡ Answered from cache")
+                with tracer.span("render"):
+                    st.write(response)
+        elif fast_answer is not None:
+            # Common question shapes are answered by a template query without the LLM
+            answer_path = "fast_path"
+            response = fast_answer.text
+            answer_cache.put(user_query, selected_model, db_identity, db_schema_hash, data_stamp, response)
+            with st.chat_message("assistant"):
+                st.caption("⚡ Answered directly from the database")
+                with tracer.span("render"):
+                    display_query_result(QueryResult(fast_answer.sql, fast_answer.columns, fast_answer.rows, 0))
+                    st.write(response)
+        else:
+            submit_agent_turn(user_query, tracer, data_stamp, conversation)
+        if answer_path:
+            conversation_store.append(session_id, "assistant", response)
+    except Exception as e:
+        answer_path = "error"
+        error_msg = f"Sorry, I encountered an error: {str(e)}"
+        conversation_store.append(session_id, "assistant", error_msg)
+        st.chat_message("assistant").write(error_msg)
+    if answer_path:
+        tracer.finish(answer_path)
+        st.session_state["last_turn_breakdown"] = tracer.breakdown()
+
+# Questions still being answered, including ones submitted in earlier runs
+for job in list(st.session_state["pending_jobs"]):
+    show_pending_job(job)
+
+mark_phase("chat")
+
+# Paginated view of the latest query result; pages beyond the captured rows are read lazily
+if st.session_state.get("last_query_result") is not None:
+    query_result = st.session_state["last_query_result"]
+    page_size = 100
+    with st.expander("Latest query result"):
+        st.code(query_result.sql.strip(), language="sql")
+        total = f"{query_result.total_rows:,}" if query_result.complete else f"{query_result.total_rows:,}+"
+        pages = -(-query_result.total_rows // page_size) if query_result.complete else None
+        page = st.number_input(f"Page ({total} rows)", min_value=1, max_value=pages or None, value=1, key="result_page")
         try:
-            response = agent.run(user_query, callbacks=[streamlit_callback])
-            
-            # Check if the response contains data that could be visualized
-            if "SELECT" in user_query.upper() and ("count" in user_query.lower() or "group by" in user_query.lower()):
-                try:
-                    # Extract SQL query from agent's thoughts
-                    thought_lines = streamlit_callback.thought.split('\n')
-                    sql_query = None
-                    for line in thought_lines:
-                        if "SELECT" in line.upper() and "FROM" in line.upper():
-                            sql_query = line.strip()
-                            break
-                    
-                    if sql_query:
-                        # Execute the query to get data for visualization
-                        result_df = pd.read_sql(sql_query, db.engine)
-                        
-                        # Determine appropriate visualization
-                        if result_df.shape[1] == 2 and result_df.shape[0] < 15:
-                            # For 2-column results that look like category-value pairs
-                            if result_df.dtypes.iloc[1] in ['int64', 'float64']:
-                                cols = result_df.columns
-                                fig = px.bar(result_df, x=cols[0], y=cols[1], 
-                                             title=f"Visualization of {cols[0]} vs {cols[1]}")
-                                st.plotly_chart(fig, use_container_width=True)
-                except Exception as viz_error:
-                    # Silently fail visualization attempts - they're just enhancements
-                    pass
-            
-            st.session_state.messages.append({"role": "assistant", "content": response})
-            st.write(response)
+            st.dataframe(query_result.page(page - 1, page_size), use_container_width=True)
         except Exception as e:
-            error_msg = f"Sorry, I encountered an error: {str(e)}"
-            st.session_state.messages.append({"role": "assistant", "content": error_msg})
-            st.write(error_msg)
+            st.error(f"Could not load page: {e}")
+
+# Startup/rerun timing report
+mark_phase("results")
+run_label = "Rerun" if st.session_state.get("script_runs") else "Startup"
+st.session_state["script_runs"] = st.session_state.get("script_runs", 0) + 1
+st.sidebar.caption(
+    f"{run_label}: {(time.perf_counter() - _rerun_started) * 1000:.0f} ms ("
+    + ", ".join(f"{name} {ms:.0f}" for name, ms in rerun_timings.items()) + ")"
+)
@@ -1,24 +1,16 @@
 import sqlite3
 import os
-from datetime import datetime, timedelta
+from datetime import datetime, date, timedelta
 import random
+import time
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+from db_connection import enable_wal
 
-def initialize_medical_database():
-    """Create and populate the medical database with sample data"""
-    
-    # Remove existing database if it exists
-    if os.path.exists("medical.db"):
-        os.remove("medical.db")
-    
-    # Connect to SQLite database (will create it if it doesn't exist)
-    connection = sqlite3.connect("medical.db")
-    
-    # Create a cursor object to execute SQL commands
-    cursor = connection.cursor()
-    
-    # Create patients table
-    cursor.execute("""
-    CREATE TABLE patients (
+# Schema shared by the sample database, the synthetic generator and the importer
+TABLES = [
+    """
+    CREATE TABLE IF NOT EXISTS patients (
         patient_id INTEGER PRIMARY KEY AUTOINCREMENT,
         first_name VARCHAR(50),
         last_name VARCHAR(50),
@@ -30,11 +22,9 @@ def initialize_medical_database():
         address TEXT,
         registration_date DATE
     )
-    """)
-    
-    # Create doctors table
-    cursor.execute("""
-    CREATE TABLE doctors (
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS doctors (
         doctor_id INTEGER PRIMARY KEY AUTOINCREMENT,
         first_name VARCHAR(50),
         last_name VARCHAR(50),
@@ -43,11 +33,9 @@ def initialize_medical_database():
         contact_number VARCHAR(15),
         email VARCHAR(100)
     )
-    """)
-    
-    # Create medications table
-    cursor.execute("""
-    CREATE TABLE medications (
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS medications (
         medication_id INTEGER PRIMARY KEY AUTOINCREMENT,
         name VARCHAR(100),
         manufacturer VARCHAR(100),
@@ -56,11 +44,9 @@ def initialize_medical_database():
         standard_dosage VARCHAR(50),
         side_effects TEXT
     )
-    """)
-    
-    # Create medical_records table
-    cursor.execute("""
-    CREATE TABLE medical_records (
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS medical_records (
         record_id INTEGER PRIMARY KEY AUTOINCREMENT,
         patient_id INTEGER,
         doctor_id INTEGER,
@@ -72,11 +58,9 @@ def initialize_medical_database():
         FOREIGN KEY (patient_id) REFERENCES patients (patient_id),
         FOREIGN KEY (doctor_id) REFERENCES doctors (doctor_id)
     )
-    """)
-    
-    # Create prescriptions table
-    cursor.execute("""
-    CREATE TABLE prescriptions (
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS prescriptions (
         prescription_id INTEGER PRIMARY KEY AUTOINCREMENT,
         record_id INTEGER,
         medication_id INTEGER,
@@ -88,7 +72,308 @@ def initialize_medical_database():
         FOREIGN KEY (record_id) REFERENCES medical_records (record_id),
         FOREIGN KEY (medication_id) REFERENCES medications (medication_id)
     )
-    """)
+    """,
+]
+
+# Secondary indexes for the joins and filters the agent runs: foreign keys,
+# diagnosis, visit date and patient names. (doctor_id, patient_id) and (diagnosis, patient_id)
+# also cover the "patients per doctor/diagnosis" counts without table reads.
+INDEXES = [
+    "CREATE INDEX IF NOT EXISTS idx_patients_name ON patients (last_name, first_name)",
+    "CREATE INDEX IF NOT EXISTS idx_records_patient ON medical_records (patient_id)",
+    "CREATE INDEX IF NOT EXISTS idx_records_doctor ON medical_records (doctor_id, patient_id)",
+    "CREATE INDEX IF NOT EXISTS idx_records_diagnosis ON medical_records (diagnosis, patient_id)",
+    "CREATE INDEX IF NOT EXISTS idx_records_visit_date ON medical_records (visit_date)",
+    "CREATE INDEX IF NOT EXISTS idx_prescriptions_record ON prescriptions (record_id)",
+    "CREATE INDEX IF NOT EXISTS idx_prescriptions_medication ON prescriptions (medication_id)",
+]
+
+# Dashboard metrics materialized in dashboard_stats as (metric, stat_key, value)
+# rows. Each metric counts the rows of a table grouped by a key expression in
+# which {row} stands for the table (full refresh) or NEW/OLD (triggers). Add an
+# entry here to maintain another metric; existing databases pick it up on
+# their next upgrade.
+DASHBOARD_METRICS = {
+    "patients": ("patients", "'all'"),
+    "medical_records": ("medical_records", "'all'"),
+    "prescriptions": ("prescriptions", "'all'"),
+    "gender": ("patients", "{row}.gender"),
+    "blood_type": ("patients", "{row}.blood_type"),
+    "diagnosis": ("medical_records", "{row}.diagnosis"),
+    "prescriptions_by_month": ("prescriptions", "substr({row}.start_date, 1, 7)"),
+}
+
+# Primary keys used by the MySQL delta refresher to find new rows
+TABLE_KEYS = {
+    "patients": "patient_id",
+    "doctors": "doctor_id",
+    "medications": "medication_id",
+    "medical_records": "record_id",
+    "prescriptions": "prescription_id",
+}
+
+# Long enough for free-text diagnoses; with metric it stays under MySQL's
+# 3072-byte key limit in utf8mb4
+STAT_KEY_LENGTH = 500
+
+DASHBOARD_STATS_TABLE = f"""
+    CREATE TABLE IF NOT EXISTS dashboard_stats (
+        metric VARCHAR(50) NOT NULL,
+        stat_key VARCHAR({STAT_KEY_LENGTH}) NOT NULL,
+        value INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (metric, stat_key)
+    )
+    """
+
+# Full-text indexes over the free-text columns, as index name: (table, key
+# column, indexed columns). On SQLite these are external-content FTS5 tables
+# kept in sync by triggers. The app does not change MySQL schemas; there the
+# text search tool uses FULLTEXT indexes if the DBA created them, else LIKE.
+FULLTEXT_INDEXES = {
+    "medical_records_fts": ("medical_records", "record_id", ["diagnosis", "treatment_plan", "notes"]),
+    "medications_fts": ("medications", "medication_id", ["name", "description"]),
+}
+
+# Bookkeeping and search tables that are not part of the medical data model.
+# FTS5 also creates shadow tables named after the index (medications_fts_data, ...).
+INTERNAL_TABLES = ["dashboard_stats", "import_progress"] + list(FULLTEXT_INDEXES)
+
+# Sample reference data
+MEDICATIONS = [
+    ('Lisinopril', 'Merck', 'ACE Inhibitor', 'Used to treat high blood pressure and heart failure', '10mg once daily', 'Dry cough, dizziness, headache'),
+    ('Atorvastatin', 'Pfizer', 'Statin', 'Used to lower cholesterol levels', '20mg once daily', 'Muscle pain, joint pain, digestive issues'),
+    ('Amoxicillin', 'GlaxoSmithKline', 'Antibiotic', 'Used to treat bacterial infections', '500mg every 8 hours', 'Diarrhea, rash, nausea'),
+    ('Sertraline', 'Pfizer', 'SSRI', 'Used to treat depression and anxiety disorders', '50mg once daily', 'Nausea, insomnia, dizziness'),
+    ('Prednisone', 'Novartis', 'Corticosteroid', 'Used to treat inflammation and autoimmune conditions', '20mg daily, tapering', 'Weight gain, mood changes, increased blood sugar')
+]
+
+DIAGNOSES = [
+    "Essential hypertension",
+    "Type 2 diabetes mellitus",
+    "Acute upper respiratory infection",
+    "Major depressive disorder",
+    "Generalized anxiety disorder",
+    "Acute bronchitis",
+    "Osteoarthritis",
+    "Allergic rhinitis",
+    "Gastroesophageal reflux disease",
+    "Urinary tract infection"
+]
+
+TREATMENT_PLANS = [
+    "Lifestyle modifications and medication",
+    "Diet change, exercise, and medication review",
+    "Rest, fluids, and antibiotics if bacterial",
+    "Cognitive behavioral therapy and medication",
+    "Physical therapy and anti-inflammatory medication",
+    "Proton pump inhibitor and diet modifications",
+    "Antibiotics and increased fluid intake"
+]
+
+NOTES = [
+    "Patient responded well to treatment",
+    "Symptoms improving but continue monitoring",
+    "Consider referral to specialist if no improvement",
+    "Discussed importance of medication adherence",
+    "Patient reports side effects from medication",
+    "Bloodwork ordered to monitor progress",
+    "Patient education provided on condition management"
+]
+
+DOSAGES = ["10mg", "20mg", "25mg", "50mg", "100mg", "500mg"]
+
+FREQUENCIES = ["Once daily", "Twice daily", "Three times daily", "Every 8 hours", "Every 12 hours", "As needed"]
+
+INSTRUCTIONS = [
+    "Take with food",
+    "Take on an empty stomach",
+    "Avoid alcohol",
+    "May cause drowsiness",
+    "Complete full course of medication",
+    "Take at the same time each day",
+    "Do not crush or chew tablets"
+]
+
+# Extra vocabulary for the synthetic generator
+FIRST_NAMES = ["John", "Sarah", "Michael", "Emily", "Robert", "Linda", "David", "Maria", "James", "Aisha",
+               "Wei", "Fatima", "Carlos", "Priya", "Daniel", "Olivia", "Ahmed", "Sofia", "Thomas", "Grace"]
+LAST_NAMES = ["Smith", "Johnson", "Williams", "Brown", "Jones", "Garcia", "Miller", "Davis", "Khan", "Chen",
+              "Martinez", "Lopez", "Wilson", "Anderson", "Taylor", "Thomas", "Moore", "Patel", "Nguyen", "Clark"]
+STREETS = ["Main St", "Oak Ave", "Pine Rd", "Cedar Ln", "Maple Dr", "Elm St", "Lake View", "Hill Rd"]
+CITIES = ["Anytown", "Somewhere", "Elsewhere", "Nowhere", "Anywhere", "Riverside", "Fairview", "Springfield"]
+GENDERS = ["Male", "Female"]
+BLOOD_TYPES = ["A+", "A-", "B+", "B-", "AB+", "AB-", "O+", "O-"]
+SPECIALIZATIONS = ["Cardiology", "Neurology", "Pediatrics", "Orthopedics", "Dermatology",
+                   "Endocrinology", "Psychiatry", "Pulmonology", "Gastroenterology", "Family Medicine"]
+
+# Per unit of --scale: 1,000 patients, 20,000 records and 50 doctors
+SCALE_PATIENTS = 1000
+SCALE_RECORDS = 20000
+SCALE_DOCTORS = 50
+
+# Patients per shard; shards are the unit of work for the process pool and
+# each one has its own seed so output does not depend on the worker count
+SHARD_PATIENTS = 10000
+
+BULK_LOAD_PRAGMAS = [
+    "PRAGMA journal_mode = OFF",
+    "PRAGMA synchronous = OFF",
+    "PRAGMA locking_mode = EXCLUSIVE",
+    "PRAGMA temp_store = MEMORY",
+    "PRAGMA cache_size = -262144",
+]
+
+def create_tables(cursor):
+    """Create the medical schema tables"""
+    for statement in TABLES:
+        cursor.execute(statement)
+
+def create_indexes(cursor):
+    """Create the secondary indexes of the medical schema"""
+    for statement in INDEXES:
+        cursor.execute(statement)
+
+def is_internal_table(name):
+    """True for bookkeeping tables and the shadow tables FTS5 creates for its indexes"""
+    return name in INTERNAL_TABLES or any(name.startswith(f"{index}_") for index in FULLTEXT_INDEXES)
+
+def metric_key_expression(metric, row):
+    """SQL expression for a metric's group key, with NULLs counted as 'Unknown'"""
+    table, expression = DASHBOARD_METRICS[metric]
+    return f"COALESCE({expression.format(row=row)}, 'Unknown')"
+
+def metric_refresh_queries():
+    """(metric, SELECT stat_key, value) pairs that recompute each metric from scratch"""
+    return [
+        (metric, f"SELECT {metric_key_expression(metric, table)} AS stat_key, COUNT(*) AS value "
+                 f"FROM {table} GROUP BY {metric_key_expression(metric, table)}")
+        for metric, (table, expression) in DASHBOARD_METRICS.items()
+    ]
+
+def metrics_definition_hash():
+    import hashlib
+    return hashlib.sha256(repr(sorted(DASHBOARD_METRICS.items())).encode()).hexdigest()[:16]
+
+def _stats_triggers():
+    """SQLite triggers that keep dashboard_stats current on every insert, update and delete"""
+    increment = ("INSERT INTO dashboard_stats (metric, stat_key, value) VALUES ('{metric}', {key}, 1) "
+                 "ON CONFLICT (metric, stat_key) DO UPDATE SET value = value + 1;")
+    decrement = "UPDATE dashboard_stats SET value = value - 1 WHERE metric = '{metric}' AND stat_key = {key};"
+    triggers = []
+    for table in dict.fromkeys(table for table, _ in DASHBOARD_METRICS.values()):
+        metrics = [metric for metric, (metric_table, _) in DASHBOARD_METRICS.items() if metric_table == table]
+        on_insert = [increment.format(metric=m, key=metric_key_expression(m, "NEW")) for m in metrics]
+        on_delete = [decrement.format(metric=m, key=metric_key_expression(m, "OLD")) for m in metrics]
+        grouped = [m for m in metrics if "{row}" in DASHBOARD_METRICS[m][1]]
+        on_update = [decrement.format(metric=m, key=metric_key_expression(m, "OLD")) for m in grouped]
+        on_update += [increment.format(metric=m, key=metric_key_expression(m, "NEW")) for m in grouped]
+        triggers.append((f"trg_stats_{table}_insert", f"AFTER INSERT ON {table}", on_insert))
+        triggers.append((f"trg_stats_{table}_delete", f"AFTER DELETE ON {table}", on_delete))
+        if on_update:
+            triggers.append((f"trg_stats_{table}_update", f"AFTER UPDATE ON {table}", on_update))
+    return triggers
+
+def create_dashboard_stats(cursor):
+    """Create dashboard_stats, fill it from the current data and install its triggers.
+
+    Bulk loads call this after loading, so the triggers do not slow down inserts.
+    """
+    cursor.execute(DASHBOARD_STATS_TABLE)
+    for name, _, _ in _stats_triggers():
+        cursor.execute(f"DROP TRIGGER IF EXISTS {name}")
+    cursor.execute("DELETE FROM dashboard_stats")
+    for metric, query in metric_refresh_queries():
+        cursor.execute(f"INSERT INTO dashboard_stats (metric, stat_key, value) SELECT '{metric}', stat_key, value FROM ({query})")
+    cursor.execute("INSERT INTO dashboard_stats (metric, stat_key, value) VALUES ('_definition', ?, 0)",
+                   (metrics_definition_hash(),))
+    for name, event, statements in _stats_triggers():
+        cursor.execute(f"CREATE TRIGGER {name} {event} BEGIN\n" + "\n".join(statements) + "\nEND")
+
+def _fulltext_triggers(index):
+    """(name, SQL) of the triggers that mirror a table's changes into its FTS5 index"""
+    table, key, columns = FULLTEXT_INDEXES[index]
+    names = ", ".join(columns)
+    new = ", ".join(f"NEW.{column}" for column in columns)
+    old = ", ".join(f"OLD.{column}" for column in columns)
+    add = f"INSERT INTO {index} (rowid, {names}) VALUES (NEW.{key}, {new});"
+    remove = f"INSERT INTO {index} ({index}, rowid, {names}) VALUES ('delete', OLD.{key}, {old});"
+    return [
+        (f"trg_{index}_insert", f"CREATE TRIGGER IF NOT EXISTS trg_{index}_insert AFTER INSERT ON {table} BEGIN {add} END"),
+        (f"trg_{index}_delete", f"CREATE TRIGGER IF NOT EXISTS trg_{index}_delete AFTER DELETE ON {table} BEGIN {remove} END"),
+        (f"trg_{index}_update", f"CREATE TRIGGER IF NOT EXISTS trg_{index}_update AFTER UPDATE ON {table} BEGIN {remove} {add} END"),
+    ]
+
+def create_fulltext_indexes(cursor):
+    """Create the FTS5 search tables and their sync triggers.
+
+    A new index is filled from its table in one pass, so bulk loads call
+    this after loading. Returns False if SQLite was built without FTS5.
+    """
+    for index, (table, key, columns) in FULLTEXT_INDEXES.items():
+        exists = cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (index,)).fetchone()
+        try:
+            cursor.execute(
+                f"CREATE VIRTUAL TABLE IF NOT EXISTS {index} USING fts5({', '.join(columns)}, "
+                f"content='{table}', content_rowid='{key}', tokenize='porter unicode61')"
+            )
+        except sqlite3.OperationalError:
+            return False
+        for _, statement in _fulltext_triggers(index):
+            cursor.execute(statement)
+        if not exists:
+            cursor.execute(f"INSERT INTO {index} ({index}) VALUES ('rebuild')")
+    return True
+
+def drop_derived_data(cursor):
+    """Remove the dashboard aggregates' triggers and the full-text indexes before a bulk load.
+
+    Without the per-row triggers inserts are several times faster. Dropping
+    the stored metric definition and the FTS tables makes the next
+    upgrade_medical_database rebuild both from the loaded data, even if the
+    load is interrupted before it can do so itself.
+    """
+    cursor.execute(DASHBOARD_STATS_TABLE)
+    for name, _, _ in _stats_triggers():
+        cursor.execute(f"DROP TRIGGER IF EXISTS {name}")
+    cursor.execute("DELETE FROM dashboard_stats WHERE metric = '_definition'")
+    for index in FULLTEXT_INDEXES:
+        for name, _ in _fulltext_triggers(index):
+            cursor.execute(f"DROP TRIGGER IF EXISTS {name}")
+        cursor.execute(f"DROP TABLE IF EXISTS {index}")
+
+def upgrade_medical_database(path="medical.db"):
+    """Bring a database created by an older version up to the current schema"""
+    connection = sqlite3.connect(path)
+    cursor = connection.cursor()
+    create_indexes(cursor)
+    cursor.execute(DASHBOARD_STATS_TABLE)
+    definition = cursor.execute("SELECT stat_key FROM dashboard_stats WHERE metric = '_definition'").fetchone()
+    if definition is None or definition[0] != metrics_definition_hash():
+        # New database or changed metric set: rebuild the aggregates in one transaction
+        create_dashboard_stats(cursor)
+    create_fulltext_indexes(cursor)
+    connection.commit()
+    connection.close()
+    enable_wal(path)
+
+def initialize_medical_database():
+    """Create and populate the medical database with sample data"""
+    
+    # Remove existing database if it exists
+    if os.path.exists("medical.db"):
+        os.remove("medical.db")
+    
+    # Connect to SQLite database (will create it if it doesn't exist)
+    connection = sqlite3.connect("medical.db")
+    
+    # Create a cursor object to execute SQL commands
+    cursor = connection.cursor()
+    
+    # Create the medical schema
+    create_tables(cursor)
+    create_indexes(cursor)
+    create_dashboard_stats(cursor)
+    create_fulltext_indexes(cursor)
     
     # Insert sample patient data
     patients = [
@@ -119,18 +404,11 @@ def initialize_medical_database():
     """, doctors)
     
     # Insert sample medication data
-    medications = [
-        ('Lisinopril', 'Merck', 'ACE Inhibitor', 'Used to treat high blood pressure and heart failure', '10mg once daily', 'Dry cough, dizziness, headache'),
-        ('Atorvastatin', 'Pfizer', 'Statin', 'Used to lower cholesterol levels', '20mg once daily', 'Muscle pain, joint pain, digestive issues'),
-        ('Amoxicillin', 'GlaxoSmithKline', 'Antibiotic', 'Used to treat bacterial infections', '500mg every 8 hours', 'Diarrhea, rash, nausea'),
-        ('Sertraline', 'Pfizer', 'SSRI', 'Used to treat depression and anxiety disorders', '50mg once daily', 'Nausea, insomnia, dizziness'),
-        ('Prednisone', 'Novartis', 'Corticosteroid', 'Used to treat inflammation and autoimmune conditions', '20mg daily, tapering', 'Weight gain, mood changes, increased blood sugar')
-    ]
     
     cursor.executemany("""
     INSERT INTO medications (name, manufacturer, category, description, standard_dosage, side_effects)
     VALUES (?, ?, ?, ?, ?, ?)
-    """, medications)
+    """, MEDICATIONS)
     
     # Generate sample medical records and prescriptions
     now = datetime.now()
@@ -145,42 +423,6 @@ def initialize_medical_database():
             # Random doctor
             doctor_id = random.randint(1, 5)
             
-            # Sample diagnoses
-            diagnoses = [
-                "Essential hypertension",
-                "Type 2 diabetes mellitus",
-                "Acute upper respiratory infection",
-                "Major depressive disorder",
-                "Generalized anxiety disorder",
-                "Acute bronchitis",
-                "Osteoarthritis",
-                "Allergic rhinitis",
-                "Gastroesophageal reflux disease",
-                "Urinary tract infection"
-            ]
-            
-            # Sample treatment plans
-            treatment_plans = [
-                "Lifestyle modifications and medication",
-                "Diet change, exercise, and medication review",
-                "Rest, fluids, and antibiotics if bacterial",
-                "Cognitive behavioral therapy and medication",
-                "Physical therapy and anti-inflammatory medication",
-                "Proton pump inhibitor and diet modifications",
-                "Antibiotics and increased fluid intake"
-            ]
-            
-            # Sample notes
-            notes = [
-                "Patient responded well to treatment",
-                "Symptoms improving but continue monitoring",
-                "Consider referral to specialist if no improvement",
-                "Discussed importance of medication adherence",
-                "Patient reports side effects from medication",
-                "Bloodwork ordered to monitor progress",
-                "Patient education provided on condition management"
-            ]
-            
             # Insert medical record
             cursor.execute("""
             INSERT INTO medical_records (patient_id, doctor_id, diagnosis, treatment_plan, visit_date, follow_up_date, notes)
@@ -188,11 +430,11 @@ def initialize_medical_database():
             """, (
                 patient_id,
                 doctor_id,
-                random.choice(diagnoses),
-                random.choice(treatment_plans),
+                random.choice(DIAGNOSES),
+                random.choice(TREATMENT_PLANS),
                 visit_date,
                 follow_up_date,
-                random.choice(notes)
+                random.choice(NOTES)
             ))
             
             # Get the inserted record ID
@@ -204,23 +446,6 @@ def initialize_medical_database():
                 for _ in range(random.randint(1, 3)):
                     medication_id = random.randint(1, 5)
                     
-                    # Sample dosages
-                    dosages = ["10mg", "20mg", "25mg", "50mg", "100mg", "500mg"]
-                    
-                    # Sample frequencies
-                    frequencies = ["Once daily", "Twice daily", "Three times daily", "Every 8 hours", "Every 12 hours", "As needed"]
-                    
-                    # Sample instructions
-                    instructions = [
-                        "Take with food",
-                        "Take on an empty stomach",
-                        "Avoid alcohol",
-                        "May cause drowsiness",
-                        "Complete full course of medication",
-                        "Take at the same time each day",
-                        "Do not crush or chew tablets"
-                    ]
-                    
                     start_date = visit_date
                     end_date = (datetime.strptime(start_date, '%Y-%m-%d') + timedelta(days=random.randint(7, 30))).strftime('%Y-%m-%d')
                     
@@ -231,11 +456,11 @@ def initialize_medical_database():
                     """, (
                         record_id,
                         medication_id,
-                        random.choice(dosages),
-                        random.choice(frequencies),
+                        random.choice(DOSAGES),
+                        random.choice(FREQUENCIES),
                         start_date,
                         end_date,
-                        random.choice(instructions)
+                        random.choice(INSTRUCTIONS)
                     ))
     
     # Commit changes and close connection
@@ -272,6 +497,313 @@ def initialize_medical_database():
         print(row)
     
     connection.close()
+    enable_wal("medical.db")
+
+# ---------------------------------------------------------------------------
+# Synthetic data generator for benchmark-sized databases
+# ---------------------------------------------------------------------------
+
+class _DateTable:
+    """ISO date strings around a fixed reference day, precomputed for speed"""
+
+    def __init__(self, as_of, days_back, days_forward):
+        start = as_of - timedelta(days=days_back)
+        self.origin = days_back
+        self.values = [(start + timedelta(days=i)).isoformat() for i in range(days_back + days_forward + 1)]
+
+    def offset(self, days):
+        """Date string for as_of + days"""
+        return self.values[self.origin + days]
+
+def _shard_rng(seed, shard):
+    return random.Random(f"{seed}:{shard}")
+
+def _doctor_rows(seed, doctor_count):
+    rng = _shard_rng(seed, "doctors")
+    for doctor_id in range(1, doctor_count + 1):
+        first = rng.choice(FIRST_NAMES)
+        last = rng.choice(LAST_NAMES)
+        yield (
+            doctor_id,
+            first,
+            last,
+            rng.choice(SPECIALIZATIONS),
+            f"MD{10000 + doctor_id}",
+            f"555-{rng.randrange(1000):03d}-{rng.randrange(10000):04d}",
+            f"dr.{last.lower()}{doctor_id}@hospital.com"
+        )
+
+def _picker(rng, values):
+    """Fast uniform choice bound to rng; random.choice/randint dominate generation time"""
+    random_ = rng.random
+    count = len(values)
+    return lambda: values[int(random_() * count)]
+
+def _patient_rows(rng, first_id, last_id, dates):
+    first_name = _picker(rng, FIRST_NAMES)
+    last_name = _picker(rng, LAST_NAMES)
+    gender = _picker(rng, GENDERS)
+    blood_type = _picker(rng, BLOOD_TYPES)
+    street = _picker(rng, STREETS)
+    city = _picker(rng, CITIES)
+    birth_day = _picker(rng, range(365, 365 * 90))
+    registration_day = _picker(rng, range(1, 365 * 5))
+    random_ = rng.random
+    for patient_id in range(first_id, last_id):
+        first = first_name()
+        last = last_name()
+        yield (
+            patient_id,
+            first,
+            last,
+            dates.offset(-birth_day()),
+            gender(),
+            blood_type(),
+            f"555-{int(random_() * 1000):03d}-{int(random_() * 10000):04d}",
+            f"{first.lower()}.{last.lower()}{patient_id}@email.com",
+            f"{int(random_() * 9999) + 1} {street()}, {city()}",
+            dates.offset(-registration_day())
+        )
+
+def _clinical_batches(rng, first_record_id, record_count, first_patient_id, last_patient_id, doctor_count, dates, batch_size):
+    """Yield (records, prescriptions) batches; prescriptions follow the sample data distribution"""
+    random_ = rng.random
+    patient_span = last_patient_id - first_patient_id
+    medication_count = len(MEDICATIONS)
+    diagnosis = _picker(rng, DIAGNOSES)
+    treatment_plan = _picker(rng, TREATMENT_PLANS)
+    note = _picker(rng, NOTES)
+    dosage = _picker(rng, DOSAGES)
+    frequency = _picker(rng, FREQUENCIES)
+    instruction = _picker(rng, INSTRUCTIONS)
+    day = dates.offset
+    records = []
+    prescriptions = []
+    for record_id in range(first_record_id, first_record_id + record_count):
+        # Random visit in the last year with a follow-up 14-90 days later
+        days_ago = int(random_() * 365) + 1
+        visit_date = day(-days_ago)
+        records.append((
+            record_id,
+            first_patient_id + int(random_() * patient_span),
+            int(random_() * doctor_count) + 1,
+            diagnosis(),
+            treatment_plan(),
+            visit_date,
+            day(-days_ago + int(random_() * 77) + 14),
+            note()
+        ))
+
+        # Maybe add prescriptions (70% chance), 1-3 medications each
+        if random_() < 0.7:
+            for _ in range(int(random_() * 3) + 1):
+                prescriptions.append((
+                    record_id,
+                    int(random_() * medication_count) + 1,
+                    dosage(),
+                    frequency(),
+                    visit_date,
+                    day(-days_ago + int(random_() * 24) + 7),
+                    instruction()
+                ))
+
+        if len(records) >= batch_size:
+            yield records, prescriptions
+            records, prescriptions = [], []
+    if records:
+        yield records, prescriptions
+
+def _batched(rows, batch_size):
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+def _shard_plan(patients, records):
+    """Split the patient and record id spaces into independent shards"""
+    shards = []
+    for index, first_patient in enumerate(range(1, patients + 1, SHARD_PATIENTS)):
+        last_patient = min(first_patient + SHARD_PATIENTS, patients + 1)
+        first_record = (first_patient - 1) * records // patients + 1
+        last_record = (last_patient - 1) * records // patients + 1
+        shards.append((index, first_patient, last_patient, first_record, last_record - first_record))
+    return shards
+
+def _load_shard(connection, seed, shard, doctor_count, as_of, batch_size):
+    """Insert one shard into an open connection, returning per-table row counts"""
+    index, first_patient, last_patient, first_record, record_count = shard
+    rng = _shard_rng(seed, index)
+    dates = _DateTable(as_of, 365 * 90, 120)
+    counts = {"patients": 0, "medical_records": 0, "prescriptions": 0}
+    cursor = connection.cursor()
+
+    for batch in _batched(_patient_rows(rng, first_patient, last_patient, dates), batch_size):
+        cursor.executemany("""
+        INSERT INTO patients (patient_id, first_name, last_name, date_of_birth, gender, blood_type, contact_number, email, address, registration_date)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        """, batch)
+        counts["patients"] += len(batch)
+
+    if record_count:
+        for records, prescriptions in _clinical_batches(rng, first_record, record_count, first_patient, last_patient,
+                                                        doctor_count, dates, batch_size):
+            cursor.executemany("""
+            INSERT INTO medical_records (record_id, patient_id, doctor_id, diagnosis, treatment_plan, visit_date, follow_up_date, notes)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+            """, records)
+            cursor.executemany("""
+            INSERT INTO prescriptions (record_id, medication_id, dosage, frequency, start_date, end_date, instructions)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+            """, prescriptions)
+            counts["medical_records"] += len(records)
+            counts["prescriptions"] += len(prescriptions)
+
+    connection.commit()
+    return counts
+
+def _open_bulk_connection(path):
+    connection = sqlite3.connect(path)
+    for pragma in BULK_LOAD_PRAGMAS:
+        connection.execute(pragma)
+    return connection
+
+def _generate_shard_file(args):
+    """Process pool worker: write one shard to its own database file"""
+    path, seed, shard, doctor_count, as_of, batch_size = args
+    if os.path.exists(path):
+        os.remove(path)
+    connection = _open_bulk_connection(path)
+    create_tables(connection.cursor())
+    counts = _load_shard(connection, seed, shard, doctor_count, as_of, batch_size)
+    connection.close()
+    return path, counts
+
+def _merge_shard(connection, path):
+    connection.execute("ATTACH DATABASE ? AS shard", (path,))
+    connection.execute("INSERT INTO patients SELECT * FROM shard.patients")
+    connection.execute("INSERT INTO medical_records SELECT * FROM shard.medical_records")
+    connection.execute("""
+    INSERT INTO prescriptions (record_id, medication_id, dosage, frequency, start_date, end_date, instructions)
+    SELECT record_id, medication_id, dosage, frequency, start_date, end_date, instructions
+    FROM shard.prescriptions ORDER BY prescription_id
+    """)
+    connection.commit()
+    connection.execute("DETACH DATABASE shard")
+
+def report_throughput(label, rows, seconds):
+    """Print one phase of a bulk load: rows, seconds and rows per second"""
+    rate = rows / seconds if seconds > 0 else float("inf")
+    print(f"{label:<16} {rows:>12,} rows in {seconds:8.2f}s ({rate:,.0f} rows/sec)")
+
+def generate_synthetic_database(path="medical.db", patients=SCALE_PATIENTS, records=SCALE_RECORDS,
+                                doctors=SCALE_DOCTORS, seed=42, workers=1, batch_size=50000,
+                                as_of=date(2024, 12, 31)):
+    """Build a large deterministic medical database for load testing.
+
+    Rows are streamed from generators into batched executemany calls with
+    bulk-load PRAGMAs, and indexes are built once all data is loaded. With
+    workers > 1 the shards are generated in a process pool and merged.
+    The same seed always produces the same database regardless of workers.
+    """
+    if os.path.exists(path):
+        os.remove(path)
+
+    started = time.perf_counter()
+    connection = _open_bulk_connection(path)
+    cursor = connection.cursor()
+    create_tables(cursor)
+
+    phase = time.perf_counter()
+    cursor.executemany("""
+    INSERT INTO medications (name, manufacturer, category, description, standard_dosage, side_effects)
+    VALUES (?, ?, ?, ?, ?, ?)
+    """, MEDICATIONS)
+    for batch in _batched(_doctor_rows(seed, doctors), batch_size):
+        cursor.executemany("""
+        INSERT INTO doctors (doctor_id, first_name, last_name, specialization, license_number, contact_number, email)
+        VALUES (?, ?, ?, ?, ?, ?, ?)
+        """, batch)
+    connection.commit()
+    report_throughput("doctors", doctors, time.perf_counter() - phase)
+
+    totals = {"patients": 0, "medical_records": 0, "prescriptions": 0}
+    shards = _shard_plan(patients, records)
+    phase = time.perf_counter()
+    if workers > 1 and len(shards) > 1:
+        jobs = [(f"{path}.shard{shard[0]}", seed, shard, doctors, as_of, batch_size) for shard in shards]
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            # map preserves shard order, so merged prescription ids are deterministic
+            for shard_path, counts in pool.map(_generate_shard_file, jobs):
+                _merge_shard(connection, shard_path)
+                os.remove(shard_path)
+                for table, count in counts.items():
+                    totals[table] += count
+    else:
+        for shard in shards:
+            counts = _load_shard(connection, seed, shard, doctors, as_of, batch_size)
+            for table, count in counts.items():
+                totals[table] += count
+    elapsed = time.perf_counter() - phase
+    for table, count in totals.items():
+        print(f"{table:<16} {count:>12,} rows")
+    report_throughput(f"{len(shards)} shards", sum(totals.values()), elapsed)
+
+    phase = time.perf_counter()
+    create_indexes(cursor)
+    cursor.execute("ANALYZE")
+    connection.commit()
+    print(f"{'indexes':<16} built in {time.perf_counter() - phase:.2f}s")
+
+    phase = time.perf_counter()
+    create_dashboard_stats(cursor)
+    connection.commit()
+    print(f"{'dashboard stats':<16} built in {time.perf_counter() - phase:.2f}s")
+
+    phase = time.perf_counter()
+    if create_fulltext_indexes(cursor):
+        connection.commit()
+        print(f"{'full-text index':<16} built in {time.perf_counter() - phase:.2f}s")
+
+    connection.close()
+    # Loaded without a journal; readers share the finished database in WAL mode
+    enable_wal(path)
+    total_rows = doctors + len(MEDICATIONS) + sum(totals.values())
+    report_throughput("total", total_rows, time.perf_counter() - started)
+    return totals
+
+def main():
+    parser = argparse.ArgumentParser(description="Create the MediChat medical database")
+    parser.add_argument("--db", default="medical.db", help="database file to create")
+    parser.add_argument("--scale", type=float, help="synthetic scale factor (1 = 1,000 patients, 20,000 records)")
+    parser.add_argument("--patients", type=int, help="number of synthetic patients")
+    parser.add_argument("--records", type=int, help="number of synthetic medical records")
+    parser.add_argument("--doctors", type=int, help="number of synthetic doctors")
+    parser.add_argument("--seed", type=int, default=42, help="random seed for the synthetic data")
+    parser.add_argument("--workers", type=int, default=1, help="processes used to generate shards")
+    parser.add_argument("--batch-size", type=int, default=50000, help="rows per executemany batch")
+    args = parser.parse_args()
+
+    if args.scale is None and args.patients is None:
+        if args.db != "medical.db":
+            parser.error("--db is only supported together with --scale or --patients")
+        initialize_medical_database()
+        return
+
+    scale = args.scale if args.scale is not None else args.patients / SCALE_PATIENTS
+    patients = args.patients or max(1, int(scale * SCALE_PATIENTS))
+    generate_synthetic_database(
+        path=args.db,
+        patients=patients,
+        records=args.records if args.records is not None else int(scale * SCALE_RECORDS),
+        doctors=args.doctors or max(5, int(scale * SCALE_DOCTORS)),
+        seed=args.seed,
+        workers=args.workers,
+        batch_size=args.batch_size
+    )
 
 if __name__ == "__main__":
-    initialize_medical_database()
+    main()
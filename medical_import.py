@@ -0,0 +1,291 @@
+import os
+import csv
+import sys
+import json
+import time
+import sqlite3
+import argparse
+from datetime import date, datetime
+from medical_database import TABLE_KEYS, create_tables, drop_derived_data, upgrade_medical_database, report_throughput
+
+# Parents before children, so foreign keys can be checked against loaded rows
+IMPORT_ORDER = ["patients", "doctors", "medications", "medical_records", "prescriptions"]
+
+FORMATS = {".csv": "csv", ".jsonl": "jsonl", ".ndjson": "jsonl", ".parquet": "parquet"}
+
+IMPORT_PROGRESS_TABLE = """
+CREATE TABLE IF NOT EXISTS import_progress (
+    source TEXT PRIMARY KEY,
+    target_table TEXT,
+    fingerprint TEXT,
+    rows_done INTEGER,
+    inserted INTEGER,
+    skipped INTEGER,
+    rejected INTEGER,
+    status TEXT,
+    updated_at REAL
+)
+"""
+
+# Writes stay durable, so a committed checkpoint always matches the loaded rows
+IMPORT_PRAGMAS = [
+    "PRAGMA journal_mode = WAL",
+    "PRAGMA synchronous = NORMAL",
+    "PRAGMA temp_store = MEMORY",
+    "PRAGMA cache_size = -262144",
+]
+
+# Bound parameters per IN (...) lookup
+LOOKUP_CHUNK = 500
+
+def read_rows(path, file_format, batch_size):
+    """Yield lists of at most batch_size dicts from a CSV, JSON Lines or Parquet file"""
+    if file_format == "parquet":
+        try:
+            import pyarrow.parquet as pq
+        except ImportError:
+            raise SystemExit("Reading Parquet files needs pyarrow: pip install pyarrow")
+        for batch in pq.ParquetFile(path).iter_batches(batch_size=batch_size):
+            yield batch.to_pylist()
+        return
+    with open(path, newline="", encoding="utf-8") as source:
+        if file_format == "csv":
+            # Empty CSV fields are missing values, not empty strings
+            rows = ({k: v if v != "" else None for k, v in row.items()} for row in csv.DictReader(source))
+        else:
+            rows = (json.loads(line) for line in source if line.strip())
+        batch = []
+        for row in rows:
+            batch.append(row)
+            if len(batch) >= batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+def _fingerprint(path):
+    stat = os.stat(path)
+    return f"{stat.st_size}:{stat.st_mtime_ns}"
+
+def _sql_value(value):
+    if isinstance(value, (date, datetime)):
+        return value.isoformat()
+    if isinstance(value, (dict, list)):
+        return json.dumps(value)
+    return value
+
+class TableImporter:
+    """Loads rows into one table in batches, one transaction per batch.
+
+    Each batch is committed together with the source's checkpoint in
+    import_progress, so an interrupted import resumes after the last
+    committed batch. Rows whose primary key already exists are skipped (or
+    updated with on_conflict="update"), which makes appending a newer
+    export safe. Rows referring to a patient, doctor, record or medication
+    that does not exist are rejected and written to a .rejected.jsonl file
+    next to the input.
+    """
+
+    def __init__(self, connection, table, on_conflict="skip", check_foreign_keys=True):
+        self.connection = connection
+        self.table = table
+        self.key = TABLE_KEYS[table]
+        self.columns = [row[1] for row in connection.execute(f"PRAGMA table_info({table})")]
+        self.foreign_keys = {
+            row[3]: (row[2], row[4]) for row in connection.execute(f"PRAGMA foreign_key_list({table})")
+        } if check_foreign_keys else {}
+        updates = ", ".join(f"{column} = excluded.{column}" for column in self.columns if column != self.key)
+        action = f"DO UPDATE SET {updates}" if on_conflict == "update" else "DO NOTHING"
+        self.insert = (
+            f"INSERT INTO {table} ({', '.join(self.columns)}) VALUES ({', '.join('?' * len(self.columns))}) "
+            f"ON CONFLICT ({self.key}) {action}"
+        )
+
+    def _existing(self, table, column, values):
+        found = set()
+        values = list(values)
+        for start in range(0, len(values), LOOKUP_CHUNK):
+            chunk = values[start:start + LOOKUP_CHUNK]
+            found.update(row[0] for row in self.connection.execute(
+                f"SELECT {column} FROM {table} WHERE {column} IN ({', '.join('?' * len(chunk))})", chunk
+            ))
+        return found
+
+    def validate(self, rows):
+        """(rows as tuples in column order, [(row, reason)] for rows with dangling references)"""
+        missing = {}
+        for column, (parent, parent_key) in self.foreign_keys.items():
+            wanted = {row.get(column) for row in rows if row.get(column) is not None}
+            # Compare as integers where possible, since CSV values arrive as text
+            wanted = {int(value) if str(value).lstrip("-").isdigit() else value for value in wanted}
+            missing[column] = (parent, wanted - self._existing(parent, parent_key, wanted))
+        accepted, rejected = [], []
+        for row in rows:
+            for column, (parent, absent) in missing.items():
+                value = row.get(column)
+                if value is not None and (int(value) if str(value).lstrip("-").isdigit() else value) in absent:
+                    rejected.append((row, f"{column} {value} not found in {parent}"))
+                    break
+            else:
+                accepted.append(tuple(_sql_value(row.get(column)) for column in self.columns))
+        return accepted, rejected
+
+    def load(self, rows):
+        """Insert one batch inside the caller's transaction; returns (inserted, skipped, rejected rows)"""
+        accepted, rejected = self.validate(rows)
+        cursor = self.connection.executemany(self.insert, accepted)
+        # rowcount only counts rows that were inserted or updated
+        written = max(cursor.rowcount, 0)
+        return written, len(accepted) - written, rejected
+
+def import_file(connection, table, path, file_format=None, batch_size=10000, on_conflict="skip",
+                check_foreign_keys=True, restart=False, progress_every=5.0):
+    """Stream one file into a table, resuming from its checkpoint; returns its counters"""
+    file_format = file_format or FORMATS.get(os.path.splitext(path)[1].lower())
+    if file_format is None:
+        raise SystemExit(f"Unknown file format for {path}; use --format")
+    source = os.path.abspath(path)
+    fingerprint = _fingerprint(path)
+    progress = connection.execute(
+        "SELECT fingerprint, rows_done, inserted, skipped, rejected, status FROM import_progress WHERE source = ?",
+        (source,)
+    ).fetchone()
+    counts = {"rows": 0, "inserted": 0, "skipped": 0, "rejected": 0}
+    if progress and not restart:
+        if progress[0] != fingerprint:
+            print(f"{path} changed since the last import; starting over")
+        elif progress[5] == "done":
+            print(f"{path} was already imported; use --restart to import it again")
+            return None
+        else:
+            counts = dict(zip(("rows", "inserted", "skipped", "rejected"), progress[1:5]))
+            print(f"Resuming {path} after {counts['rows']:,} rows")
+    resume_after = counts["rows"]
+
+    importer = TableImporter(connection, table, on_conflict, check_foreign_keys)
+    rejects_path = f"{path}.rejected.jsonl"
+    started = last_report = time.perf_counter()
+    seen = 0
+    for batch in read_rows(path, file_format, batch_size):
+        # Batches committed by an earlier run are read again but not loaded
+        if seen + len(batch) <= resume_after:
+            seen += len(batch)
+            continue
+        if seen < resume_after:
+            batch = batch[resume_after - seen:]
+            seen = resume_after
+        with connection:
+            inserted, skipped, rejected = importer.load(batch)
+            seen += len(batch)
+            counts["rows"] = seen
+            counts["inserted"] += inserted
+            counts["skipped"] += skipped
+            counts["rejected"] += len(rejected)
+            connection.execute(
+                "INSERT OR REPLACE INTO import_progress VALUES (?, ?, ?, ?, ?, ?, ?, 'running', ?)",
+                (source, table, fingerprint, counts["rows"], counts["inserted"], counts["skipped"],
+                 counts["rejected"], time.time())
+            )
+        if rejected:
+            with open(rejects_path, "a", encoding="utf-8") as rejects:
+                for row, reason in rejected:
+                    rejects.write(json.dumps({"reason": reason, "row": row}, default=str) + "\n")
+        now = time.perf_counter()
+        if progress_every and now - last_report >= progress_every:
+            rate = (seen - resume_after) / (now - started)
+            print(f"  {table}: {seen:,} rows read ({rate:,.0f} rows/sec)")
+            last_report = now
+    with connection:
+        connection.execute("UPDATE import_progress SET status = 'done', updated_at = ? WHERE source = ?",
+                           (time.time(), source))
+    counts["read"] = seen - resume_after
+    report_throughput(table, counts["read"], time.perf_counter() - started)
+    written = "inserted or updated" if on_conflict == "update" else "inserted"
+    print(f"{'':<16} {counts['inserted']:,} {written}, {counts['skipped']:,} already present, "
+          f"{counts['rejected']:,} rejected" + (f" (see {rejects_path})" if counts["rejected"] else ""))
+    return counts
+
+def parse_source(argument):
+    """(table, path) from 'table=path' or a path named after its table"""
+    table, _, path = argument.rpartition("=")
+    if not table:
+        table = os.path.basename(path).split(".")[0]
+    if table not in IMPORT_ORDER:
+        raise SystemExit(f"Unknown table {table!r} for {path}; use table=path with one of {', '.join(IMPORT_ORDER)}")
+    return table, path
+
+def import_files(path, sources, defer_derived=None, **options):
+    """Import (table, file) pairs into the database at path in foreign-key order.
+
+    With defer_derived the dashboard aggregates and full-text indexes are
+    dropped for the load and rebuilt once at the end; otherwise their
+    triggers keep them current row by row, which suits small appends. By
+    default they are deferred when the database has no medical records yet
+    or an earlier import was interrupted.
+    """
+    connection = sqlite3.connect(path)
+    for pragma in IMPORT_PRAGMAS:
+        connection.execute(pragma)
+    create_tables(connection.cursor())
+    connection.execute(IMPORT_PROGRESS_TABLE)
+    connection.commit()
+    if defer_derived is None:
+        # An interrupted deferred load is resumed the same way
+        defer_derived = connection.execute("SELECT 1 FROM medical_records LIMIT 1").fetchone() is None \
+            or connection.execute("SELECT 1 FROM import_progress WHERE status = 'running'").fetchone() is not None
+    if defer_derived:
+        with connection:
+            drop_derived_data(connection.cursor())
+    else:
+        upgrade_medical_database(path)
+
+    started = time.perf_counter()
+    totals = {}
+    for table, source in sorted(sources, key=lambda item: IMPORT_ORDER.index(item[0])):
+        counts = import_file(connection, table, source, **options)
+        for name, value in (counts or {}).items():
+            totals[name] = totals.get(name, 0) + value
+    connection.execute("PRAGMA optimize")
+    connection.close()
+
+    if defer_derived:
+        phase = time.perf_counter()
+        upgrade_medical_database(path)
+        print(f"{'derived data':<16} rebuilt in {time.perf_counter() - phase:.2f}s")
+    if totals:
+        report_throughput("total", totals["read"], time.perf_counter() - started)
+    return totals
+
+def main():
+    parser = argparse.ArgumentParser(description="Import CSV, JSON Lines or Parquet exports into the medical database")
+    parser.add_argument("sources", nargs="+", help="files to import, as table=path or a path named after its table "
+                                                   "(patients.csv, medical_records.jsonl, ...)")
+    parser.add_argument("--db", default="medical.db", help="database file to import into (created if missing)")
+    parser.add_argument("--format", choices=sorted(set(FORMATS.values())), help="input format (default: by extension)")
+    parser.add_argument("--batch-size", type=int, default=10000, help="rows per batch and transaction")
+    parser.add_argument("--on-conflict", choices=["skip", "update"], default="skip",
+                        help="what to do with rows whose id already exists")
+    parser.add_argument("--no-fk-check", action="store_true", help="do not reject rows with unknown foreign keys")
+    parser.add_argument("--restart", action="store_true", help="ignore checkpoints and read every file from the start")
+    derived = parser.add_mutually_exclusive_group()
+    derived.add_argument("--defer-derived", dest="defer_derived", action="store_true", default=None,
+                         help="rebuild dashboard stats and search indexes after the load (default for an empty database)")
+    derived.add_argument("--live-derived", dest="defer_derived", action="store_false",
+                         help="keep dashboard stats and search indexes current row by row (default for appends)")
+    args = parser.parse_args()
+
+    totals = import_files(
+        args.db,
+        [parse_source(source) for source in args.sources],
+        file_format=args.format,
+        batch_size=args.batch_size,
+        on_conflict=args.on_conflict,
+        check_foreign_keys=not args.no_fk_check,
+        restart=args.restart,
+        defer_derived=args.defer_derived,
+    )
+    if totals.get("rejected"):
+        sys.exit(2)
+
+if __name__ == "__main__":
+    main()
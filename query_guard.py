@@ -0,0 +1,215 @@
+import re
+import math
+import time
+import logging
+import threading
+from contextlib import contextmanager
+from collections import defaultdict
+from sqlalchemy import text
+from index_advisor import TABLE_REF, _strip_literals
+
+logger = logging.getLogger(__name__)
+
+# Plan lines of subqueries that run once per row of the loops around them
+CORRELATED = "CORRELATED"
+
+# Outer statements with none of these read every row they touch
+NARROWING = re.compile(r"\b(WHERE|GROUP\s+BY|HAVING|LIMIT|DISTINCT|UNION|COUNT|SUM|AVG|MIN|MAX)\b", re.IGNORECASE)
+
+class QueryRejected(Exception):
+    """The plan of a statement is too expensive to run; the message says why"""
+
+@contextmanager
+def statement_timeout(connection, seconds):
+    """Interrupt SQLite statements on this connection after seconds of wall-clock time.
+
+    The progress handler is called every few thousand virtual machine
+    instructions, so even a statement that returns no rows is stopped.
+    MySQL gets the limit as an optimizer hint instead, see with_timeout_hint.
+    """
+    if not seconds or connection.dialect.name != "sqlite":
+        yield
+        return
+    deadline = time.monotonic() + seconds
+    raw = connection.connection.driver_connection
+    raw.set_progress_handler(lambda: time.monotonic() > deadline, 10000)
+    try:
+        yield
+    finally:
+        raw.set_progress_handler(None, 0)
+
+def with_timeout_hint(sql, seconds, dialect):
+    """Add a MAX_EXECUTION_TIME hint to a MySQL SELECT"""
+    if not seconds or dialect != "mysql":
+        return sql
+    return re.sub(r"^\s*SELECT\b", f"SELECT /*+ MAX_EXECUTION_TIME({int(seconds * 1000)}) */", sql, count=1,
+                  flags=re.IGNORECASE)
+
+def limit_rows(sql, limit):
+    """A statement reading at most limit rows of sql.
+
+    The statement is wrapped rather than suffixed, so a trailing comment or
+    a LIMIT inside it cannot swallow the limit; the newline ends a trailing
+    -- comment before the closing parenthesis.
+    """
+    return f"SELECT * FROM (\n{sql.strip().rstrip(';')}\n) AS guarded LIMIT {int(limit)}"
+
+def is_timeout_error(error):
+    """True for the errors raised by statement_timeout and MAX_EXECUTION_TIME"""
+    message = str(error).lower()
+    return "interrupted" in message or "maximum statement execution time" in message
+
+class QueryGuard:
+    """Admission control for the SQL the agent wants to run.
+
+    Each statement is explained first and the number of rows it will read
+    is estimated from the plan and the catalog's row counts. Full scans
+    nested inside each other, which is what a cartesian join or a
+    correlated subquery without an index looks like, are rejected past
+    max_examined_rows. Plain unfiltered scans of large tables get a LIMIT.
+    Statements that are admitted still run under a wall-clock timeout.
+    """
+
+    def __init__(self, engine, catalog, max_examined_rows=10000000, row_limit=1000, timeout=30):
+        self.engine = engine
+        self.catalog = catalog
+        self.max_examined_rows = max_examined_rows
+        self.row_limit = row_limit
+        self.timeout = timeout
+        self.counts = {"admitted": 0, "rewritten": 0, "rejected": 0, "timed_out": 0}
+        self._lock = threading.Lock()
+
+    def count(self, outcome):
+        """Add one to a counter; agent workers admit queries from several threads"""
+        with self._lock:
+            self.counts[outcome] += 1
+
+    def stats(self):
+        with self._lock:
+            return dict(self.counts)
+
+    def _rows(self, table):
+        table = self.catalog.tables.get(table)
+        return table["rows"] if table and table["rows"] else 1
+
+    @staticmethod
+    def _aliases(sql):
+        """{alias or table name: table name} for the tables a statement reads"""
+        aliases = {}
+        for match in TABLE_REF.finditer(_strip_literals(sql)):
+            table = match.group(1) or match.group(3)
+            aliases[table] = table
+            if match.group(2) or match.group(4):
+                aliases[match.group(2) or match.group(4)] = table
+        return aliases
+
+    def admit(self, sql, count=True):
+        """(statement to run, note for the agent or None); raises QueryRejected.
+
+        With count=False the statement is not added to the counters, for
+        statements derived from one already admitted (pages of a result).
+        """
+        record = self.count if count else lambda outcome: None
+        sql = sql.strip().rstrip(";")
+        if not re.match(r"(SELECT|WITH)\b", sql, re.IGNORECASE):
+            return sql, None
+        try:
+            estimate, scans = self.estimate(sql)
+        except Exception as e:
+            # Invalid SQL fails again when it runs, with the database's own message
+            logger.info("Could not explain query: %s", e)
+            return sql, None
+        if estimate > self.max_examined_rows and len(scans) > 1:
+            record("rejected")
+            raise QueryRejected(self._rejection(sql, estimate, scans))
+        record("admitted")
+        if estimate > self.row_limit and not NARROWING.search(_strip_literals(sql)):
+            record("rewritten")
+            return limit_rows(sql, self.row_limit), (
+                f"Note: this query has no filter, so only the first {self.row_limit} rows were read. "
+                f"Use COUNT(*) or other aggregates for totals."
+            )
+        return sql, None
+
+    def estimate(self, sql):
+        """(estimated rows read, tables read in full that multiply each other)"""
+        with self.engine.connect() as connection:
+            if self.engine.dialect.name == "sqlite":
+                plan = connection.execute(text(f"EXPLAIN QUERY PLAN {sql}")).fetchall()
+                return self._sqlite_estimate(plan, self._aliases(sql))
+            plan = connection.execute(text(f"EXPLAIN {sql}")).mappings().fetchall()
+            return self._mysql_estimate(plan)
+
+    def _sqlite_estimate(self, plan, aliases):
+        children = defaultdict(list)
+        for node, parent, _, detail in plan:
+            children[parent].append((node, detail))
+
+        def cost(parent):
+            # (rows in the innermost loop plus the subqueries below, the full
+            # scans that run inside each other)
+            loops, scanned, nested, extra = 1, [], [], 0
+            for node, detail in children[parent]:
+                match = re.match(r"SCAN (?:TABLE )?(\w+)", detail)
+                if match and "CONSTANT ROW" not in detail:
+                    # The plan names tables by their alias
+                    table = aliases.get(match.group(1), match.group(1))
+                    rows = self._rows(table)
+                    loops *= rows
+                    if rows > 1:
+                        scanned.append(table)
+                elif children[node]:
+                    inner, inner_scans = cost(node)
+                    if detail.startswith(CORRELATED):
+                        extra += loops * inner
+                        inner_scans = scanned + inner_scans
+                    else:
+                        extra += inner
+                    nested = max(nested, inner_scans, key=len)
+            return loops + extra, max(scanned, nested, key=len)
+
+        return cost(0)
+
+    def _mysql_estimate(self, plan):
+        selects = defaultdict(list)
+        for row in plan:
+            rows = (row.get("rows") or 1) * (row.get("filtered") or 100) / 100
+            selects[(row.get("id"), str(row.get("select_type") or ""))].append((row.get("table"), row.get("type"), rows))
+        outer = 1
+        total, nested = 0, []
+        for (_, select_type), tables in sorted(selects.items(), key=lambda item: item[0][0] or 0):
+            loops = math.prod(rows for _, _, rows in tables)
+            if select_type.startswith("DEPENDENT"):
+                loops *= outer
+            elif select_type in ("SIMPLE", "PRIMARY"):
+                outer = loops
+            total += loops
+            scanned = [table for table, type_, rows in tables if type_ in ("ALL", "index") and rows > 1]
+            if len(scanned) > len(nested):
+                nested = scanned
+        return total, nested
+
+    def _rejection(self, sql, estimate, scans):
+        message = (
+            f"Query rejected: it would read about {estimate:,.0f} rows because "
+            f"{scans[-1]} is read in full for every row of {' x '.join(scans[:-1])}."
+        )
+        hints = self._join_hints(sql, scans)
+        if hints:
+            message += f" The join condition is probably missing; join on {' or '.join(hints)}."
+        return message + " Add join conditions or filters on indexed columns, or aggregate in a single pass, and try again."
+
+    def _join_hints(self, sql, tables):
+        """Foreign-key conditions between the scanned tables that the statement does not use"""
+        names = {}
+        for alias, table in self._aliases(sql).items():
+            if alias != table or table not in names:
+                names[table] = alias
+        hints = []
+        for table in tables:
+            for column, (ref_table, ref_column) in self.catalog.tables[table]["foreign_keys"].items():
+                if ref_table in tables:
+                    condition = f"{names.get(table, table)}.{column} = {names.get(ref_table, ref_table)}.{ref_column}"
+                    if condition.lower() not in sql.lower():
+                        hints.append(condition)
+        return hints
@@ -0,0 +1,230 @@
+import os
+import re
+import time
+import hashlib
+from collections import deque
+from sqlalchemy import inspect, text
+
+# Words that point at a table even when its name is not in the question
+TABLE_KEYWORDS = {
+    "patients": ["patient", "people", "person", "gender", "male", "female", "men", "women", "age", "old", "born",
+                 "birth", "blood"],
+    "doctors": ["doctor", "physician", "specialist", "specialization", "specialty", "cardiolog", "neurolog",
+                "pediatric", "psychiatr"],
+    "medical_records": ["record", "visit", "diagnos", "condition", "disease", "treat", "treatment", "note", "seen",
+                        "history"],
+    "prescriptions": ["prescription", "prescribed", "prescribe", "dosage", "dose", "frequency"],
+    "medications": ["medication", "medicine", "drug", "manufactur", "side", "effect"],
+}
+
+# Columns with at most this many distinct values (in a sample) get a value dictionary
+MAX_DICTIONARY_VALUES = 12
+MAX_DICTIONARY_VALUE_LENGTH = 40
+DICTIONARY_SAMPLE_ROWS = 10000
+
+def _stems(phrase):
+    """Six-letter prefixes of the longer words, a cheap stand-in for stemming"""
+    return {word[:6] for word in re.findall(r"[a-z]+", phrase.lower()) if len(word) >= 5}
+
+class SchemaCatalog:
+    """Compact, precomputed description of the database for the agent prompt.
+
+    Holds column types, primary and foreign keys, indexed columns, an
+    approximate row count and the values of low-cardinality columns such
+    as gender and blood_type, instead of the CREATE statements and sample
+    rows of SQLDatabase.get_table_info.
+    """
+
+    def __init__(self, tables, dialect):
+        self.tables = tables
+        self.dialect = dialect
+        # Changes whenever the described schema or row counts do, so objects
+        # built from the catalog can be cached on it
+        self.version = hashlib.sha256(self.describe().encode()).hexdigest()[:16]
+
+    @classmethod
+    def build(cls, engine, ignore_tables=()):
+        started = time.perf_counter()
+        inspector = inspect(engine)
+        tables = {}
+        with engine.connect() as connection:
+            for name in sorted(inspector.get_table_names()):
+                if name in ignore_tables:
+                    continue
+                primary_key = set(inspector.get_pk_constraint(name).get("constrained_columns") or [])
+                foreign_keys = {}
+                for fk in inspector.get_foreign_keys(name):
+                    for column, referred in zip(fk["constrained_columns"], fk["referred_columns"]):
+                        foreign_keys[column] = (fk["referred_table"], referred)
+                indexed = {index["column_names"][0] for index in inspector.get_indexes(name) if index["column_names"]}
+                columns = [(column["name"], str(column["type"])) for column in inspector.get_columns(name)]
+                values = {}
+                for column, type_ in columns:
+                    if column in primary_key or column in foreign_keys or not re.match(r"(VARCHAR|TEXT|CHAR)", type_.upper()):
+                        continue
+                    dictionary = cls._value_dictionary(connection, name, column, sorted(primary_key))
+                    if dictionary:
+                        values[column] = dictionary
+                tables[name] = {
+                    "columns": columns,
+                    "primary_key": primary_key,
+                    "foreign_keys": foreign_keys,
+                    "indexed": indexed,
+                    "values": values,
+                    "rows": cls._approximate_rows(connection, engine.dialect.name, name),
+                }
+        catalog = cls(tables, engine.dialect.name)
+        catalog.build_seconds = time.perf_counter() - started
+        return catalog
+
+    @staticmethod
+    def _value_dictionary(connection, table, column, primary_key):
+        """Distinct values of a column if there are few of them, most common first"""
+        # Without an ORDER BY the sample may be read from an index on the
+        # column itself and contain a single value
+        order = f" ORDER BY {', '.join(primary_key)}" if primary_key else ""
+        rows = connection.execute(text(
+            f"SELECT {column}, COUNT(*) AS n FROM (SELECT {column} FROM {table}{order} LIMIT {DICTIONARY_SAMPLE_ROWS}) AS sample "
+            f"WHERE {column} IS NOT NULL GROUP BY {column} ORDER BY n DESC LIMIT {MAX_DICTIONARY_VALUES + 1}"
+        )).fetchall()
+        sampled = sum(n for _, n in rows)
+        # Columns where no value repeats (names, emails) are not categories
+        if not rows or len(rows) > MAX_DICTIONARY_VALUES or sampled == len(rows):
+            return None
+        if any(len(str(value)) > MAX_DICTIONARY_VALUE_LENGTH for value, _ in rows):
+            return None
+        return [value for value, _ in rows]
+
+    @staticmethod
+    def _approximate_rows(connection, dialect, table):
+        if dialect == "mysql":
+            return connection.execute(text(
+                "SELECT TABLE_ROWS FROM information_schema.tables WHERE table_schema = DATABASE() AND table_name = :table"
+            ), {"table": table}).scalar()
+        if dialect == "sqlite":
+            # The highest rowid is an O(1) estimate that ignores deleted rows
+            return connection.execute(text(f"SELECT MAX(rowid) FROM {table}")).scalar() or 0
+        return None
+
+    def table_names(self):
+        return list(self.tables)
+
+    def describe_table(self, name):
+        table = self.tables[name]
+        rows = f" (~{table['rows']:,} rows)" if table["rows"] is not None else ""
+        lines = [f"{name}{rows}"]
+        for column, type_ in table["columns"]:
+            notes = []
+            if column in table["primary_key"]:
+                notes.append("primary key")
+            if column in table["foreign_keys"]:
+                notes.append("-> {}.{}".format(*table["foreign_keys"][column]))
+            if column in table["indexed"] and column not in table["primary_key"]:
+                notes.append("indexed")
+            if column in table["values"]:
+                notes.append("values: " + ", ".join(repr(value) for value in table["values"][column]))
+            lines.append(f"  {column} {type_}" + (f" [{'; '.join(notes)}]" if notes else ""))
+        return "\n".join(lines)
+
+    def describe(self, names=None):
+        """Schema of the given tables (all by default); unknown names are reported, not raised"""
+        names = self.table_names() if names is None else names
+        unknown = [name for name in names if name not in self.tables]
+        parts = [self.describe_table(name) for name in names if name in self.tables]
+        if unknown:
+            parts.append(f"Unknown tables: {', '.join(unknown)}. Available tables: {', '.join(self.tables)}")
+        return "\n\n".join(parts)
+
+    def summary(self):
+        """One line per table with its size and relationships, for sql_db_list_tables"""
+        lines = []
+        for name, table in self.tables.items():
+            links = ", ".join(f"{column} -> {ref_table}" for column, (ref_table, _) in table["foreign_keys"].items())
+            rows = f"~{table['rows']:,} rows" if table["rows"] is not None else "rows unknown"
+            lines.append(f"{name} ({rows}{'; ' + links if links else ''})")
+        return "\n".join(lines)
+
+    def _neighbours(self):
+        graph = {name: set() for name in self.tables}
+        for name, table in self.tables.items():
+            for ref_table, _ in table["foreign_keys"].values():
+                if ref_table in graph:
+                    graph[name].add(ref_table)
+                    graph[ref_table].add(name)
+        return graph
+
+    def _join_path(self, graph, start, goal):
+        previous = {start: None}
+        queue = deque([start])
+        while queue:
+            node = queue.popleft()
+            if node == goal:
+                path = []
+                while node is not None:
+                    path.append(node)
+                    node = previous[node]
+                return path
+            for neighbour in sorted(graph[node]):
+                if neighbour not in previous:
+                    previous[neighbour] = node
+                    queue.append(neighbour)
+        return []
+
+    def relevant_tables(self, question):
+        """Tables the question refers to, plus the tables needed to join them.
+
+        A table matches on its name, a keyword, a column name or a word of
+        one of its dictionary values. If nothing matches, every table is
+        returned.
+        """
+        lowered = question.lower()
+        words = re.findall(r"[a-z0-9]+", lowered)
+        stems = _stems(question)
+        matched = []
+        for name, table in self.tables.items():
+            keywords = name.split("_") + TABLE_KEYWORDS.get(name, [])
+            value_stems = set().union(*(_stems(str(value)) for values in table["values"].values() for value in values))
+            if any(word.startswith(keyword) for word in words for keyword in keywords if len(keyword) > 2) \
+                    or any(column in lowered for column, _ in table["columns"] if "_" in column) \
+                    or stems & value_stems:
+                matched.append(name)
+        if not matched:
+            return self.table_names()
+        # Add the tables on the foreign-key path between every pair of matches
+        graph = self._neighbours()
+        selected = set(matched)
+        for start in matched:
+            for goal in matched:
+                if start < goal:
+                    selected.update(self._join_path(graph, start, goal))
+        return [name for name in self.tables if name in selected]
+
+# Suffix for create_sql_agent when the relevant schema is part of the input
+CATALOG_SUFFIX = """Begin!
+
+Question: {input}
+Thought: The schema of the tables relevant to the question is listed with it. I only need sql_db_schema for other tables.
+{agent_scratchpad}"""
+
+def catalog_prompt_enabled():
+    """Whether questions are sent to the agent with their schema (MEDICHAT_SCHEMA_CATALOG).
+
+    Off by default: the schema is repeated in every step of a run, and the
+    recorded agent runs still list tables and fetch schemas, so prompts grow
+    by about a quarter. The query guard uses the catalog either way.
+    """
+    return os.environ.get("MEDICHAT_SCHEMA_CATALOG", "").lower() in ("1", "true", "yes")
+
+def compose_agent_input(question, catalog, conversation=""):
+    """The question, earlier turns of the conversation if any, and the schema of the tables it needs"""
+    parts = [question]
+    if conversation:
+        parts += ["", conversation]
+    if catalog is None:
+        return "\n".join(parts)
+    tables = catalog.relevant_tables(question)
+    parts += ["", f"Relevant schema ({catalog.dialect}):", catalog.describe(tables)]
+    others = [name for name in catalog.table_names() if name not in tables]
+    if others:
+        parts.append(f"Other tables: {', '.join(others)}")
+    return "\n".join(parts)
@@ -0,0 +1,417 @@
+import re
+import time
+import logging
+from typing import Any
+from langchain.agents import create_sql_agent
+from langchain.agents.agent_types import AgentType
+from langchain.callbacks.base import BaseCallbackHandler
+from langchain.agents.agent_toolkits import SQLDatabaseToolkit
+from langchain_community.tools.sql_database.tool import (
+    BaseSQLDatabaseTool, InfoSQLDatabaseTool, ListSQLDatabaseTool, QuerySQLDataBaseTool,
+)
+from langchain_community.utilities.sql_database import truncate_word
+from langchain_core.tools import BaseTool
+from sqlalchemy import inspect, text
+from sqlalchemy.exc import DBAPIError
+from medical_database import FULLTEXT_INDEXES, is_internal_table
+from query_guard import QueryRejected, is_timeout_error, statement_timeout, with_timeout_hint
+from schema_catalog import CATALOG_SUFFIX
+
+logger = logging.getLogger(__name__)
+
+# Key columns, whose min/max/avg mean nothing to the agent
+KEY_COLUMN = re.compile(r"(^|_)id$", re.IGNORECASE)
+
+class QueryResult:
+    """SQL text and typed rows of one query executed by the agent.
+
+    Large results are not held in memory: rows keeps the first rows that
+    were fetched and total_rows counts the rest. Other pages are read
+    lazily with page(), through the QueryGuard if the query had one.
+    """
+
+    def __init__(self, sql, columns, rows, elapsed, total_rows=None, complete=True, stats=None, engine=None,
+                 scanned_rows=None):
+        self.sql = sql
+        self.columns = columns
+        self.rows = rows
+        self.elapsed = elapsed
+        self.total_rows = len(rows) if total_rows is None else total_rows
+        self.complete = complete
+        self.stats = stats or {}
+        self.scanned_rows = self.total_rows if scanned_rows is None else scanned_rows
+        self.engine = engine
+        self.guard = None
+
+    @property
+    def truncated(self):
+        return not self.complete or self.total_rows > len(self.rows)
+
+    @property
+    def dataframe(self):
+        import pandas as pd
+        return pd.DataFrame.from_records(self.rows, columns=self.columns)
+
+    def page(self, number, page_size=100):
+        """DataFrame with one page of the full result, read from the database if not captured"""
+        import pandas as pd
+        start = number * page_size
+        if start + page_size <= len(self.rows) or not self.truncated:
+            rows = self.rows[start:start + page_size]
+        else:
+            timeout = self.guard.timeout if self.guard is not None else None
+            select = with_timeout_hint(f"SELECT * FROM paged_result LIMIT {page_size} OFFSET {start}",
+                                       timeout, self.engine.dialect.name)
+            statement = f"{_as_cte(self.sql, len(self.columns), 'paged_result')} {select}"
+            if self.guard is not None:
+                statement, _ = self.guard.admit(statement, count=False)
+            rows = execute_query(self.engine, statement, capture_rows=page_size, timeout=timeout).rows
+        return pd.DataFrame.from_records(rows, columns=self.columns)
+
+    def summary(self, shown):
+        """One-line description of the rows that were left out, for the LLM"""
+        total = f"{self.total_rows:,}" if self.complete else f"more than {self.total_rows:,}"
+        parts = []
+        for column, (count, low, high, total_sum) in self.stats.items():
+            if count:
+                parts.append(f"{column}: min={low}, max={high}, avg={total_sum / count:.4g}")
+        over = "all" if self.complete and self.scanned_rows >= self.total_rows else f"the first {self.scanned_rows:,}"
+        stats = f" Column stats over {over} rows: " + "; ".join(parts) + "." if parts else ""
+        return f"(Showing the first {shown} of {total} rows.{stats} Add filters, aggregates or a LIMIT to narrow the result.)"
+
+def _as_cte(sql, width, name):
+    """WITH clause naming a statement's result, with its columns renamed by
+    position so that results with duplicate column names (a.id, b.id) can
+    be wrapped in another query. The newline ends a trailing -- comment"""
+    names = ", ".join(f"c{index}" for index in range(width))
+    return f"WITH {name} ({names}) AS (\n{sql.strip().rstrip(';')}\n)"
+
+class QueryRecorder(BaseCallbackHandler):
+    """Collects the results of the queries run during one agent run.
+
+    Pass an instance in the callbacks of agent.run; RecordingQueryTool hands
+    every result to the handlers that define on_query_result.
+    """
+
+    def __init__(self):
+        self.results = []
+
+    def on_query_result(self, result):
+        self.results.append(result)
+
+    @property
+    def last_result(self):
+        """Most recent query that returned rows, which is usually the one the answer is based on"""
+        for result in reversed(self.results):
+            if result.rows:
+                return result
+        return self.results[-1] if self.results else None
+
+def _streams_rows(dialect):
+    """Whether the driver hands over rows as they are fetched.
+
+    sqlite3 steps through the result lazily, and drivers with server-side
+    cursors (psycopg2, pymysql's SSCursor) honour stream_results. The
+    mysqlconnector dialect has neither and buffers the whole result.
+    """
+    return dialect.name == "sqlite" or dialect.supports_server_side_cursors
+
+def execute_query(engine, sql, capture_rows=1000, scan_limit=5000, fetch_size=500, params=None, timeout=None):
+    """Run a statement once, reading a bounded number of its rows.
+
+    The first capture_rows rows are kept and the first scan_limit rows (or
+    the kept rows, if more) are summarized (min/max/avg of numeric columns
+    other than keys). Larger results are counted with COUNT(*) in the database
+    rather than fetched. Where the driver streams (see _streams_rows) the
+    rows past the limit are never fetched; elsewhere a SELECT is wrapped in
+    an outer LIMIT so the server sends no more than that. With a timeout the
+    statement, and the count, are interrupted after that many seconds.
+    """
+    started = time.perf_counter()
+    columns, rows, stats = [], [], {}
+    total_rows, complete = 0, True
+    limit = max(scan_limit, capture_rows)
+    statement = with_timeout_hint(sql, timeout, engine.dialect.name)
+    with engine.begin() as connection, statement_timeout(connection, timeout):
+        cursor = None
+        if not _streams_rows(engine.dialect) and re.match(r"\s*(SELECT|WITH)\b", sql, re.IGNORECASE):
+            bounded = f"SELECT * FROM (\n{sql.strip().rstrip(';')}\n) AS bounded_result LIMIT {limit}"
+            try:
+                cursor = connection.execute(text(with_timeout_hint(bounded, timeout, engine.dialect.name)), params or {})
+            except DBAPIError as e:
+                # A derived table cannot have duplicate column names (a.id, b.id);
+                # such results are read whole by the driver
+                if "duplicate column" not in str(e).lower():
+                    raise
+        if cursor is None:
+            cursor = connection.execution_options(stream_results=True).execute(text(statement), params or {})
+        if cursor.returns_rows:
+            columns = list(cursor.keys())
+            measured = [not KEY_COLUMN.search(column) for column in columns]
+            while True:
+                batch = cursor.fetchmany(fetch_size)
+                if not batch:
+                    break
+                if len(rows) < capture_rows:
+                    rows.extend(tuple(row) for row in batch[:capture_rows - len(rows)])
+                for row in batch:
+                    for column, measure, value in zip(columns, measured, row):
+                        if measure and isinstance(value, (int, float)) and not isinstance(value, bool):
+                            count, low, high, total = stats.get(column, (0, value, value, 0))
+                            stats[column] = (count + 1, min(low, value), max(high, value), total + value)
+                total_rows += len(batch)
+                if total_rows >= limit:
+                    complete = False
+                    break
+            cursor.close()
+        scanned_rows = total_rows
+        if not complete and re.match(r"\s*(SELECT|WITH)\b", sql, re.IGNORECASE):
+            select = with_timeout_hint("SELECT COUNT(*) FROM counted_result", timeout, engine.dialect.name)
+            counted = f"{_as_cte(sql, len(columns), 'counted_result')} {select}"
+            try:
+                total_rows, complete = connection.execute(text(counted), params or {}).scalar(), True
+            except Exception:
+                # Past the timeout the result is reported as "more than" the rows scanned
+                logger.info("Could not count the rows of a query", exc_info=True)
+    return QueryResult(sql, columns, rows, time.perf_counter() - started, total_rows, complete, stats, engine,
+                       scanned_rows)
+
+def format_for_llm(result, max_string_length=300, max_rows=50, max_chars=4000):
+    """Render rows the way SQLDatabase.run does, capped by row count and size.
+
+    When rows are left out a summary with the total row count and column
+    statistics is appended, so the agent knows the result was cut.
+    """
+    shown = []
+    size = 2
+    for row in result.rows[:max_rows]:
+        row = tuple(truncate_word(value, length=max_string_length) for value in row)
+        size += len(str(row)) + 2
+        if shown and size > max_chars:
+            break
+        shown.append(row)
+    if not shown:
+        return ""
+    if len(shown) == result.total_rows and result.complete:
+        return str(shown)
+    return str(shown) + "\n" + result.summary(len(shown))
+
+def notify_query_result(run_manager, result):
+    """Hand a result to every callback handler that defines on_query_result"""
+    for handler in run_manager.handlers if run_manager else []:
+        notify = getattr(handler, "on_query_result", None)
+        if notify is not None:
+            notify(result)
+
+class RecordingQueryTool(QuerySQLDataBaseTool):
+    """sql_db_query that streams results, caps what the LLM sees and keeps the typed rows.
+
+    With a QueryGuard, expensive statements are rejected before they run
+    and the rest run under its timeout. With a Federation, each statement
+    runs on every site and the merged result is returned.
+    """
+
+    max_rows: int = 50
+    max_chars: int = 4000
+    capture_rows: int = 1000
+    scan_limit: int = 5000
+    guard: Any = None
+    federation: Any = None
+
+    def _run(self, query, run_manager=None):
+        note, timeout, original = None, None, query
+        try:
+            if self.guard is not None:
+                query, note = self.guard.admit(query)
+                timeout = self.guard.timeout
+            if self.federation is not None:
+                result = self.federation.execute(query, timeout=timeout)
+            else:
+                result = self._execute(original, query, note, timeout)
+                result.guard = self.guard
+        except QueryRejected as e:
+            return f"Error: {e}"
+        except Exception as e:
+            if timeout and is_timeout_error(e):
+                self.guard.count("timed_out")
+                return (f"Error: the query was stopped after {timeout:g} seconds. Filter on indexed columns, "
+                        f"aggregate instead of listing rows, or split the question into smaller queries.")
+            return f"Error: {e}"
+        notify_query_result(run_manager, result)
+        shown = format_for_llm(result, getattr(self.db, "_max_string_length", 300), self.max_rows, self.max_chars)
+        if self.federation is not None:
+            note = "\n".join(filter(None, [note, self.federation.describe(result)]))
+        return f"{shown}\n{note}" if note else shown
+
+    def _execute(self, original, query, note, timeout):
+        try:
+            return execute_query(self.db._engine, query, self.capture_rows, self.scan_limit, timeout=timeout)
+        except DBAPIError as e:
+            # MySQL rejects the guard's derived table when the result has
+            # duplicate column names (a.id, b.id); execute_query bounds the
+            # original statement on its own
+            if note is None or "duplicate column" not in str(e).lower():
+                raise
+            return execute_query(self.db._engine, original, self.capture_rows, self.scan_limit, timeout=timeout)
+
+class FullTextSearchTool(BaseSQLDatabaseTool, BaseTool):
+    """Text search over diagnoses, treatment plans, notes and medication descriptions.
+
+    Uses the FTS5 indexes on SQLite and FULLTEXT indexes on MySQL, falling
+    back to LIKE when neither exists. Besides the matching rows it gives the
+    agent a SQL condition that reuses the index in later queries.
+    """
+
+    name: str = "sql_db_text_search"
+    description: str = (
+        "Input is search words, optionally prefixed with what to search: 'records: <words>' for the diagnosis, "
+        "treatment_plan and notes of medical_records (the default) or 'medications: <words>' for medication "
+        "names and descriptions. Returns the number of matching rows, the best matches and a SQL condition "
+        "to use in sql_db_query. Use this instead of LIKE '%...%' to find rows by what their text says."
+    )
+    max_results: int = 10
+
+    def _index_for(self, scope):
+        scope = scope.strip().lower()
+        for index, (table, _, _) in FULLTEXT_INDEXES.items():
+            if scope and (table.startswith(scope) or scope.startswith(table.split("_")[-1])):
+                return index
+        return next(iter(FULLTEXT_INDEXES))
+
+    def _condition(self, engine, index, words):
+        """(SQL condition with literals inlined, bind parameters for it)"""
+        table, key, columns = FULLTEXT_INDEXES[index]
+        if engine.dialect.name == "sqlite" and index in inspect(engine).get_table_names():
+            match = " ".join(f'"{word}"' for word in words)
+            return f"{key} IN (SELECT rowid FROM {index} WHERE {index} MATCH '{match}')", "fts"
+        if engine.dialect.name == "mysql":
+            # Words shorter than the default minimum token size are not indexed
+            match = " ".join(f"+{word}" for word in words if len(word) >= 3)
+            if match:
+                return f"MATCH({', '.join(columns)}) AGAINST ('{match}' IN BOOLEAN MODE)", "fulltext"
+        return self._like_condition(columns, words), "like"
+
+    @staticmethod
+    def _like_condition(columns, words):
+        return " AND ".join(
+            "(" + " OR ".join(f"{column} LIKE '%{word}%'" for column in columns) + ")" for word in words
+        )
+
+    def _run(self, query, run_manager=None):
+        scope, _, phrase = query.rpartition(":")
+        words = re.findall(r"\w+", phrase.lower())
+        if not words:
+            return "Error: give one or more words to search for."
+        index = self._index_for(scope)
+        table, key, columns = FULLTEXT_INDEXES[index]
+        engine = self.db._engine
+        condition, method = self._condition(engine, index, words)
+        try:
+            try:
+                count = self._count(engine, table, condition)
+            except Exception:
+                if method != "fulltext":
+                    raise
+                # The MySQL table has no FULLTEXT index
+                condition, method = self._like_condition(columns, words), "like"
+                count = self._count(engine, table, condition)
+        except Exception as e:
+            return f"Error: {e}"
+        sql = f"SELECT {key}, {', '.join(columns)} FROM {table} WHERE {condition} ORDER BY {key} LIMIT {self.max_results}"
+        try:
+            result = execute_query(engine, sql, capture_rows=self.max_results)
+        except Exception as e:
+            return f"Error: {e}"
+        notify_query_result(run_manager, result)
+        if not count:
+            return f"No {table} rows match {' '.join(words)!r}."
+        shown = format_for_llm(result, max_string_length=100, max_rows=self.max_results)
+        return (
+            f"{count:,} {table} rows match {' '.join(words)!r}. First {len(result.rows)} ({key}, {', '.join(columns)}):\n"
+            f"{shown}\n"
+            f"To filter {table} on these matches in sql_db_query, use: WHERE {condition}"
+        )
+
+    @staticmethod
+    def _count(engine, table, condition):
+        with engine.connect() as connection:
+            return connection.execute(text(f"SELECT COUNT(*) FROM {table} WHERE {condition}")).scalar()
+
+class CatalogInfoTool(InfoSQLDatabaseTool):
+    """sql_db_schema answered from the precomputed SchemaCatalog"""
+
+    catalog: Any
+
+    def _run(self, table_names, run_manager=None):
+        return self.catalog.describe([name.strip() for name in table_names.split(",") if name.strip()])
+
+class CatalogListTool(ListSQLDatabaseTool):
+    """sql_db_list_tables with row counts and foreign keys from the SchemaCatalog"""
+
+    catalog: Any
+
+    def _run(self, tool_input="", run_manager=None):
+        return self.catalog.summary()
+
+class CapturingSQLDatabaseToolkit(SQLDatabaseToolkit):
+    """SQLDatabaseToolkit whose query tool records results for the UI.
+
+    With a SchemaCatalog the schema and list-tables tools answer from the
+    catalog instead of reading CREATE statements and sample rows. A
+    QueryGuard and a Federation are handed to the query tool.
+    """
+
+    max_rows: int = 50
+    max_chars: int = 4000
+    catalog: Any = None
+    guard: Any = None
+    federation: Any = None
+
+    def get_tools(self):
+        tools = []
+        for tool in super().get_tools():
+            if isinstance(tool, QuerySQLDataBaseTool):
+                description = tool.description
+                if self.federation is not None:
+                    description += " " + FEDERATED_QUERY_NOTE
+                tool = RecordingQueryTool(db=self.db, description=description, guard=self.guard,
+                                          federation=self.federation, max_rows=self.max_rows, max_chars=self.max_chars)
+            elif isinstance(tool, InfoSQLDatabaseTool) and self.catalog is not None:
+                tool = CatalogInfoTool(db=self.db, catalog=self.catalog, description=tool.description.replace(
+                    "schema and sample rows", "columns, keys, indexes and common values"))
+            elif isinstance(tool, ListSQLDatabaseTool) and self.catalog is not None:
+                tool = CatalogListTool(db=self.db, catalog=self.catalog)
+            tools.append(tool)
+        return tools
+
+FEDERATED_QUERY_NOTE = (
+    "The query runs on every clinic database and the results are merged: listed rows get a site column, and "
+    "COUNT, SUM, MIN, MAX and AVG are combined per GROUP BY group. HAVING, COUNT(DISTINCT ...), UNION, window "
+    "functions and expressions around aggregates (ROUND(AVG(x)), SUM(a) / COUNT(*)) are not supported."
+)
+
+def internal_tables(engine):
+    """Bookkeeping and full-text search tables, to pass as ignore_tables to SQLDatabase"""
+    return [table for table in inspect(engine).get_table_names() if is_internal_table(table)]
+
+def build_agent(llm, db, verbose=True, catalog=None, guard=None, federation=None, **toolkit_options):
+    """The SQL agent used by the chat UI, built on CapturingSQLDatabaseToolkit.
+
+    With a catalog, questions are expected to arrive with their relevant
+    schema (see schema_catalog.compose_agent_input), so the prompt no longer
+    starts every run by listing the tables. With a federation, db is one of
+    its sites and is used for the schema and text search.
+    """
+    toolkit = CapturingSQLDatabaseToolkit(db=db, llm=llm, catalog=catalog, guard=guard, federation=federation,
+                                          **toolkit_options)
+    search = FullTextSearchTool(db=db)
+    if federation is not None:
+        search.description += " Only one site is searched; use the returned condition in sql_db_query to cover every site."
+    return create_sql_agent(
+        llm=llm,
+        toolkit=toolkit,
+        verbose=verbose,
+        agent_type=AgentType.ZERO_SHOT_REACT_DESCRIPTION,
+        extra_tools=[search],
+        suffix=CATALOG_SUFFIX if catalog is not None else None
+    )
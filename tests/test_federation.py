@@ -0,0 +1,77 @@
+import pytest
+from sqlalchemy import create_engine, text
+from federation import FederatedQuery, FederationError
+from sql_tools import execute_query
+
+SITES = {
+    "north": [(1, "flu", 30, 1), (2, "asthma", 45, 1), (3, "flu", 60, 2)],
+    "south": [(4, "flu", 20, 3), (5, "diabetes", 70, 3), (6, "asthma", 35, 4), (7, "asthma", None, 4)],
+}
+
+def _engine(path, rows):
+    engine = create_engine(f"sqlite:///{path}")
+    with engine.begin() as connection:
+        connection.execute(text("CREATE TABLE visits (visit_id INTEGER PRIMARY KEY, diagnosis TEXT, age INTEGER, doctor_id INTEGER)"))
+        connection.execute(text("INSERT INTO visits VALUES (:id, :diagnosis, :age, :doctor)"),
+                           [dict(zip(("id", "diagnosis", "age", "doctor"), row)) for row in rows])
+    return engine
+
+@pytest.fixture
+def sites(tmp_path):
+    engines = {site: _engine(tmp_path / f"{site}.db", rows) for site, rows in SITES.items()}
+    yield engines
+    for engine in engines.values():
+        engine.dispose()
+
+@pytest.fixture
+def combined(tmp_path):
+    engine = _engine(tmp_path / "combined.db", [row for rows in SITES.values() for row in rows])
+    yield engine
+    engine.dispose()
+
+def federated(sites, sql):
+    query = FederatedQuery(sql)
+    site_sql = query.site_sql()
+    return query.merge([(site, execute_query(engine, site_sql)) for site, engine in sites.items()])
+
+def test_average_runs_as_sum_and_count_on_each_site():
+    query = FederatedQuery("SELECT diagnosis, AVG(age) AS mean_age FROM visits GROUP BY diagnosis")
+    site_sql = query.site_sql()
+    assert "SUM(age) AS mean_age" in site_sql
+    assert "COUNT(age)" in site_sql
+    assert "AVG(" not in site_sql
+
+def test_limit_is_pushed_down_with_the_offset():
+    assert FederatedQuery("SELECT visit_id FROM visits ORDER BY age DESC LIMIT 2 OFFSET 1").site_sql().endswith("LIMIT 3")
+
+@pytest.mark.parametrize("sql", [
+    "SELECT diagnosis, COUNT(*) AS n, SUM(age), MIN(age), MAX(age), AVG(age) FROM visits GROUP BY diagnosis ORDER BY diagnosis",
+    "SELECT COUNT(*), AVG(age) FROM visits WHERE age > 25",
+    "SELECT diagnosis, COUNT(*) AS n FROM visits GROUP BY diagnosis ORDER BY n DESC, diagnosis LIMIT 2",
+    "SELECT doctor_id, MIN(age), MAX(age) FROM visits GROUP BY doctor_id ORDER BY doctor_id",
+])
+def test_aggregates_match_a_single_database(sites, combined, sql):
+    columns, rows = federated(sites, sql)
+    expected = execute_query(combined, sql)
+    assert [tuple(row) for row in rows] == pytest.approx([tuple(row) for row in expected.rows])
+
+def test_listings_are_tagged_with_their_site_and_sorted_again(sites, combined):
+    columns, rows = federated(sites, "SELECT visit_id, age FROM visits WHERE age IS NOT NULL ORDER BY age DESC LIMIT 3")
+    assert columns == ["site", "visit_id", "age"]
+    assert rows == [("south", 5, 70), ("north", 3, 60), ("north", 2, 45)]
+
+def test_distinct_listings_are_deduplicated_across_sites(sites):
+    columns, rows = federated(sites, "SELECT DISTINCT diagnosis FROM visits ORDER BY diagnosis")
+    assert [row[1] for row in rows] == ["asthma", "diabetes", "flu"]
+
+@pytest.mark.parametrize("sql", [
+    "SELECT diagnosis FROM visits GROUP BY diagnosis HAVING COUNT(*) > 1",
+    "SELECT diagnosis FROM visits UNION SELECT diagnosis FROM visits",
+    "SELECT visit_id, ROW_NUMBER() OVER (ORDER BY age) FROM visits",
+    "SELECT *, COUNT(*) FROM visits",
+    "SELECT COUNT(DISTINCT diagnosis) FROM visits",
+    "DELETE FROM visits",
+])
+def test_unmergeable_statements_are_rejected(sql):
+    with pytest.raises(FederationError):
+        FederatedQuery(sql)
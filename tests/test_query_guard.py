@@ -0,0 +1,63 @@
+import pytest
+from sqlalchemy import create_engine, text
+from query_guard import QueryGuard, QueryRejected, limit_rows
+from schema_catalog import SchemaCatalog
+from sql_tools import execute_query
+
+@pytest.fixture
+def engine(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'guard.db'}")
+    with engine.begin() as connection:
+        connection.execute(text("CREATE TABLE doctors (doctor_id INTEGER PRIMARY KEY, last_name TEXT)"))
+        connection.execute(text(
+            "CREATE TABLE medical_records (record_id INTEGER PRIMARY KEY, "
+            "doctor_id INTEGER REFERENCES doctors (doctor_id), diagnosis TEXT)"
+        ))
+        connection.execute(text("INSERT INTO doctors VALUES (:id, :name)"),
+                           [{"id": i, "name": f"Doctor {i}"} for i in range(1, 201)])
+        connection.execute(text("INSERT INTO medical_records VALUES (:id, :doctor, 'flu')"),
+                           [{"id": i, "doctor": i % 200 + 1} for i in range(1, 501)])
+    yield engine
+    engine.dispose()
+
+@pytest.fixture
+def guard(engine):
+    return QueryGuard(engine, SchemaCatalog.build(engine), max_examined_rows=10000, row_limit=100)
+
+def test_limit_rows_survives_a_trailing_comment(engine):
+    statement = limit_rows("SELECT * FROM medical_records -- every record;", 5)
+    with engine.connect() as connection:
+        assert len(connection.execute(text(statement)).fetchall()) == 5
+
+def test_unfiltered_scan_is_limited(guard, engine):
+    statement, note = guard.admit("SELECT * FROM medical_records;")
+    assert statement == limit_rows("SELECT * FROM medical_records", 100)
+    assert note and "first 100 rows" in note
+    assert len(execute_query(engine, statement).rows) == 100
+    assert guard.stats() == {"admitted": 1, "rewritten": 1, "rejected": 0, "timed_out": 0}
+
+@pytest.mark.parametrize("sql", [
+    "SELECT * FROM medical_records WHERE doctor_id = 3",
+    "SELECT diagnosis, COUNT(*) FROM medical_records GROUP BY diagnosis",
+    "SELECT * FROM doctors LIMIT 500",
+])
+def test_narrowed_statements_run_unchanged(guard, sql):
+    assert guard.admit(sql) == (sql, None)
+
+def test_cartesian_join_is_rejected_with_a_join_hint(guard):
+    with pytest.raises(QueryRejected, match=r"medical_records\.doctor_id = doctors\.doctor_id"):
+        guard.admit("SELECT COUNT(*) FROM medical_records, doctors")
+    assert guard.stats()["rejected"] == 1
+
+def test_joined_statement_is_admitted(guard):
+    sql = "SELECT * FROM medical_records r JOIN doctors d ON r.doctor_id = d.doctor_id WHERE d.doctor_id = 7"
+    assert guard.admit(sql) == (sql, None)
+
+def test_uncounted_admissions(guard):
+    guard.admit("SELECT * FROM medical_records", count=False)
+    with pytest.raises(QueryRejected):
+        guard.admit("SELECT COUNT(*) FROM medical_records, doctors", count=False)
+    assert guard.stats() == {"admitted": 0, "rewritten": 0, "rejected": 0, "timed_out": 0}
+
+def test_other_statements_pass_through(guard):
+    assert guard.admit("PRAGMA table_info(doctors);") == ("PRAGMA table_info(doctors)", None)